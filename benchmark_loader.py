@@ -0,0 +1,99 @@
+"""
+Copyright [2022-23], by the California Institute of Technology and Chapman University.
+ALL RIGHTS RESERVED. United States Government Sponsorship acknowledged. Any commercial use must be negotiated with the
+Office of Technology Transfer at the California Institute of Technology and Chapman University.
+This software may be subject to U.S. export control laws. By accepting this software, the user agrees to comply with all
+applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be
+required before exporting such information to foreign countries or providing access to foreign persons.
+"""
+import argparse
+from timeit import default_timer as timer
+
+import numpy as np
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from dbn_datasets import DBNDataset
+from dist_utils import get_sampler, batch_loader
+
+
+def loader_throughput(loader, sampler, epochs = 1):
+    """
+    Iterates over a DataLoader and measures how fast samples are delivered.
+
+    :param loader: DataLoader to iterate over.
+    :param sampler: Sampler driving the loader (set_epoch is called every epoch).
+    :param epochs: Number of passes over the loader.
+
+    :return: Samples per second, and the batches of the last epoch (for equivalence checks).
+    """
+    n_samples = 0
+    batches = []
+    start = timer()
+    for e in range(epochs):
+        sampler.set_epoch(e)
+        batches = []
+        for x_batch, y_batch in loader:
+            n_samples = n_samples + x_batch.shape[0]
+            batches.append((x_batch, y_batch))
+    return n_samples / (timer() - start), batches
+
+
+def compare_loaders(dataset, batch_size, epochs = 1, num_workers = 0, shuffle = True, drop_last = True):
+    """
+    Benchmarks per-sample fetching (DataLoader with collation) against whole-batch fetching (dist_utils.batch_loader)
+    over the same dataset and sampler, and checks both produce identical batches.
+
+    :param dataset: Dataset to load from.
+    :param batch_size: Amount of samples per batch.
+    :param epochs: Number of passes over the data per loader.
+    :param num_workers: Number of DataLoader worker processes.
+    :param shuffle: Whether or not to shuffle each epoch.
+    :param drop_last: Whether or not to drop the last, incomplete, batch.
+
+    :return: Dictionary with samples/s of each loader and the speedup.
+    """
+    sampler = get_sampler(dataset, shuffle=shuffle, drop_last=False)
+    per_sample = DataLoader(dataset, batch_size=batch_size, shuffle=False, sampler=sampler,
+        num_workers = num_workers, drop_last = drop_last)
+    per_sample_rate, per_sample_batches = loader_throughput(per_sample, sampler, epochs)
+
+    batched = batch_loader(dataset, sampler, batch_size, num_workers = num_workers, drop_last = drop_last)
+    batched_rate, batched_batches = loader_throughput(batched, sampler, epochs)
+
+    assert len(per_sample_batches) == len(batched_batches)
+    for (x1, y1), (x2, y2) in zip(per_sample_batches, batched_batches):
+        assert torch.equal(x1, x2) and torch.equal(y1, y2)
+
+    return {"per_sample": per_sample_rate, "batched": batched_rate, "speedup": batched_rate / per_sample_rate}
+
+
+def main(n_samples, n_features, batch_size, epochs, num_workers):
+    data = np.random.default_rng(42).random((n_samples, n_features), dtype=np.float32)
+    targets = np.zeros((n_samples, 3), dtype=np.int16)
+    targets[:,2] = np.arange(n_samples) % np.iinfo(np.int16).max
+
+    dbn_data = DBNDataset()
+    dbn_data.init_from_array(data, targets)
+    tensor_data = TensorDataset(dbn_data.data, dbn_data.targets)
+
+    for name, dataset in [("DBNDataset", dbn_data), ("TensorDataset", tensor_data)]:
+        res = compare_loaders(dataset, batch_size, epochs, num_workers)
+        print(name, "per-sample: %.0f samples/s, batched: %.0f samples/s, speedup: %.1fx" % \
+            (res["per_sample"], res["batched"], res["speedup"]))
+    res = compare_loaders(dbn_data, batch_size, epochs, num_workers, shuffle = False, drop_last = False)
+    print("DBNDataset (unshuffled, output generation)", "per-sample: %.0f samples/s, batched: %.0f samples/s, speedup: %.1fx" % \
+        (res["per_sample"], res["batched"], res["speedup"]))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--samples", type=int, default=1000000, help="Number of samples.")
+    parser.add_argument("-f", "--features", type=int, default=162, help="Number of features per sample (e.g. 9 channels with pixel_padding 1 is 81).")
+    parser.add_argument("-b", "--batch-size", type=int, default=128, help="Batch size.")
+    parser.add_argument("-e", "--epochs", type=int, default=1, help="Number of passes over the data per loader.")
+    parser.add_argument("-w", "--workers", type=int, default=0, help="Number of DataLoader workers.")
+    args = parser.parse_args()
+    main(args.samples, args.features, args.batch_size, args.epochs, args.workers)
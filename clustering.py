@@ -40,6 +40,7 @@ from dask_ml.preprocessing import StandardScaler
 #Data
 from dbn_datasets import DBNDataset
 from utils import numpy_to_torch, read_yaml, get_read_func, get_scaler
+from output_store import load_features, load_indices
 
 #Input Parsing
 import yaml
@@ -221,16 +222,16 @@ class RSClustering(object):
                     #    self.__train_scaler__(dat[j:j+1000000]) 
     
                     if ".data.input" in train_data[i]:
-                        tmp = da.from_array(torch.load(train_data[i]), chunks=self.chunks)
+                        tmp = load_features(train_data[i], self.chunks)
                         if np.isnan(tmp.min().compute()) and np.isnan(tmp.min().compute()):
                             continue
                         trn.append(tmp)
                     else: 
-                        tmp = da.from_array(torch.load(train_data[i]).detach().numpy(), chunks=self.chunks)
+                        tmp = load_features(train_data[i], self.chunks)
                         if np.isnan(tmp.min().compute()) and np.isnan(tmp.min().compute()):
                             continue
                         trn.append(tmp)
-                    print(torch.load(train_data[i]).detach().numpy().min(), torch.load(train_data[i]).detach().numpy().max())
+                    print(tmp.min().compute(), tmp.max().compute())
                     #self.__train_scaler__(trn[i])
                 trn = da.concatenate(trn)
                 self.__train_scaler__(trn)
@@ -242,12 +243,12 @@ class RSClustering(object):
                 trn = []
                 print(train_data[i])
                 if ".data.input" in train_data[i]: 
-                    tmp = da.from_array(torch.load(train_data[i]), chunks=self.chunks)
+                    tmp = load_features(train_data[i], self.chunks)
                     if np.isnan(tmp.min().compute()) and np.isnan(tmp.min().compute()):
                         continue
                     trn.append(tmp)
                 else:
-                    tmp = da.from_array(torch.load(train_data[i]).detach().numpy(), chunks=self.chunks)
+                    tmp = load_features(train_data[i], self.chunks)
                     if np.isnan(tmp.min().compute()) and np.isnan(tmp.min().compute()):
                             continue
                     trn.append(tmp)
@@ -326,26 +327,26 @@ class RSClustering(object):
         for i in range(len(train_data)):
             print("CLUSTERING", train_data[i])
             if ".data.input" in train_data[i]:
-                trn = da.from_array(torch.load(train_data[i]), chunks=self.chunks)
+                trn = load_features(train_data[i], self.chunks)
             else:
-                tmp = da.from_array(torch.load(train_data[i]).detach().numpy(), chunks=self.chunks)
+                tmp = load_features(train_data[i], self.chunks)
                 if np.isnan(tmp.min().compute()) and np.isnan(tmp.min().compute()):
                             continue
                 trn = tmp
-            train_indices = torch.load(train_data[i].replace(".input", "") + ".indices")
+            train_indices = load_indices(train_data[i].replace(".input", "") + ".indices")
  
             self.__cluster_data__(trn, train_indices, os.path.join(self.out_dir, os.path.basename(train_data[i])), scale)
 
         for i in range(len(test_data)):
             print("CLUSTERING", test_data[i])
             if ".data.input" in test_data[i]:
-                test = da.from_array(torch.load(test_data[i]), chunks=self.chunks)
+                test = load_features(test_data[i], self.chunks)
             else:
-                tmp = da.from_array(torch.load(test_data[i]).detach().numpy(), chunks=self.chunks)
+                tmp = load_features(test_data[i], self.chunks)
                 if np.isnan(tmp.min().compute()) and np.isnan(tmp.min().compute()):
                             continue
                 test = tmp
-            test_indices = torch.load(test_data[i].replace(".input", "") + ".indices")
+            test_indices = load_indices(test_data[i].replace(".input", "") + ".indices")
         
             self.__cluster_data__(test, test_indices, os.path.join(self.out_dir, os.path.basename(test_data[i])), scale) 
 
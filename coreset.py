@@ -0,0 +1,347 @@
+"""
+Copyright [2022-23], by the California Institute of Technology and Chapman University.
+ALL RIGHTS RESERVED. United States Government Sponsorship acknowledged. Any commercial use must be negotiated with the
+Office of Technology Transfer at the California Institute of Technology and Chapman University.
+This software may be subject to U.S. export control laws. By accepting this software, the user agrees to comply with all
+applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be
+required before exporting such information to foreign countries or providing access to foreign persons.
+"""
+import argparse
+import json
+
+import numpy as np
+import torch
+
+#Training subset selection methods
+#   random  - uniformly random samples (default)
+#   norm    - lightweight coreset: samples drawn with probability mixing uniform and squared distance to the data mean, so
+#             sparse and extreme regions of the feature space are kept. Two streaming passes, memory bounded by the subset size.
+#   kcenter - streaming (doubling) k-center greedy: every sample lies within a bounded distance of a selected one. A selection
+#             pass, a farthest-point top-up pass if merging left fewer than k centers, and a pass counting the samples each
+#             center covers - memory bounded by the subset size, cost grows with subset size x samples - intended for subsets
+#             of up to a few tens of thousands.
+SUBSET_METHODS = ["random", "norm", "kcenter"]
+
+#Rows processed at a time
+CHUNK_SIZE = 100000
+BLOCK_SIZE = 4096
+
+#Floor of the k-center radius, so near-identical samples (whose computed distances carry rounding error) still merge
+MIN_RADIUS = 1e-6
+
+
+def select_subset(data, k, method = "random", seed = 0):
+    """
+    Selects a training subset.
+
+    :param data: Samples (N_samples x N_features numpy array or memmap).
+    :param k: Amount of samples to select.
+    :param method: One of SUBSET_METHODS.
+    :param seed: Random seed.
+
+    :return: Sorted indices of the selected samples, and per-sample weights (the amount of data each selected sample stands for, summing to N_samples).
+    """
+    n_samples = data.shape[0]
+    if k >= n_samples:
+        return np.arange(n_samples), np.ones(n_samples)
+    if method == "random":
+        return np.sort(np.random.default_rng(seed).choice(n_samples, size=k, replace=False)), np.full(k, n_samples / k)
+    if method == "norm":
+        return lightweight_coreset(data, k, seed)
+    if method == "kcenter":
+        return kcenter_coreset(data, k)
+    raise ValueError("Unknown subset selection method " + str(method) + ", expected one of " + ", ".join(SUBSET_METHODS))
+
+
+def _chunk(data, i, chunk_size):
+    return torch.as_tensor(np.asarray(data[i:i+chunk_size], dtype=np.float32)).reshape(min(chunk_size, data.shape[0] - i), -1)
+
+
+def lightweight_coreset(data, k, seed = 0, chunk_size = CHUNK_SIZE):
+    """
+    Lightweight coreset (Bachem et al., 2018). Sample i is selected with probability proportional to
+    q_i = 1/(2N) + d(x_i, mean)^2 / (2 * sum_j d(x_j, mean)^2), via weighted reservoir sampling (Efraimidis & Spirakis), and weighted by 1 / (k q_i).
+    The first pass accumulates the mean and squared norms, the second samples. Only the k best reservoir keys are held in memory.
+
+    :param data: Samples (N_samples x N_features).
+    :param k: Amount of samples to select.
+    :param seed: Random seed.
+    :param chunk_size: Amount of samples processed at a time.
+
+    :return: Sorted indices of the selected samples and their weights.
+    """
+    n_samples = data.shape[0]
+    total = None
+    total_sq = 0.0
+    for i in range(0, n_samples, chunk_size):
+        chunk = _chunk(data, i, chunk_size).double()
+        total = chunk.sum(dim=0) if total is None else total + chunk.sum(dim=0)
+        total_sq = total_sq + (chunk ** 2).sum().item()
+    mean = (total / n_samples).float()
+    #sum_j ||x_j - mean||^2 = sum_j ||x_j||^2 - N ||mean||^2
+    dist_total = max(total_sq - n_samples * (mean.double() ** 2).sum().item(), np.finfo(np.float32).tiny)
+
+    rng = np.random.default_rng(seed)
+    keys = np.empty(0)
+    inds = np.empty(0, dtype=np.int64)
+    probs = np.empty(0)
+    for i in range(0, n_samples, chunk_size):
+        dist = ((_chunk(data, i, chunk_size) - mean) ** 2).sum(dim=1).double().numpy()
+        q = 0.5 / n_samples + 0.5 * dist / dist_total
+        #Reservoir key u^(1/q), compared in log space
+        keys = np.concatenate((keys, np.log(rng.random(q.shape[0])) / q))
+        inds = np.concatenate((inds, np.arange(i, i + q.shape[0])))
+        probs = np.concatenate((probs, q))
+        if keys.shape[0] > k:
+            top = np.argpartition(-keys, k - 1)[:k]
+            keys = keys[top]
+            inds = inds[top]
+            probs = probs[top]
+    order = np.argsort(inds)
+    return inds[order], 1.0 / (k * probs[order])
+
+
+def kcenter_coreset(data, k, block_size = BLOCK_SIZE, device = "cpu"):
+    """
+    Streaming k-center greedy via the doubling algorithm (Charikar et al., 1997). A sample farther than 2r from every
+    selected center becomes a center. Whenever there are more than k centers, r is doubled and centers within 2r of an
+    earlier center are merged into it. Every sample ends up within 8x the optimal k-center radius of a center.
+    Doubling can leave fewer than k centers, in which case a second pass tops them up, farthest samples first. A final
+    pass counts the samples each center covers. At most k centers (plus one block, and the top-up candidates) are held in memory.
+
+    :param data: Samples (N_samples x N_features).
+    :param k: Amount of samples to select.
+    :param block_size: Amount of samples processed at a time.
+    :param device: Device distances are computed on.
+
+    :return: Sorted indices of the min(k, N_samples) selected samples, and the amount of samples each one covers.
+    """
+    n_select = min(k, data.shape[0])
+    centers = None
+    inds = np.empty(0, dtype=np.int64)
+    counts = np.empty(0)
+    radius = 0.0
+    for i in range(0, data.shape[0], block_size):
+        block = _chunk(data, i, block_size).to(device)
+        block_inds = np.arange(i, i + block.shape[0])
+        if centers is not None:
+            dist, nearest = torch.cdist(block, centers).min(dim=1)
+            covered = (dist <= 2.0 * radius).cpu().numpy()
+            counts = counts + np.bincount(nearest.cpu().numpy()[covered], minlength=counts.shape[0])
+            block = block[torch.from_numpy(~covered).to(device)]
+            block_inds = block_inds[~covered]
+        if block.shape[0] == 0:
+            continue
+        new, new_counts = _greedy_centers(block, radius)
+        centers = block[new] if centers is None else torch.cat((centers, block[new]))
+        inds = np.concatenate((inds, block_inds[new]))
+        counts = np.concatenate((counts, new_counts))
+
+        while centers.shape[0] > k:
+            if radius == 0.0:
+                #k+1 distinct centers - some pair shares an optimal center, so half their separation bounds the optimal radius from below
+                radius = max(_min_separation(centers, block_size) / 2.0, MIN_RADIUS)
+            else:
+                radius = 2.0 * radius
+            keep, merged = _merge_centers(centers, counts, radius, block_size)
+            centers = centers[torch.from_numpy(keep).to(device)]
+            inds = inds[keep]
+            counts = merged
+    #Doubling the radius can merge the centers well below k - top them back up, farthest first
+    if inds.shape[0] < n_select:
+        centers, inds = _top_up(data, centers, inds, n_select, block_size, device)
+    #Coverage counts of the final centers (the merged counts are only approximate)
+    counts = _cover(data, centers, inds, block_size, device)[0]
+    if inds.shape[0] != n_select or np.unique(inds).shape[0] != n_select:
+        raise ValueError("k-center selected " + str(np.unique(inds).shape[0]) + " of " + str(n_select) + " samples")
+    order = np.argsort(inds)
+    return inds[order], counts[order]
+
+
+def _cover(data, centers, inds, block_size, device, n_far = 0):
+    """
+    One pass over the data.
+
+    :return: Amount of samples nearest to each center, and the indices and distances of the n_far samples (centers excluded) farthest from every center.
+    """
+    counts = np.zeros(centers.shape[0])
+    far_inds = np.empty(0, dtype=np.int64)
+    far_dist = np.empty(0)
+    for i in range(0, data.shape[0], block_size):
+        dist, nearest = torch.cdist(_chunk(data, i, block_size).to(device), centers).min(dim=1)
+        counts = counts + np.bincount(nearest.cpu().numpy(), minlength=counts.shape[0])
+        if n_far == 0:
+            continue
+        block_inds = np.arange(i, i + dist.shape[0])
+        keep = ~np.isin(block_inds, inds)
+        far_inds = np.concatenate((far_inds, block_inds[keep]))
+        far_dist = np.concatenate((far_dist, dist.cpu().numpy().astype(np.float64)[keep]))
+        if far_inds.shape[0] > n_far:
+            top = np.argpartition(-far_dist, n_far - 1)[:n_far]
+            far_inds = far_inds[top]
+            far_dist = far_dist[top]
+    return counts, far_inds, far_dist
+
+
+def _top_up(data, centers, inds, n_select, block_size, device, pool_factor = 4):
+    """
+    Adds centers by farthest-point selection until there are n_select. Candidates are the pool_factor x (missing centers)
+    samples farthest from the current centers (found in one pass), whose distances are updated as centers are added.
+
+    :return: Centers and their indices.
+    """
+    n_missing = n_select - inds.shape[0]
+    n_pool = min(data.shape[0] - inds.shape[0], pool_factor * n_missing)
+    _, pool, dist = _cover(data, centers, inds, block_size, device, n_pool)
+    order = np.argsort(pool)
+    pool = pool[order]
+    pool_data = _chunk(data[pool], 0, n_pool).to(device)
+    pool_dist = torch.as_tensor(dist[order], device=device)
+    new = []
+    for _ in range(n_missing):
+        j = int(torch.argmax(pool_dist))
+        new.append(j)
+        pool_dist = torch.minimum(pool_dist, torch.cdist(pool_data, pool_data[j:j+1])[:, 0].double())
+        pool_dist[j] = -1.0
+    new = np.array(new, dtype=np.int64)
+    return torch.cat((centers, pool_data[torch.from_numpy(new).to(device)])), np.concatenate((inds, pool[new]))
+
+
+def check_subset_size(n_samples = 20000, k_values = (500, 1000, 5000), n_features = (9, 20, 81), seed = 0):
+    """
+    Checks that k-center selection returns exactly min(k, N_samples) samples, covering every sample, across dimensionalities.
+
+    :return: List of (n_features, k, n_selected) checked.
+    """
+    rng = np.random.default_rng(seed)
+    checked = []
+    for d in n_features:
+        data = rng.normal(size=(n_samples, d)).astype(np.float32)
+        for k in k_values:
+            inds, counts = kcenter_coreset(data, k)
+            n_select = min(k, n_samples)
+            if inds.shape[0] != n_select or np.unique(inds).shape[0] != n_select or counts.sum() != n_samples:
+                raise ValueError("k-center selected " + str(np.unique(inds).shape[0]) + " of " + str(n_select) +
+                    " samples (covering " + str(counts.sum()) + " of " + str(n_samples) + ") at " + str(d) + " features")
+            checked.append((d, k, int(inds.shape[0])))
+    return checked
+
+
+def _greedy_centers(block, radius):
+    """
+    Sequential greedy cover of one block: the first uncovered sample becomes a center and covers every sample within 2 * radius.
+
+    :return: Indices (within the block) of the new centers, and the amount of samples each covers.
+    """
+    dist = torch.cdist(block, block).cpu().numpy() <= 2.0 * radius
+    np.fill_diagonal(dist, True)
+    remaining = np.ones(block.shape[0], dtype=bool)
+    new = []
+    new_counts = []
+    for j in range(block.shape[0]):
+        if not remaining[j]:
+            continue
+        close = dist[j] & remaining
+        new.append(j)
+        new_counts.append(close.sum())
+        remaining = remaining & ~close
+    return np.array(new, dtype=np.int64), np.array(new_counts, dtype=np.float64)
+
+
+def _min_separation(centers, block_size):
+    """
+    :return: Smallest distance between two (distinct) centers.
+    """
+    sep = np.inf
+    for i in range(0, centers.shape[0], block_size):
+        dist = torch.cdist(centers[i:i+block_size], centers)
+        rows = torch.arange(dist.shape[0], device=dist.device)
+        dist[rows, rows + i] = np.inf
+        sep = min(sep, dist.min().item())
+    return sep
+
+
+def _merge_centers(centers, counts, radius, block_size):
+    """
+    Re-covers the current centers at a larger radius, in their selection order. Counts of dropped centers go to the kept center that covers them.
+
+    :return: Boolean mask of kept centers, and the counts of the kept centers.
+    """
+    kept = np.zeros(centers.shape[0], dtype=bool)
+    owner = np.arange(centers.shape[0])
+    for i in range(0, centers.shape[0], block_size):
+        block = centers[i:i+block_size]
+        covered = np.zeros(block.shape[0], dtype=bool)
+        kept_inds = np.where(kept)[0]
+        if kept_inds.shape[0] > 0:
+            dist, nearest = torch.cdist(block, centers[torch.from_numpy(kept_inds).to(centers.device)]).min(dim=1)
+            covered = (dist <= 2.0 * radius).cpu().numpy()
+            owner[i:i+block.shape[0]][covered] = kept_inds[nearest.cpu().numpy()[covered]]
+        unc = np.where(~covered)[0]
+        if unc.shape[0] == 0:
+            continue
+        within = torch.cdist(block[unc], block[unc]).cpu().numpy() <= 2.0 * radius
+        np.fill_diagonal(within, True)
+        remaining = np.ones(unc.shape[0], dtype=bool)
+        for j in range(unc.shape[0]):
+            if not remaining[j]:
+                continue
+            close = within[j] & remaining
+            kept[i + unc[j]] = True
+            owner[i + unc[close]] = i + unc[j]
+            remaining = remaining & ~close
+    merged = np.bincount(owner, weights=counts, minlength=centers.shape[0])
+    return kept, merged[kept]
+
+
+def coverage(data, inds, n_probe = 1000, seed = 0, chunk_size = CHUNK_SIZE):
+    """
+    Measures how well a subset covers the feature space of the full data: the distance from randomly probed samples to their
+    nearest selected sample, compared with a random subset of the same size.
+
+    :param data: Samples (N_samples x N_features).
+    :param inds: Indices of the selected samples.
+    :param n_probe: Amount of samples to probe.
+    :param seed: Random seed.
+    :param chunk_size: Amount of selected samples compared against at a time.
+
+    :return: Dictionary of mean, median, 95th percentile, and max nearest-selected distance, for the subset and for a random subset.
+    """
+    rng = np.random.default_rng(seed)
+    probe = np.sort(rng.choice(data.shape[0], size=min(n_probe, data.shape[0]), replace=False))
+    baseline = np.sort(rng.choice(data.shape[0], size=len(inds), replace=False))
+    x = torch.as_tensor(np.asarray(data[probe], dtype=np.float32)).reshape(probe.shape[0], -1)
+    report = {"n_samples": int(data.shape[0]), "n_selected": int(len(inds)), "n_probe": int(probe.shape[0])}
+    for name, subset in [("selected", inds), ("random", baseline)]:
+        nearest = None
+        for i in range(0, len(subset), chunk_size):
+            dist = torch.cdist(x, _chunk(data[np.asarray(subset[i:i+chunk_size])], 0, chunk_size)).min(dim=1).values
+            nearest = dist if nearest is None else torch.minimum(nearest, dist)
+        nearest = nearest.numpy()
+        report[name] = {"mean": float(nearest.mean()), "median": float(np.median(nearest)),
+            "p95": float(np.percentile(nearest, 95)), "max": float(nearest.max())}
+    return report
+
+
+def main(data_fname, k, methods, n_probe, check = False):
+    if check:
+        for d, k_check, n_selected in check_subset_size():
+            print("kcenter", d, "features:", n_selected, "of", k_check, "samples selected")
+        return
+    data = np.load(data_fname, mmap_mode="r")
+    data = data.reshape(data.shape[0], -1)
+    for method in methods:
+        inds, weights = select_subset(data, k, method)
+        print(method, json.dumps(coverage(data, inds, n_probe), indent=2))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Reports how well training subsets selected by each method cover the feature space of the full data.")
+    parser.add_argument("-d", "--data", help="Preprocessed samples (.npy), e.g. train_data.npy written by dbn_datasets.py with subset_training = -1.")
+    parser.add_argument("-k", "--samples", type=int, help="Subset size.")
+    parser.add_argument("-m", "--methods", nargs="+", default=SUBSET_METHODS, help="Selection methods to compare.")
+    parser.add_argument("-p", "--probe", type=int, default=1000, help="Number of samples probed for coverage.")
+    parser.add_argument("-c", "--check", action="store_true", help="Check k-center subset sizes on synthetic data of several dimensionalities, instead of comparing methods.")
+    args = parser.parse_args()
+    main(args.data, args.samples, args.methods, args.probe, args.check)
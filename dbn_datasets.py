@@ -7,6 +7,8 @@ applicable U.S. export laws and regulations. User has the responsibility to obta
 required before exporting such information to foreign countries or providing access to foreign persons.
 """
 import os
+import shutil
+import hashlib
 import numpy as np
 import random
 import copy
@@ -15,17 +17,25 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 
 import argparse
+import json
 
 import sys
 sys.setrecursionlimit(4500)
 
 from utils import numpy_to_torch, read_yaml, get_read_func, get_scaler
+from dist_utils import get_rank, get_world_size, all_reduce, collective_device, all_reduce_scaler
+from sample_codec import SampleCodec
+from coreset import select_subset, coverage
+from validity import validity_mask, pixel_mask, window_mask, pack_mask, FILL
+from spectral_reduction import SpectralReducer
+from telemetry import get_telemetry
 
 import pickle
 from joblib import load, dump
 
 #ML imports
 import torch
+import torch.distributed as dist
 from sklearn.preprocessing import StandardScaler, MinMaxScaler, MaxAbsScaler
 from sklearn.utils import shuffle
 
@@ -57,6 +67,7 @@ class DBNDataset(torch.utils.data.Dataset):
 		#Set class attributes
 		self.data_full = data_full
 		self.targets_full = targets_full
+		self.codec = None
 
 		self.train_indices = None
 		self.scaler = scaler
@@ -88,6 +99,15 @@ class DBNDataset(torch.utils.data.Dataset):
 		self.data_full = np.load(data_filename)
 		self.targets_full = np.load(indices_filename)
 
+		#Reduced-precision samples are stored alongside their codec
+		self.codec = None
+		if os.path.exists(get_codec_filename(data_filename)):
+			self.codec = load(get_codec_filename(data_filename))
+		#As are the weights of weighted training subsets
+		self.counts_full = None
+		if os.path.exists(get_weights_filename(data_filename)):
+			self.counts_full = np.load(get_weights_filename(data_filename))
+
 		self.train_indices = None
 		self.scale = False
 		self.scaler = scaler
@@ -105,7 +125,68 @@ class DBNDataset(torch.utils.data.Dataset):
 		self.next_subset()
 
 
-	def read_and_preprocess_data(self, filenames, read_func, read_func_kwargs, pixel_padding, delete_chans, valid_min, valid_max, fill_value = -9999, chan_dim = 0, transform_chans = [], transform_values = [], scaler = None, scale=False, transform=None, subset=None, train_scaler = False, subset_training = -1, stratify_data = None):
+	def publish_shared(self, path):
+		"""
+		Publishes the preprocessed samples and indices so that other processes on the node can use them without their own copy.
+		data_full and targets_full are written to path as .npy files (alongside the scaler, transform, and training indices) and
+		are then replaced in this Dataset by read-only memory maps of those files. Use read_shared to attach from other processes.
+		If path is on a RAM-backed filesystem (e.g. /dev/shm), the pages are shared in memory; otherwise they are shared through the page cache.
+		DataLoader workers forked afterwards map the same pages rather than copying them.
+
+		:param path: Directory to publish to. Should be node-local.
+		"""
+		os.makedirs(path, exist_ok=True)
+		data = self.data_full
+		targets = self.targets_full
+		if torch.is_tensor(data):
+			data = data.numpy()
+		if torch.is_tensor(targets):
+			targets = targets.numpy()
+		np.save(os.path.join(path, "data.npy"), data)
+		np.save(os.path.join(path, "targets.npy"), targets)
+		with open(os.path.join(path, "attributes.pkl"), "wb") as f:
+			dump({"scaler": self.scaler, "transform": self.transform, "train_indices": self.train_indices, "codec": self.get_codec(), \
+				"counts": getattr(self, "counts_full", None), "reducer": getattr(self, "reducer", None)}, \
+				f, True, pickle.HIGHEST_PROTOCOL)
+		del data, targets
+		self.__map_shared__(path)
+
+
+	def read_shared(self, path, subset=None):
+		"""
+		Initializes Dataset by attaching (read-only) to samples published by another process via publish_shared.
+
+		:param path: Directory the Dataset was published to.
+		:param subset: Optional number of subsets to break data into. Default is 1.
+		"""
+		with open(os.path.join(path, "attributes.pkl"), "rb") as f:
+			attributes = load(f)
+		self.scaler = attributes["scaler"]
+		self.transform = attributes["transform"]
+		self.train_indices = attributes["train_indices"]
+		self.codec = attributes["codec"]
+		self.counts_full = attributes["counts"]
+		self.reducer = attributes["reducer"]
+		self.scale = self.scaler is not None
+		self.subset = subset
+		if self.subset is None:
+			self.subset = 1
+		self.__map_shared__(path)
+
+
+	def __map_shared__(self, path):
+		"""
+		Internal function to replace data_full and targets_full with read-only memory maps of published files. Use publish_shared or read_shared to interface.
+
+		:param path: Directory the Dataset was published to.
+		"""
+		self.data_full = np.load(os.path.join(path, "data.npy"), mmap_mode="r")
+		self.targets_full = np.load(os.path.join(path, "targets.npy"), mmap_mode="r")
+		self.current_subset = -1
+		self.next_subset()
+
+
+	def read_and_preprocess_data(self, filenames, read_func, read_func_kwargs, pixel_padding, delete_chans, valid_min, valid_max, fill_value = -9999, chan_dim = 0, transform_chans = [], transform_values = [], scaler = None, scale=False, transform=None, subset=None, train_scaler = False, subset_training = -1, stratify_data = None, shard = False, storage_dtype = "float32", subset_method = "random", subset_weighted = False, reducer = None, train_reducer = False):
 		"""
 		High level initialization function for data ingestion, preprocessesing, and Dataset initialization. Data gets read in in file x channel x line x sample dimensionality and gets preprocessed/changed into n_samples x n_features dimensionality. 
 	
@@ -127,11 +208,21 @@ class DBNDataset(torch.utils.data.Dataset):
 			:param train_scaler: Optional boolean value indicating whether or not to train scaler with data in Dataset. Default is False.
 			:param subset_training: Optional number of samples to subset and extract out of full preprocessed set. Typically used for training Datasets. If set to -1, full set of samples is kept. Associated stratification and oversampling techniques being developed. Default is -1. 
 			:param stratify_data: Optional dictionary describing data and techniques for stratification of subset. Subset size specified via subset_training. Currently under development and should be left unset/set to None. If set to None, no stratification is done. Default value is None.
+			:param storage_dtype: Optional data type preprocessed samples are kept in (float32, float16, bfloat16, or int16 with per-feature offset and scale). Samples are upcast to float32 one batch at a time as they are fetched. See sample_codec. Default is float32.
+			:param shard: Optional boolean value indicating whether or not each distributed rank ingests only its own shard of the data. Files are assigned round-robin to ranks (or, if there are fewer files than ranks, each rank preprocesses its own block of rows of every scene - files are still read in full by every rank), scaler statistics are combined across ranks, and shards are padded to equal length. subset_training is then the total across ranks. The Dataset is flagged as sharded so samplers do not partition it again. Default is False.
+			:param subset_method: Optional method used to select the subset_training samples: random (first samples after shuffling), norm (lightweight coreset), or kcenter (streaming k-center greedy). See coreset. Coverage of the full feature space by the subset is kept in coverage_report. Default is random.
+			:param subset_weighted: Optional boolean value indicating whether or not subset samples are drawn during training in proportion to the amount of data they stand for (coreset weights), rather than uniformly. Default is False.
+			:param reducer: Optional SpectralReducer applied to every (scaled) pixel before neighborhood windows are extracted, reducing the number of channels per pixel. See spectral_reduction. If set to None, no reduction is done. Default value is None.
+			:param train_reducer: Optional boolean value indicating whether or not to fit the reducer with data in Dataset, after the scaler. Default is False.
 		"""
 
 		#Set class attributes
 		self.train_indices = None
 		self.training = False
+		self.sharded = shard and get_world_size() > 1
+		self.shard_files = self.sharded and len(filenames) >= get_world_size()
+		self.storage_dtype = storage_dtype
+		self.codec = None
 		self.filenames = filenames
 		self.transform = transform
 		self.pixel_padding = pixel_padding
@@ -151,14 +242,114 @@ class DBNDataset(torch.utils.data.Dataset):
 		self.subset = subset
 		self.subset_training = subset_training
 		self.stratify_data = stratify_data
+		self.subset_method = subset_method
+		self.subset_weighted = subset_weighted
+		self.reducer = reducer
+		self.train_reducer = train_reducer
+		self.coverage_report = None
+		self.reduction_report = None
 		if self.subset is None:
 			self.subset = 1		
 		self.current_subset = -1
+		if self.sharded and self.subset_training > 0:
+			self.subset_training = int(self.subset_training / get_world_size())
 
 
 		#load and preprocess data
 		self.__loaddata__()
 
+	def read_and_preprocess_scene(self, filename, read_func, read_func_kwargs, pixel_padding, delete_chans, valid_min, valid_max, fill_value = -9999, chan_dim = 0, transform_chans = [], transform_values = [], scaler = None, scale = False, reducer = None):
+		"""
+		Reads and preprocesses a single file exactly as read_and_preprocess_data does, but keeps it as a scene - neighborhood
+		windows are not extracted, so (convolutional) scene-level inference can run over it without the (1 + 2 * pixel_padding)^2
+		copy of every pixel. See rbm_models.scene_inference.
+
+		:param filename: File (or list of files, as in an entry of data/files_test) to read.
+		:param read_func: Function to be used to read data in from file. Will be used with read_func_kwargs.
+		:param read_func_kwargs: Arguments to be passed into read_func.
+		:param pixel_padding: Number of pixels to extend per-pixel/per-sample 'neighborhood' away from center sample of focus. Can be 0.
+		:param delete_chans: Channels to be deleted from the data.
+		:param valid_min: Minimum valid value in data. Anything less will be set to a fill value and not used.
+		:param valid_max: Maximum valid value in data. Anything greater  will be set to a fill value and not used.
+		:param fill_value: Optional fill value to be used for bad/unusample samples/pixeld. Default value is -9999.
+		:param chan_dim: Optional dimension of channels. Default value is 0.
+		:param transform_chans: Optional channels to have special transforms applied to pixels out of expected ranges prior to filling. Default value is empty list ([]).
+		:param transform_values: Optional values to be used for special transforms. Default value is empty list ([]).
+		:param scaler: Optional trained per-feature scaler. Default value is None.
+		:param scale: Optional boolean value specifying whether or not to use scaler to scale data. Default value is False.
+		:param reducer: Optional trained SpectralReducer. Default value is None.
+
+		:return: Preprocessed scene (rows x columns x channels, float32, invalid pixels set to fill) and its per-pixel validity mask.
+		"""
+		self.filenames = [filename]
+		self.pixel_padding = pixel_padding
+		self.delete_chans = delete_chans
+		self.valid_min = valid_min
+		self.valid_max = valid_max
+		self.fill_value = fill_value
+		self.chan_dim = chan_dim
+		self.transform_chans = transform_chans
+		self.transform_value = transform_values
+		self.scaler = scaler
+		self.scale = scale
+		self.read_func = read_func
+		self.read_func_kwargs = read_func_kwargs
+		self.reducer = reducer
+
+		dat, mask = self.__read_file__(filename)
+		self.chan_dim = 2
+		if self.scale and mask.any():
+			dat[mask] = self.scaler.transform(dat[mask])
+		if self.reducer is not None:
+			reduced = np.full(dat.shape[:2] + (self.reducer.n_components,), FILL, dtype=dat.dtype)
+			if mask.any():
+				reduced[mask] = self.reducer.transform(dat[mask])
+			dat = reduced
+		self.valid_masks = [pack_mask(mask)]
+		return dat.astype(np.float32), mask
+
+	def __read_file__(self, filename):
+		"""
+		Internal function to read one file, apply channel transforms and deletions, and set invalid values to fill.
+
+		:param filename: File (or list of files) to read.
+
+		:return: Data (rows x columns x channels, float64) and per-pixel validity mask.
+		"""
+		print(filename)
+		#Use read function passed in to get data into numpy ndarray
+		dat = self.read_func(filename, **self.read_func_kwargs).astype(np.float64)
+		print(dat.shape)
+		#If single channel, 2D data, transform into 3D (setting 3rd dimension to 1)
+		if dat.ndim == 2:
+			dat = np.expand_dims(dat, self.chan_dim)
+		#Apply channel-specific transformations, if any. 		
+		for t in range(len(self.transform_chans)):
+			slc = [slice(None)] * dat.ndim
+			slc[self.chan_dim] = slice(self.transform_chans[t], self.transform_chans[t]+1)
+			tmp = dat[tuple(slc)]
+			if self.valid_min is not None:
+				inds = np.where(tmp < self.valid_min - 0.00000000005) 
+				tmp[inds] = self.transform_value[t]
+			if self.valid_max is not None:
+				inds = np.where(tmp > self.valid_max - 0.00000000005)
+				tmp[inds] = self.transform_value[t]
+			dat[tuple(slc)] = tmp
+		if len(self.transform_chans) > 0:
+			del slc
+			del tmp
+					
+		#Delete channels set to be unused in config	
+		dat = np.delete(dat, self.delete_chans, self.chan_dim)
+
+		#Values outside of specified valid range, or fill, are marked invalid once here and set to fill.
+		#Later stages use the per-pixel mask rather than scanning for fill.
+		valid = validity_mask(dat, self.valid_min, self.valid_max, self.fill_value)
+		dat[~valid] = FILL
+		#Move specified channel dimension to 3rd position for uniformity
+		dat = np.moveaxis(dat, self.chan_dim, 2)
+		return dat, pixel_mask(valid, self.chan_dim)
+
 	def __loaddata__(self):
 		"""
 		Internal function for data ingestion and preprocessing. Should not be interfaced with directly. Use read_and_preprocess_data to properly interface.
@@ -166,52 +357,45 @@ class DBNDataset(torch.utils.data.Dataset):
 
 		strat_local = []
 		data_local = []
-		for i in range(0, len(self.filenames)):
+		masks_local = []
+		fit_masks = []
+		full_masks = []
+		row_offsets = []
+		file_ids = []
+		file_range = range(0, len(self.filenames))
+		if self.shard_files:
+			file_range = range(get_rank(), len(self.filenames), get_world_size())
+		for i in file_range:
 			#Read data in one file at a time
 			if (type(self.filenames[i]) == str and os.path.exists(self.filenames[i])) or (type(self.filenames[i]) is list and os.path.exists(self.filenames[i][0])):
 
-				print(self.filenames[i])
-				#Use read function passed in to get data into numpy ndarray
-				dat = self.read_func(self.filenames[i], **self.read_func_kwargs).astype(np.float64)
-				print(dat.shape)
+				dat, mask = self.__read_file__(self.filenames[i])
 				strat_data = None
-				#If single channel, 2D data, transform into 3D (setting 3rd dimension to 1)
-				if dat.ndim == 2:
-					dat = np.expand_dims(dat, self.chan_dim)
 				#Setup data to use for stratification
 				if self.stratify_data is not None:
 					strat_data = self.stratify_data["reader"](self.stratify_data["filename"][i], \
 						**self.stratify_data["reader_kwargs"])	
-				#Apply channel-specific transformations, if any. 		
-				for t in range(len(self.transform_chans)):
-					slc = [slice(None)] * dat.ndim
-					slc[self.chan_dim] = slice(self.transform_chans[t], self.transform_chans[t]+1)
-					tmp = dat[tuple(slc)]
-					if self.valid_min is not None:
-						inds = np.where(tmp < self.valid_min - 0.00000000005) 
-						tmp[inds] = self.transform_value[t]
-					if self.valid_max is not None:
-						inds = np.where(tmp > self.valid_max - 0.00000000005)
-						tmp[inds] = self.transform_value[t]
-					dat[tuple(slc)] = tmp
-				if len(self.transform_chans) > 0:
-					del slc
-					del tmp
-							
-				#Delete channels set to be unused in config	
-				dat = np.delete(dat, self.delete_chans, self.chan_dim)
-
-				#Set all other values outside of specified valid range to fill
-				if self.valid_min is not None:
-					dat[np.where(dat < self.valid_min - 0.00000000005)] = -9999
-				if self.valid_max is not None:	
-					dat[np.where(dat > self.valid_max - 0.00000000005)] = -9999
-				if self.fill_value is not None:
-					dat[np.where(dat == self.fill_value)] = -9999
-				#Move specified channel dimension to 3rd position for uniformity
-				dat = np.moveaxis(dat, self.chan_dim, 2)
+				full_masks.append(mask)
+				fit_mask = mask
+				row_offset = 0
+				if self.sharded and not self.shard_files:
+					#Fewer files than ranks - each rank preprocesses only its own block of rows of every scene, plus
+					#pixel_padding rows of context on either side so every window centered in the block is complete
+					lo, hi, own_start, own_end = self.__row_block__(dat.shape[0])
+					dat = dat[lo:hi]
+					mask = mask[lo:hi]
+					if strat_data is not None:
+						strat_data = strat_data[lo:hi]
+					#Context rows belong to the neighboring ranks' blocks, so are left out of the scaler fit
+					fit_mask = np.zeros(mask.shape, dtype=bool)
+					fit_mask[own_start - lo:own_end - lo] = mask[own_start - lo:own_end - lo]
+					row_offset = lo
 				#Append data and stratification data from current files to full set
 				data_local.append(dat)
+				masks_local.append(mask)
+				fit_masks.append(fit_mask)
+				row_offsets.append(row_offset)
+				file_ids.append(i)
 				if strat_data is not None:
 					#TODO Generalize to multi-class
 					strat_data = strat_data.astype(np.int32)
@@ -225,18 +409,35 @@ class DBNDataset(torch.utils.data.Dataset):
 			#Train scaler if applicable
 			if self.scaler is None or self.train_scaler:
 				self.training = True
-				self.__train_scaler__(data_local)
+				get_telemetry().start("scaler_fit")
+				self.__train_scaler__(data_local, fit_masks)
+				#Each rank has only seen its own files (or rows)
+				if self.sharded:
+					all_reduce_scaler(self.scaler)
+				get_telemetry().stop("scaler_fit", sum(int(m.sum()) for m in fit_masks))
 
 			#If scale == True do per-channel scaling on all valid pixels
 			for r in range(len(data_local)):	
-				subd = data_local[r]
-				shape = copy.deepcopy(subd.shape)
-				subd = subd.reshape(-1, shape[self.chan_dim])
-				inds = np.where(subd <= -9998)
-				subd = self.scaler.transform(subd)
-				subd[inds] = -9999
-				subd = subd.reshape(shape)
-				data_local[r] = subd
+				if masks_local[r].any():
+					data_local[r][masks_local[r]] = self.scaler.transform(data_local[r][masks_local[r]])
+
+		#Reduce the channels of every valid pixel, ahead of neighborhood expansion
+		if self.reducer is not None:
+			if self.train_reducer:
+				get_telemetry().start("reducer_fit")
+				for r in range(len(data_local)):
+					if masks_local[r].any():
+						self.reducer.partial_fit(data_local[r][masks_local[r]])
+				self.reducer.finalize()
+				get_telemetry().stop("reducer_fit", sum(int(m.sum()) for m in masks_local))
+				self.reduction_report = self.reducer.explained_variance()
+				print("SPECTRAL REDUCTION", self.reduction_report["method"], self.reduction_report["n_components"], \
+					"COMPONENTS, VARIANCE RETAINED", self.reduction_report["total"])
+			for r in range(len(data_local)):
+				reduced = np.full(data_local[r].shape[:2] + (self.reducer.n_components,), FILL, dtype=data_local[r].dtype)
+				if masks_local[r].any():
+					reduced[masks_local[r]] = self.reducer.transform(data_local[r][masks_local[r]])
+				data_local[r] = reduced
 
 		dim1 = 0
 		dim2 = 1
@@ -249,6 +450,8 @@ class DBNDataset(torch.utils.data.Dataset):
 		self.data = []
 		self.targets = []
 		self.stratify_training = []
+		#Per-scene pixel validity (packed, see validity), carried through to outputs
+		self.valid_masks = []
 		for r in range(len(data_local)):
 			"""
 			For each scene split out each pixel and its pre-specified neighborhood/surrounding window to be used as a single sample.
@@ -261,15 +464,19 @@ class DBNDataset(torch.utils.data.Dataset):
 			size_wind = 1 + 2 * self.pixel_padding
 			tgts = np.indices(data_local[r].shape[0:2])
 			tgts = tgts[:,self.pixel_padding:tgts.shape[1] - self.pixel_padding,self.pixel_padding:tgts.shape[2] - self.pixel_padding]
-			tgts = np.concatenate((np.full((1,tgts.shape[1], tgts.shape[2]),r, dtype=np.int16), tgts), axis=0)
+			tgts[0] += row_offsets[r]
+			file_id = r
+			if self.shard_files:
+				file_id = file_ids[r]
+			tgts = np.concatenate((np.full((1,tgts.shape[1], tgts.shape[2]),file_id, dtype=np.int16), tgts), axis=0)
 			tgts = tgts.reshape((3,tgts.shape[1]*tgts.shape[2])).astype(np.int16)
-			sub_data_total = view_as_windows(data_local[r], [size_wind, size_wind, data_local[r].shape[2]], step=1)
-			sub_data_total = sub_data_total.reshape((sub_data_total.shape[0]*sub_data_total.shape[1], -1))		
 
-			#No sample is used that contains a fill value
-			del_inds = np.where(sub_data_total <= -9998)[0]
-			sub_data_total = np.delete(sub_data_total, del_inds, 0)
-			tgts = np.delete(tgts, del_inds, 1)
+			#No sample is used that contains an invalid pixel - only valid windows are copied out of the (strided) window view
+			samples_valid = window_mask(masks_local[r], self.pixel_padding)
+			self.valid_masks.append(pack_mask(full_masks[r]))
+			sub_data_total = view_as_windows(data_local[r], [size_wind, size_wind, data_local[r].shape[2]], step=1)
+			sub_data_total = sub_data_total[samples_valid].reshape((-1, size_wind * size_wind * data_local[r].shape[2]))
+			tgts = tgts[:, samples_valid.ravel()]
 
 			#Preprocess stratification data in same manner
 			if len(strat_local) > 0:
@@ -313,14 +520,25 @@ class DBNDataset(torch.utils.data.Dataset):
 				self.stratify_training = np.array(self.stratify_training)
 				self.stratify_training = self.stratify_training.reshape((-1))
 				self.__stratify_training__()
+			elif self.subset_method != "random":
+				self.__select_coreset__()
 			else:
 				self.data_full = self.data_full[:self.subset_training,:]
 				self.targets_full = self.targets_full[:self.subset_training,:]
 		del self.data
 		del self.targets
 
+		if self.sharded:
+			self.__balance_shards__()
+
 		print("STATS", self.data_full.min(), self.data_full.max(), self.data_full.mean(), self.data_full.std())
 
+		#Reduce storage precision, if configured
+		if self.storage_dtype != "float32":
+			self.codec = SampleCodec(self.storage_dtype)
+			self.data_full = self.codec.fit_encode(self.data_full)
+			print("STORING SAMPLES AS", self.storage_dtype, self.data_full.nbytes / 1e6, "MB")
+
 		#Setup subsetting
 		self.next_subset()
  
@@ -385,6 +603,21 @@ class DBNDataset(torch.utils.data.Dataset):
 		self.train_indices = train_inds_by_value
 
 
+	def __select_coreset__(self):
+		"""
+		Internal function to select a representative, diversity-preserving training subset of subset_training samples (see coreset.select_subset),
+		and report how well it covers the feature space of the full data (which reads the probed and selected samples once more).
+		"""
+		inds, weights = select_subset(self.data_full, self.subset_training, self.subset_method)
+		self.coverage_report = coverage(self.data_full, inds)
+		self.coverage_report["method"] = self.subset_method
+		print("SUBSET COVERAGE", self.coverage_report)
+		self.data_full = self.data_full[inds]
+		self.targets_full = self.targets_full[inds]
+		if self.subset_weighted:
+			self.counts_full = weights
+
+
 	def __set_subset__(self,increment):
 		"""
 		Internal function to set the current subset of data. Use next_subset and previous_subset to interface externally.
@@ -410,19 +643,132 @@ class DBNDataset(torch.utils.data.Dataset):
 			self.targets = torch.from_numpy(self.targets_full[self.subset_inds[0]:self.subset_inds[1],:])		
 		else:
 			self.data = self.data_full[self.subset_inds[0]:self.subset_inds[1],:]
-			self.targets = self.targets_full[self.subset_inds[0]:self.subset_inds[1],:]	
+			self.targets = self.targets_full[self.subset_inds[0]:self.subset_inds[1],:]
+
+		#Multiplicity counts of deduplicated samples (see deduplicate)
+		self.sample_weights = None
+		if getattr(self, "counts_full", None) is not None:
+			self.sample_weights = self.counts_full[self.subset_inds[0]:self.subset_inds[1]]
+
+
+	def __balance_shards__(self):
+		"""
+		Internal function to pad every rank's shard (by wrapping around its own samples) to the length of the largest shard,
+		as DistributedSampler does, so every rank runs the same number of batches.
+		"""
+		n_local = self.data_full.shape[0]
+		n_max = torch.tensor([n_local], dtype=torch.int64, device=collective_device())
+		all_reduce(n_max, op=dist.ReduceOp.MAX)
+		n_max = int(n_max.item())
+		if n_local == 0:
+			raise ValueError("Rank " + str(get_rank()) + " received no valid samples to train on")
+		if n_max > n_local:
+			pad = np.arange(n_max - n_local) % n_local
+			self.data_full = np.concatenate((self.data_full, self.data_full[pad]))
+			self.targets_full = np.concatenate((self.targets_full, self.targets_full[pad]))
+			if getattr(self, "counts_full", None) is not None:
+				self.counts_full = np.concatenate((self.counts_full, self.counts_full[pad]))
+		print("SHARD", get_rank(), n_local, "SAMPLES, PADDED TO", n_max)
+
+
+	def deduplicate(self, tolerance = 0.0, chunk_size = 1000000):
+		"""
+		Collapses repeated samples in data_full (e.g. from large homogeneous regions) into unique samples with multiplicity counts
+		(or, if samples already carry weights, the sum of their weights).
+		The first occurrence of each sample is kept, in its original (shuffled) order, along with its index. The counts are exposed
+		as sample_weights, which makes dist_utils.get_sampler draw with probability proportional to them, so the training distribution is
+		unchanged while each epoch only draws as many samples as there are unique ones. Should be called after any held-out samples have been split off.
+
+		:param tolerance: Optional grid width for near-duplicate collapse. Samples whose (scaled) features fall into the same grid cell of this width are considered duplicates. If 0, only exact duplicates (identical stored values) are collapsed. Default is 0.
+		:param chunk_size: Amount of samples quantized at a time when tolerance is set.
+
+		:return: Dictionary with the amount of samples before and after collapse, the reduction ratio, and the expected per-epoch training speedup.
+		"""
+		data = self.data_full
+		if torch.is_tensor(data):
+			data = data.numpy()
+		n_samples = data.shape[0]
+		if tolerance is None or tolerance <= 0.0:
+			keys = np.ascontiguousarray(data.reshape(n_samples, -1))
+		else:
+			keys = np.empty((n_samples, int(np.prod(data.shape[1:]))), dtype=np.int32)
+			for i in range(0, n_samples, chunk_size):
+				chunk = self.decode(data[i:i+chunk_size])
+				if torch.is_tensor(chunk):
+					chunk = chunk.numpy()
+				chunk = np.floor(np.asarray(chunk, dtype=np.float64).reshape(chunk.shape[0], -1) / tolerance)
+				if np.abs(chunk).max() >= np.iinfo(np.int32).max:
+					raise ValueError("Deduplication tolerance " + str(tolerance) + " is too small for the range of the data")
+				keys[i:i+chunk_size] = chunk
+		#Each sample's bytes as a single opaque value, so samples can be sorted and compared as a whole
+		keys = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+		_, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+		del keys
+		#Samples that already carry weights (e.g. coreset weights) pass them on to their unique sample
+		if getattr(self, "counts_full", None) is not None:
+			counts = np.bincount(inverse.ravel(), weights=self.counts_full, minlength=first.shape[0])
+		order = np.argsort(first)
+		first = first[order]
+
+		self.data_full = data[first]
+		self.targets_full = np.asarray(self.targets_full)[first]
+		self.counts_full = counts[order]
+		#Sharded ranks draw from their own shard - every rank draws as many samples as the largest deduplicated shard
+		self.epoch_size = None
+		if getattr(self, "sharded", False):
+			n_max = torch.tensor([first.shape[0]], dtype=torch.int64, device=collective_device())
+			all_reduce(n_max, op=dist.ReduceOp.MAX)
+			self.epoch_size = int(n_max.item())
+		self.current_subset = -1
+		self.next_subset()
 
+		stats = {"n_samples": int(n_samples), "n_unique": int(first.shape[0]), "tolerance": float(tolerance or 0.0),
+			"reduction_ratio": float(first.shape[0]) / max(n_samples, 1), "epoch_speedup": float(n_samples) / max(first.shape[0], 1)}
+		print("DEDUPLICATED", stats["n_samples"], "SAMPLES TO", stats["n_unique"], "UNIQUE (%.1fx fewer samples per epoch)" % stats["epoch_speedup"])
+		return stats
 
-	def __train_scaler__(self, data):
+
+	def __row_block__(self, n_rows):
+		"""
+		Internal function to assign this rank its block of rows of a scene, when there are fewer files than ranks.
+
+		:param n_rows: Number of rows in the scene.
+
+		:return: First and last (exclusive) rows to preprocess, and first and last (exclusive) rows this rank owns. Rows are split into contiguous, disjoint blocks, one per rank; the rows to preprocess add pixel_padding rows of context on either side.
+		"""
+		bounds = np.linspace(0, n_rows, get_world_size() + 1).astype(np.int64)
+		own_start = int(bounds[get_rank()])
+		own_end = int(bounds[get_rank() + 1])
+		return max(own_start - self.pixel_padding, 0), min(own_end + self.pixel_padding, n_rows), own_start, own_end
+
+	def __train_scaler__(self, data, masks):
 		"""
 		Internal function to train scaler.
 	
 		:param data: Data to use to train scaler. partial_fit function used so this process can be done multiple separate times.
+		:param masks: Per-pixel validity masks of data. Only pixels valid in every channel are used.
 		"""
 		for r in range(len(data)):
-			subd = data[r]
-			shape = subd.shape
-			self.scaler.partial_fit(subd[np.where(subd > -9999)].reshape(-1, shape[self.chan_dim]))
+			self.scaler.partial_fit(data[r][masks[r]])
+
+	def get_codec(self):
+		"""
+		:return: SampleCodec samples are stored with, or None if they are stored as float32.
+		"""
+		return getattr(self, "codec", None)
+
+	def decode(self, samples):
+		"""
+		Upcasts stored samples (e.g. a slice of data_full) to float32. No-op if samples are stored as float32.
+
+		:param samples: Stored samples.
+
+		:return: float32 samples, as a tensor if samples were decoded.
+		"""
+		codec = self.get_codec()
+		if codec is None:
+			return samples
+		return codec.decode(samples)
 
 	def __len__(self):
 		"""
@@ -436,14 +782,19 @@ class DBNDataset(torch.utils.data.Dataset):
 		"""
 		Overriding of Dataset internal function __getitem__.
 	
-		:param index: Index of sample to be returned.
+		:param index: Index of sample to be returned, or list of indices when whole batches are fetched at once (see dist_utils.batch_loader).
 
-		:return: Sample and associated index.
+		:return: Sample and associated index, or batch of samples and associated indices.
 		"""
 		if torch.is_tensor(index):
 			index = index.tolist()
+		#Contiguous batches (e.g. unshuffled output generation) are sliced rather than gathered
+		if isinstance(index, list) and len(index) > 1:
+			inds = np.asarray(index)
+			if np.all(np.diff(inds) == 1):
+				index = slice(int(inds[0]), int(inds[-1]) + 1)
 
-		sample = self.data[index]
+		sample = self.decode(self.data[index])
 		#if self.transform:
 		#	sample = self.transform(sample)
 
@@ -454,6 +805,50 @@ class DBNDataset(torch.utils.data.Dataset):
 
 
 
+def get_codec_filename(data_filename):
+	"""
+	:param data_filename: Path to preprocessed samples (.npy).
+
+	:return: Path the SampleCodec of reduced-precision samples is stored at.
+	"""
+	return os.path.splitext(data_filename)[0] + ".codec.pkl"
+
+
+def get_weights_filename(data_filename):
+	"""
+	:param data_filename: Path to preprocessed samples (.npy).
+
+	:return: Path the per-sample weights of a weighted training subset are stored at.
+	"""
+	return os.path.splitext(data_filename)[0] + ".weights.npy"
+
+
+def get_shared_dir(conf, out_dir):
+	"""
+	Resolves the data/shared_memory configuration option.
+
+	:param conf: True (publish to a node-local directory under /dev/shm, unique to out_dir), a directory path, or False/None (disabled).
+	:param out_dir: Output directory of the run.
+
+	:return: Directory to publish training data to, or None if sharing is disabled.
+	"""
+	if conf is None or conf is False:
+		return None
+	if conf is True:
+		run_hash = hashlib.md5(os.path.abspath(out_dir).encode()).hexdigest()[:12]
+		return os.path.join("/dev/shm", "sit_fuse_" + run_hash)
+	return str(conf)
+
+
+def release_shared(path):
+	"""
+	Removes data published via DBNDataset.publish_shared. Processes that have already mapped it keep access until they release it.
+
+	:param path: Directory the Dataset was published to.
+	"""
+	shutil.rmtree(path, ignore_errors=True)
+
+
 def main(yml_fpath):
 	"""
 	Function used if code is called as executable. Generates data and indices in preprocessed format and 
@@ -512,6 +907,20 @@ def main(yml_fpath):
 	scaler, scaler_train = get_scaler(scaler_type, cuda = use_gpu_pre)
 
 	subset_training = yml_conf["dbn"]["subset_training"]
+
+	storage_dtype = "float32"
+	if "storage_dtype" in yml_conf["data"]:
+		storage_dtype = yml_conf["data"]["storage_dtype"]
+
+	subset_method = "random"
+	subset_weighted = False
+	if "subset_selection" in yml_conf["dbn"]:
+		subset_method = yml_conf["dbn"]["subset_selection"].get("method", "random")
+		subset_weighted = yml_conf["dbn"]["subset_selection"].get("weighted", False)
+
+	reducer = None
+	if "spectral_reduction" in yml_conf["data"]:
+		reducer = SpectralReducer.from_config(yml_conf["data"]["spectral_reduction"])
  
 	os.environ['PREPROCESS_GPU'] = str(int(use_gpu_pre))
 
@@ -530,7 +939,9 @@ def main(yml_fpath):
 	x2.read_and_preprocess_data(data_train, read_func, data_reader_kwargs, pixel_padding, delete_chans=delete_chans, \
 			valid_min=valid_min, valid_max=valid_max, fill_value =fill, chan_dim = chan_dim, transform_chans=transform_chans, \
 			transform_values=transform_values, scaler = scaler, train_scaler = scaler_train, scale = scale_data, \
-			transform=numpy_to_torch, subset=subset_count, subset_training = subset_training, stratify_data=stratify_data)
+			transform=numpy_to_torch, subset=subset_count, subset_training = subset_training, stratify_data=stratify_data, \
+			storage_dtype = storage_dtype, subset_method = subset_method, subset_weighted = subset_weighted, \
+			reducer = reducer, train_reducer = reducer is not None)
  
 	if x2.train_indices is not None:
 		np.save(os.path.join(out_dir, "train_indices"), x2.train_indices)
@@ -538,10 +949,23 @@ def main(yml_fpath):
 
 	np.save(os.path.join(out_dir, "train_data.indices"), x2.targets_full)
 	np.save(os.path.join(out_dir, "train_data"), x2.data_full) 
+	if x2.get_codec() is not None:
+		with open(get_codec_filename(os.path.join(out_dir, "train_data.npy")), "wb") as f:
+			dump(x2.get_codec(), f, True, pickle.HIGHEST_PROTOCOL)
+	if getattr(x2, "counts_full", None) is not None:
+		np.save(get_weights_filename(os.path.join(out_dir, "train_data.npy")), x2.counts_full)
+	if x2.coverage_report is not None:
+		with open(os.path.join(out_dir, "subset_coverage.json"), "w") as f:
+			json.dump(x2.coverage_report, f, indent=2)
  
 	#Save scaler
 	with open(os.path.join(out_dir, "dbn_scaler.pkl"), "wb") as f:
 		dump(x2.scaler, f, True, pickle.HIGHEST_PROTOCOL)
+	if x2.reducer is not None:
+		with open(os.path.join(out_dir, "dbn_reducer.pkl"), "wb") as f:
+			dump(x2.reducer, f, True, pickle.HIGHEST_PROTOCOL)
+		with open(os.path.join(out_dir, "spectral_reduction.json"), "w") as f:
+			json.dump(x2.reduction_report, f, indent=2)
 
 
 if __name__ == '__main__':
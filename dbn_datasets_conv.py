@@ -7,6 +7,7 @@ applicable U.S. export laws and regulations. User has the responsibility to obta
 required before exporting such information to foreign countries or providing access to foreign persons.
 """
 import os
+import json
 import numpy as np
 import random
 import copy
@@ -20,15 +21,63 @@ sys.setrecursionlimit(4500)
 #ML imports
 import torch
 from torchvision import transforms
-from dbn_datasets import DBNDataset
+from dbn_datasets import DBNDataset, get_codec_filename
+from sample_codec import SampleCodec
+from validity import validity_mask, pixel_mask, pack_mask, FILL
+from joblib import load, dump
+import pickle
 
 from utils import numpy_to_torch, read_yaml, get_read_func, get_scaler
+from dist_utils import get_rank, get_world_size, all_reduce, collective_device
 
 import argparse
 
 from skimage.util import view_as_windows
 from skimage.filters import sobel
 
+def read_scene(filename, read_func, read_func_kwargs, delete_chans, valid_min, valid_max, fill_value = -9999, chan_dim = 0, transform_chans = [], transform_values = []):
+	"""
+	Reads a single scene, as DBNDatasetConv does before tiling.
+
+	:param filename: Scene to read (path, or list of paths, as accepted by read_func).
+	:param read_func: Reader (see utils.get_read_func).
+	:param read_func_kwargs: Keyword arguments of read_func.
+
+	:return: Scene data (channels first, invalid values set to FILL) and its per-pixel validity mask.
+	"""
+	dat = read_func(filename, **read_func_kwargs).astype(np.float32)
+	for t in range(len(transform_chans)):
+		slc = [slice(None)] * dat.ndim
+		slc[chan_dim] = slice(transform_chans[t], transform_chans[t]+1)
+		tmp = dat[tuple(slc)]
+		if valid_min is not None:
+			inds = np.where(tmp < valid_min - 0.00000000005) 
+			tmp[inds] = transform_values[t]
+		if valid_max is not None:
+			inds = np.where(tmp > valid_max - 0.00000000005)
+			tmp[inds] = transform_values[t]
+
+	dat = np.delete(dat, delete_chans, chan_dim)
+
+	valid = validity_mask(dat, valid_min, valid_max, fill_value)
+	dat[~valid] = FILL
+	return np.moveaxis(dat, chan_dim, 0), pixel_mask(valid, chan_dim)
+
+
+def prepare_scene(dat, sobel_features = True):
+	"""
+	:param dat: Scene data, channels first, as returned by read_scene.
+	:param sobel_features: Whether or not to prepend sobel edges of every channel. If False, the model computes them (see rbm_models.fcn_dbn.SobelFeatures).
+
+	:return: Sobel edges of every channel (if sobel_features is set), followed by the channels themselves, with invalid values imputed.
+	"""
+	if sobel_features:
+		dat = np.concatenate((sobel(dat, axis=(1,2)), dat), axis=0)
+	#TODO - 0 imputation - fix with mean later
+	dat[np.where(dat <= -9999)] = 0.0
+	return dat
+
+
 class DBNDatasetConv(DBNDataset):
 
 	def __init__(self):
@@ -39,6 +88,10 @@ class DBNDatasetConv(DBNDataset):
 		self.data_full = np.load(data_filename)
 		self.targets_full = np.load(indices_filename)
 
+		self.codec = None
+		if os.path.exists(get_codec_filename(data_filename)):
+			self.codec = load(get_codec_filename(data_filename))
+
 		self.scale = False
 		self.scaler = None
 		self.train_indices = None
@@ -54,8 +107,10 @@ class DBNDatasetConv(DBNDataset):
 
 
 
-	def read_and_preprocess_data(self, filenames, read_func, read_func_kwargs, delete_chans, valid_min, valid_max, fill_value = -9999, chan_dim = 0, transform_chans = [], transform_values = [], transform=None, subset=None, tile = False, tile_size = None, tile_step = None, subset_training = -1):
+	def read_and_preprocess_data(self, filenames, read_func, read_func_kwargs, delete_chans, valid_min, valid_max, fill_value = -9999, chan_dim = 0, transform_chans = [], transform_values = [], transform=None, subset=None, tile = False, tile_size = None, tile_step = None, subset_training = -1, storage_dtype = "float32", sobel_features = True):
 		#Scaler info isnt used here, but keeping same interface as DBNDataset
+		#storage_dtype - see DBNDataset.read_and_preprocess_data. Offsets and scales of int16 storage are per channel.
+		#sobel_features - see prepare_scene. If False, samples hold half the channels.
 
                 #TODO Employ stratification
 		self.train_indices = None
@@ -81,6 +136,9 @@ class DBNDatasetConv(DBNDataset):
 			self.subset = 1		
 		self.current_subset = -1
 		self.subset_training = subset_training
+		self.storage_dtype = storage_dtype
+		self.sobel_features = sobel_features
+		self.codec = None
 	
 
 		self.__loaddata__()
@@ -88,34 +146,14 @@ class DBNDatasetConv(DBNDataset):
 	def __loaddata__(self):
 		
 		data_local = []
+		masks_local = []
 		for i in range(0, len(self.filenames)):
 			if (type(self.filenames[i]) == str and os.path.exists(self.filenames[i])) or (type(self.filenames[i]) is list and os.path.exists(self.filenames[i][0])):
 				print(self.filenames[i])
-				dat = self.read_func(self.filenames[i], **self.read_func_kwargs).astype(np.float32)
-				for t in range(len(self.transform_chans)):
-					slc = [slice(None)] * dat.ndim
-					slc[self.chan_dim] = slice(self.transform_chans[t], self.transform_chans[t]+1)
-					tmp = dat[tuple(slc)]
-					if self.valid_min is not None:
-						inds = np.where(tmp < self.valid_min - 0.00000000005) 
-						tmp[inds] = self.transform_value[t]
-					if self.valid_max is not None:
-						inds = np.where(tmp > self.valid_max - 0.00000000005)
-						tmp[inds] = self.transform_value[t]
-				if len(self.transform_chans) > 0:
-					del slc
-					del tmp
-										
-				dat = np.delete(dat, self.delete_chans, self.chan_dim)
-
-				if self.valid_min is not None:
-					dat[np.where(dat < self.valid_min - 0.00000000005)] = -9999
-				if self.valid_max is not None:	
-					dat[np.where(dat > self.valid_max - 0.00000000005)] = -9999
-				if self.fill_value is not None:
-					dat[np.where(dat == self.fill_value)] = -9999
-				dat = np.moveaxis(dat, self.chan_dim, 0)
+				dat, valid = read_scene(self.filenames[i], self.read_func, self.read_func_kwargs, self.delete_chans, self.valid_min, self.valid_max,
+					self.fill_value, self.chan_dim, self.transform_chans, self.transform_value)
 				data_local.append(dat)
+				masks_local.append(valid)
 
 		del dat 
 		dim1 = 1
@@ -125,6 +163,7 @@ class DBNDatasetConv(DBNDataset):
 
 		self.data = []
 		self.targets = []
+		self.valid_masks = [pack_mask(m) for m in masks_local]
 		if self.tile:
 			window_size = [0,0,0]
 			tile_step_final = [0,0,0]
@@ -132,17 +171,15 @@ class DBNDatasetConv(DBNDataset):
 			window_size[dim2] = self.tile_size[1]
 			tile_step_final[dim1] = self.tile_step[0]
 			tile_step_final[dim2] = self.tile_step[1]
-			tile_step_final[self.chan_dim] = data_local[0].shape[self.chan_dim]*2
-			window_size[self.chan_dim] = data_local[0].shape[self.chan_dim]*2
+			n_feat = 2 if self.sobel_features else 1
+			tile_step_final[self.chan_dim] = data_local[0].shape[self.chan_dim]*n_feat
+			window_size[self.chan_dim] = data_local[0].shape[self.chan_dim]*n_feat
 			window_size = tuple(window_size)
 		for r in range(len(data_local)):
 			count = 0
 			last_count = len(self.data)
 			sub_data_total = []
-			data_local[r] = np.concatenate((sobel(data_local[r], axis=(dim1,dim2)), data_local[r]), axis=self.chan_dim)
-			
-			#TODO - 0 imputation - fix with mean later
-			data_local[r][np.where(data_local[r] <= -9999)] = 0.0	
+			data_local[r] = prepare_scene(data_local[r], self.sobel_features)
 
 			pixel_padding = (window_size[dim1] - 1) //2
 
@@ -191,18 +228,16 @@ class DBNDatasetConv(DBNDataset):
 			if self.subset_training > 0:
 				self.data_full = self.data_full[:self.subset_training,:,:,:]
 				self.targets_full = self.data_full[:self.subset_training,:,:]
-			for chan in range(0,self.n_chans):
+			n_sobel = self.n_chans if self.sobel_features else 0
+			for chan in range(0,n_sobel):
 				mean_per_channel.append(0.0)
 				std_per_channel.append(1.0)
-			for chan in range(self.n_chans, self.data_full.shape[self.chan_dim]):
+			for chan in range(n_sobel, self.data_full.shape[self.chan_dim]):
 				#TODO slice to make more generic
+				#Invalid pixels were already imputed (set to 0) before tiling, so every value is used
 				subd = self.data_full[:,chan,:,:]
-				inds = np.where(subd <= -9999)
-				inds2 = np.where(subd > -9999)
-				mean_per_channel.append(np.squeeze(subd[inds2].mean()))
-				std_per_channel.append(np.squeeze(subd[inds2].std()))
-				subd[inds] = mean_per_channel[chan-self.n_chans]
-				self.data_full[:,chan,:,:] = subd
+				mean_per_channel.append(np.squeeze(subd.mean()))
+				std_per_channel.append(np.squeeze(subd.std()))
 
 			transform_norm = torch.nn.Sequential(
 				#transforms.ToTensor(),
@@ -213,6 +248,11 @@ class DBNDatasetConv(DBNDataset):
 
 		self.data_full = self.transform(self.data_full)
 
+		if self.storage_dtype != "float32":
+			self.codec = SampleCodec(self.storage_dtype)
+			self.data_full = self.codec.fit_encode(self.data_full)
+			self.targets_full = self.targets_full.numpy()
+
 
 		self.next_subset()
  
@@ -223,8 +263,214 @@ class DBNDatasetConv(DBNDataset):
 		pass
 
 
+class DBNDatasetConvCrops(torch.utils.data.IterableDataset):
+	"""
+	Fully convolutional training samples drawn on the fly. Instead of pre-tiling every scene in memory, each epoch draws random
+	tile positions from scenes read lazily, one at a time, by the DataLoader worker that owns them (scenes are partitioned
+	across ranks and workers). Tiles with more than max_fill invalid pixels are rejected. Crops go through a shuffle buffer,
+	so batches mix scenes. Offsets differ every epoch (see set_epoch).
+	"""
+
+	def __init__(self, filenames, read_func, read_func_kwargs, delete_chans, valid_min, valid_max, fill_value = -9999, chan_dim = 0, transform_chans = [], transform_values = [], transform = None, tile_size = None, samples_per_epoch = 100000, max_fill = 0.5, crops_per_scene = 64, shuffle_buffer = 256, max_tries = 20, seed = 0, sobel_features = True):
+		"""
+		:param filenames: Scenes to sample from. Arguments up to transform_values are as in DBNDatasetConv.read_and_preprocess_data.
+		:param transform: Normalization of the (sobel + raw) channels. If None, it is computed from every scene's valid pixels.
+		:param tile_size: Tile size ([rows, columns, ...]).
+		:param samples_per_epoch: Tiles drawn per epoch, across all ranks.
+		:param max_fill: Maximum fraction of invalid pixels in a tile.
+		:param crops_per_scene: Tiles drawn each time a scene is read. Higher values mean less I/O per tile, lower values more scene diversity.
+		:param shuffle_buffer: Amount of tiles buffered (per worker) to mix tiles of different scenes.
+		:param max_tries: Rounds of candidate positions drawn per scene visit before giving up on the remaining tiles.
+		:param seed: Random seed.
+		:param sobel_features: Whether or not tiles hold sobel edges (see prepare_scene).
+		"""
+		self.filenames = [f for f in filenames if (type(f) == str and os.path.exists(f)) or (type(f) is list and os.path.exists(f[0]))]
+		if len(self.filenames) == 0:
+			raise ValueError("No existing scenes to draw tiles from")
+		self.read_func = read_func
+		self.read_func_kwargs = read_func_kwargs
+		self.delete_chans = delete_chans
+		self.valid_min = valid_min
+		self.valid_max = valid_max
+		self.fill_value = fill_value
+		self.chan_dim = chan_dim
+		self.transform_chans = transform_chans
+		self.transform_value = transform_values
+		self.tile_size = tile_size
+		self.samples_per_epoch = samples_per_epoch
+		self.max_fill = max_fill
+		self.crops_per_scene = crops_per_scene
+		self.shuffle_buffer = shuffle_buffer
+		self.max_tries = max_tries
+		self.seed = seed
+		self.sobel_features = sobel_features
+		self.epoch = 0
+
+		#Same interface as DBNDatasetConv, where training loops use it
+		self.scaler = None
+		self.train_indices = None
+		self.sample_weights = None
+		self.codec = None
+		self.subset = 1
+
+		#Captured here, as DataLoader workers may not see the process group
+		self.rank = get_rank()
+		self.world_size = get_world_size()
+
+		self.transform = transform
+		if self.transform is None:
+			self.transform = self.__compute_transform__()
+		self.mean = np.asarray(self.transform[0].mean, dtype=np.float32)[:,None,None]
+		self.std = np.asarray(self.transform[0].std, dtype=np.float32)[:,None,None]
+
+	def __read__(self, s):
+		dat, valid = read_scene(self.filenames[s], self.read_func, self.read_func_kwargs, self.delete_chans, self.valid_min, self.valid_max,
+			self.fill_value, self.chan_dim, self.transform_chans, self.transform_value)
+		return prepare_scene(dat, self.sobel_features), valid
+
+	def __compute_transform__(self):
+		"""
+		Streaming per-channel statistics over every scene's pixels (imputed values included, as in DBNDatasetConv). Each rank reads
+		its share of the scenes, and the sums are combined across ranks. Sobel channels are left unnormalized.
+		"""
+		sums = None
+		for s in range(self.rank, len(self.filenames), self.world_size):
+			dat, _ = self.__read__(s)
+			dat = dat.reshape(dat.shape[0], -1).astype(np.float64)
+			stats = np.array([np.full(dat.shape[0], dat.shape[1], dtype=np.float64), dat.sum(axis=1), (dat ** 2).sum(axis=1)])
+			sums = stats if sums is None else sums + stats
+			del dat
+		n_chans = torch.tensor([0 if sums is None else sums.shape[1]], dtype=torch.int64, device=collective_device())
+		all_reduce(n_chans, op=torch.distributed.ReduceOp.MAX)
+		if sums is None:
+			sums = np.zeros((3, int(n_chans.item())))
+		sums = all_reduce(torch.from_numpy(sums).to(collective_device())).cpu().numpy()
+		mean = sums[1] / sums[0]
+		std = np.sqrt(np.maximum(sums[2] / sums[0] - mean ** 2, 0.0))
+		n_sobel = sums.shape[1] // 2 if self.sobel_features else 0
+		mean_per_channel = [0.0] * n_sobel + mean[n_sobel:].tolist()
+		std_per_channel = [1.0] * n_sobel + std[n_sobel:].tolist()
+		return torch.nn.Sequential(
+			transforms.Normalize(mean_per_channel, std_per_channel)
+		)
+
+	def set_epoch(self, epoch):
+		"""
+		:param epoch: Epoch tiles are about to be drawn for. Epochs without an explicit set_epoch advance it by one.
+		"""
+		self.epoch = epoch
+
+	def get_codec(self):
+		return None
+
+	def has_next_subset(self):
+		return False
+
+	def next_subset(self):
+		pass
 
-def main(yml_fpath):
+	def __len__(self):
+		"""
+		:return: Number of tiles this rank draws per epoch.
+		"""
+		return -(-self.samples_per_epoch // self.world_size)
+
+	def __crops__(self, dat, valid, n_crops, rng):
+		"""
+		Draws up to n_crops tiles with at most max_fill invalid pixels, using a summed-area table of the invalid pixels.
+
+		:return: Tiles and their (row, column) offsets.
+		"""
+		rows, cols = self.tile_size[0], self.tile_size[1]
+		if dat.shape[1] < rows or dat.shape[2] < cols:
+			return [], []
+		invalid = np.pad(np.cumsum(np.cumsum(~valid, axis=0, dtype=np.int64), axis=1), ((1,0),(1,0)))
+		max_invalid = self.max_fill * rows * cols
+		offsets = []
+		for _ in range(self.max_tries):
+			y = rng.integers(0, dat.shape[1] - rows + 1, 4 * n_crops)
+			x = rng.integers(0, dat.shape[2] - cols + 1, 4 * n_crops)
+			n_invalid = invalid[y + rows, x + cols] - invalid[y, x + cols] - invalid[y + rows, x] + invalid[y, x]
+			keep = n_invalid <= max_invalid
+			offsets.extend(zip(y[keep], x[keep]))
+			if len(offsets) >= n_crops:
+				break
+		offsets = offsets[:n_crops]
+		crops = [(dat[:, y:y+rows, x:x+cols] - self.mean) / self.std for y, x in offsets]
+		return crops, offsets
+
+	def __iter__(self):
+		worker = torch.utils.data.get_worker_info()
+		worker_id, n_workers, worker_seed = 0, 1, 0
+		if worker is not None:
+			worker_id, n_workers, worker_seed = worker.id, worker.num_workers, worker.seed % (2 ** 32)
+		n_shards = self.world_size * n_workers
+		shard = self.rank * n_workers + worker_id
+		if len(self.filenames) >= n_shards:
+			scenes = np.arange(shard, len(self.filenames), n_shards)
+		else:
+			scenes = np.array([shard % len(self.filenames)])
+		n_samples = len(self) // n_workers + int(worker_id < len(self) % n_workers)
+
+		#Worker seeds change every epoch (DataLoader draws a new base seed per iterator), so offsets change even without set_epoch
+		rng = np.random.default_rng([self.seed, self.epoch, shard, worker_seed])
+		self.epoch = self.epoch + 1
+
+		buffer = []
+		drawn = 0
+		while drawn < n_samples:
+			progress = False
+			for s in rng.permutation(scenes):
+				dat, valid = self.__read__(s)
+				crops, offsets = self.__crops__(dat, valid, min(self.crops_per_scene, n_samples - drawn), rng)
+				del dat, valid
+				for crop, (y, x) in zip(crops, offsets):
+					buffer.append((torch.from_numpy(crop.astype(np.float32)), torch.tensor([s, y, x], dtype=torch.int32)))
+					if len(buffer) > self.shuffle_buffer:
+						ind = rng.integers(len(buffer))
+						buffer[ind], buffer[-1] = buffer[-1], buffer[ind]
+						yield buffer.pop()
+				drawn = drawn + len(crops)
+				progress = progress or len(crops) > 0
+				if drawn >= n_samples:
+					break
+			if not progress:
+				raise ValueError("No tiles with at most " + str(self.max_fill) + " fill found in scenes " + str([self.filenames[s] for s in scenes]))
+		for ind in rng.permutation(len(buffer)):
+			yield buffer[ind]
+
+
+def check_sobel_layer(dat):
+	"""
+	Numerical equivalence of the sobel features rbm_models.fcn_dbn.SobelFeatures computes on the fly with the skimage
+	features prepare_scene stores.
+
+	:param dat: Scene data, channels first, as returned by read_scene.
+
+	:return: Dictionary with the maximum absolute and relative difference between the layer and skimage on the imputed scene,
+		and the fraction of pixels whose stored features differ anyway, as stored features are computed before fill values are imputed.
+	"""
+	#Imported here so preprocessing does not depend on the model code
+	from rbm_models.fcn_dbn import SobelFeatures
+
+	imputed = prepare_scene(dat.copy(), False)
+	reference = sobel(imputed, axis=(1,2))
+	stored = prepare_scene(dat.copy())[:dat.shape[0]]
+
+	flat = imputed.reshape(imputed.shape[0], -1).astype(np.float64)
+	mean = flat.mean(axis=1)
+	std = flat.std(axis=1)
+	std[std == 0] = 1.0
+	x = torch.from_numpy(((imputed - mean[:,None,None]) / std[:,None,None]).astype(np.float32))[None]
+	with torch.no_grad():
+		out = SobelFeatures(mean, std)(x)[0, :dat.shape[0]].numpy()
+
+	diff = np.abs(out - reference)
+	return {"max_abs_diff": float(diff.max()), "max_rel_diff": float(diff.max() / max(np.abs(reference).max(), np.finfo(np.float32).tiny)),
+		"fill_affected_fraction": float((~np.isclose(stored, reference, rtol=1e-4, atol=1e-4)).any(axis=0).mean())}
+
+
+def main(yml_fpath, check_sobel = False):
     #Translate config to dictionary 
     yml_conf = read_yaml(yml_fpath)
 
@@ -252,6 +498,14 @@ def main(yml_fpath):
     transform_chans = yml_conf["data"]["transform_default"]["chans"]
     transform_values =  yml_conf["data"]["transform_default"]["transform"]
 
+    if check_sobel:
+        read_func = get_read_func(data_reader)
+        for fname in data_train:
+            dat, _ = read_scene(fname, read_func, data_reader_kwargs, delete_chans, valid_min, valid_max, fill, chan_dim,
+                transform_chans, transform_values)
+            print(fname, json.dumps(check_sobel_layer(dat)))
+        return
+
     out_dir = yml_conf["output"]["out_dir"]
     os.makedirs(out_dir, exist_ok=True)
 
@@ -261,6 +515,14 @@ def main(yml_fpath):
 
     subset_training = yml_conf["dbn"]["subset_training"]
 
+    storage_dtype = "float32"
+    if "storage_dtype" in yml_conf["data"]:
+        storage_dtype = yml_conf["data"]["storage_dtype"]
+
+    sobel_features = True
+    if "sobel_layer" in yml_conf["data"]:
+        sobel_features = not yml_conf["data"]["sobel_layer"]
+
     os.environ['PREPROCESS_GPU'] = str(int(use_gpu_pre))
 
     read_func = get_read_func(data_reader)
@@ -277,7 +539,7 @@ def main(yml_fpath):
     x2.read_and_preprocess_data(data_train, read_func, data_reader_kwargs, delete_chans=delete_chans, \
             valid_min=valid_min, valid_max=valid_max, fill_value =fill, chan_dim = chan_dim, transform_chans=transform_chans, \
             transform_values=transform_values, transform=None, subset=subset_count, tile=tile, tile_size=tile_size, tile_step=tile_step,
-            subset_training = subset_training)
+            subset_training = subset_training, storage_dtype = storage_dtype, sobel_features = sobel_features)
 
     if x2.train_indices is not None:
         np.save(os.path.join(out_dir, "train_indices"), x2.train_indices)
@@ -287,6 +549,9 @@ def main(yml_fpath):
     np.save(os.path.join(out_dir, "train_data"), x2.data_full)
 
     torch.save(x2.transform.state_dict(), os.path.join(out_dir, "dbn_data_transform.ckpt"))
+    if x2.get_codec() is not None:
+        with open(get_codec_filename(os.path.join(out_dir, "train_data.npy")), "wb") as f:
+            dump(x2.get_codec(), f, True, pickle.HIGHEST_PROTOCOL)
 
 
 
@@ -294,10 +559,11 @@ if __name__ == '__main__':
 
         parser = argparse.ArgumentParser()
         parser.add_argument("-y", "--yaml", help="YAML file for data config.")
+        parser.add_argument("-c", "--check-sobel", action="store_true", help="Compare sobel features computed by the model (data/sobel_layer) with stored ones, for every training scene, instead of preprocessing.")
         args = parser.parse_args()
         from timeit import default_timer as timer
         start = timer()
-        main(args.yaml)
+        main(args.yaml, args.check_sobel)
         end = timer()
         print(end - start) # Time in seconds, e.g. 5.38091952400282
 
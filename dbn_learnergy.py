@@ -6,10 +6,16 @@ This software may be subject to U.S. export control laws. By accepting this soft
 applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be 
 required before exporting such information to foreign countries or providing access to foreign persons.
 """
-from GPUtil import showUtilization as gpu_usage
+try:
+    from GPUtil import showUtilization as gpu_usage
+except ImportError:
+    #CPU-only environments - nothing to report
+    def gpu_usage():
+        pass
 
 #General Imports
 import os
+import atexit
 import numpy as np
 import random
 
@@ -40,6 +46,12 @@ from torch.utils.data.distributed import DistributedSampler
 
 #from rbm_models.fcn_dbn import DBNUnet
 from rbm_models.clust_dbn import ClustDBN
+from rbm_models.convergence import ConvergenceMonitor, split_holdout, holdout_layer_input, holdout_reconstruction_mse, mark_stop
+from rbm_models.activation_cache import materialize, get_cache_dir
+from rbm_models.fused_cd import fit_fused, fused_activation
+from rbm_models.quantize import quantized_output_model
+from rbm_models.scene_inference import SceneInference, check_parity
+from rbm_models.tiled_inference import TiledInference
 #from rbm_models.clust_dbn_2d import ClustDBN2D
 #Visualization
 import learnergy.visual.convergence as converge
@@ -52,10 +64,17 @@ from joblib import dump, load
 
 #Data
 #from dbn_datasets_cupy import DBNDataset
-from dbn_datasets import DBNDataset
-from dbn_datasets_conv import DBNDatasetConv 
+from dbn_datasets import DBNDataset, get_shared_dir, release_shared
+from validity import save_mask, get_mask_filename, unpack_mask, pack_mask
+from spectral_reduction import SpectralReducer
+from telemetry import configure_telemetry, get_telemetry
+from output_store import get_output_writer, save_indices, save_array
+from raster_output import RasterWriter, raster_shape
+from dbn_datasets_conv import DBNDatasetConv, DBNDatasetConvCrops, read_scene
 #from utils_cupy import numpy_to_torch, read_yaml, get_read_func, get_scaler
 from utils import numpy_to_torch, read_yaml, get_read_func, get_scaler
+from dist_utils import setup_backend, cleanup_backend, is_distributed, barrier, get_local_rank, get_device, \
+    wrap_ddp, unwrap, get_loader, load_state_dict, get_rank, get_world_size, batch_loader
 
 #Input Parsing
 import yaml
@@ -64,29 +83,299 @@ from datetime import timedelta
 
 #Serialization
 import pickle
+import json
+import csv
+import copy
+from timeit import default_timer as timer
 
 SEED = 42
 
 torch.backends.cudnn.benchmark = True
 torch.backends.cudnn.enabled = True
 
-def setup_ddp(device_ids, use_gpu=True):
+def setup_ddp(device_ids, use_gpu=True, backend="auto"):
     #os.environ['MASTER_ADDR'] = 'localhost'
     #os.environ['MASTER_PORT'] = port
-    os.environ['CUDA_VISIBLE_DEVICES'] = ",".join(device_ids)
     #os.environ['NCCL_SOCKET_IFNAME'] = "lo"
 
-    print("HERE CUDA_VISIBLE_DEVICES", os.environ['CUDA_VISIBLE_DEVICES'])
-
-    driver = "nccl"
-    if not use_gpu or not torch.cuda.is_available():
-        driver = "gloo"
-
-    # initialize the process group
-    dist.init_process_group(driver, timeout=timedelta(seconds=5400))
+    # initialize the process group (no-op for single-process runs)
+    backend = setup_backend(device_ids, use_gpu, backend)
+    print("EXECUTION BACKEND", backend)
+    return backend
 
 def cleanup_ddp():
-    dist.destroy_process_group()
+    cleanup_backend()
+
+
+def fit_dbn_layerwise(dbn, dataset, batch_size, epochs, early_stopping = None, holdout = None, cache_dir = None,
+    num_loader_workers = 0, pin_memory = False, fused_cd = False):
+    """
+    Greedy layer-wise training of a learnergy DBN.
+
+    With early_stopping set, each layer is trained one epoch at a time and stopped once its training (or, if holdout is
+    set, held-out) reconstruction MSE has converged.
+
+    With cache_dir set, the frozen lower layers are not re-run on every batch: once a layer is trained, the activations
+    of the whole training set are written to a memmapped store under cache_dir, and the next layer is trained from it.
+    Each store is deleted as soon as the layer above it has been trained.
+
+    :param dbn: DBN to train. Layers may be wrapped in DDP.
+    :param dataset: Training dataset.
+    :param batch_size: Amount of samples per batch.
+    :param epochs: Maximum number of epochs per layer.
+    :param early_stopping: Optional early stopping configuration (patience, rel_tol, min_epochs).
+    :param holdout: Optional TensorDataset of held-out samples used for the convergence check.
+    :param cache_dir: Optional directory for per-layer activation stores.
+    :param num_loader_workers: Number of workers to be used for DataLoader.
+    :param pin_memory: Whether or not to use pinned memory with the DataLoader.
+    :param fused_cd: Whether or not to train Gaussian-ReLU/SeLU layers with the fused CD-k kernel (see rbm_models.fused_cd). Other layers use their own fit.
+
+    :return: Per-layer MSE, per-layer log-PL, and dictionary of layer index -> epoch training stopped at (early stopped layers only).
+    """
+    mse = []
+    pl = []
+    stopped_epochs = {}
+    store = None
+    layer_input = dataset
+    for i in range(len(dbn.models)):
+        model = unwrap(dbn.models[i])
+        lower_layers = list(dbn.models[:i])
+        mods = lower_layers
+        if len(lower_layers) == 0 or cache_dir is not None:
+            mods = None
+
+        if cache_dir is not None and i > 0:
+            prev_store = store
+            store = materialize([dbn.models[i-1]], layer_input, os.path.join(cache_dir, "layer_" + str(i)),
+                batch_size, model.torch_device)
+            if prev_store is not None:
+                prev_store.delete()
+            layer_input = store
+
+        loader, sampler = get_loader(layer_input, batch_size, num_workers = num_loader_workers, pin_memory = pin_memory)
+
+        holdout_input = None
+        if holdout is not None:
+            holdout_input = holdout_layer_input(lower_layers, holdout, model.torch_device)
+
+        fused = fused_cd and fused_activation(model) is not None
+        if fused_cd and not fused:
+            print("WARNING: fused CD-k does not support", type(model).__name__, "(or batch_normalize) - layer", i, "uses its own fit")
+
+        monitor = ConvergenceMonitor.from_config(early_stopping)
+        model_mse = 0
+        model_pl = 0
+        if monitor is None:
+            if fused:
+                ret = fit_fused(model, loader, sampler, epochs[i], mods)
+            else:
+                ret = model.fit(layer_input, batch_size, epochs[i], loader, sampler, mods)
+            if isinstance(ret, tuple):
+                model_mse, model_pl = ret
+            else:
+                model_mse = ret
+        else:
+            offset = len(model._history.get("mse", []))
+            for ep in range(epochs[i]):
+                sampler.set_epoch(ep)
+                if fused:
+                    ret = fit_fused(model, loader, sampler, 1, mods)
+                else:
+                    ret = model.fit(layer_input, batch_size, 1, loader, sampler, mods)
+                if isinstance(ret, tuple):
+                    model_mse, model_pl = ret
+                else:
+                    model_mse = ret
+                value = model._history["mse"][-1]
+                if holdout_input is not None:
+                    value = holdout_reconstruction_mse(model, holdout_input)
+                    print("LAYER", i, "HELD-OUT MSE", value)
+                if monitor.update(value):
+                    break
+            if monitor.stopped_epoch is not None:
+                stopped_epochs[i] = offset + monitor.stopped_epoch
+        mse.append(model_mse)
+        pl.append(model_pl)
+        del holdout_input
+        torch.cuda.empty_cache()
+    if store is not None:
+        store.delete()
+    return mse, pl, stopped_epochs
+
+
+def raster_options(raster, geo_key, index):
+    """
+    :param raster: output/raster configuration, or None.
+    :param geo_key: Configuration key of the reference GeoTIFFs of the files (geo_files_test or geo_files_train).
+    :param index: Index of the file.
+
+    :return: Raster options of the file for generate_output, or None if rasters are not written.
+    """
+    if raster is None:
+        return None
+    geo = raster.get(geo_key)
+    return {"format": raster.get("format", "tif"), "geo_reference": geo[index] if geo is not None else None}
+
+
+def sweep_subdir(out_dir, k):
+    """
+    :param out_dir: Output directory of the run.
+    :param k: Number of clusters.
+
+    :return: Directory holding the clustering head (and outputs) trained for k clusters in a sweep.
+    """
+    return os.path.join(out_dir, "k_" + str(k))
+
+
+def cluster_occupancy(clust_dbn, embeddings, n_classes, batch_size):
+    """
+    Assigns every (embedded) training sample to its most likely cluster and summarizes how evenly the clusters are used.
+
+    :param clust_dbn: Trained ClustDBN.
+    :param embeddings: Unscaled trunk outputs for the training set (array or memmap).
+    :param n_classes: Number of clusters of the head.
+    :param batch_size: Amount of samples per batch.
+
+    :return: Dictionary with the number of occupied clusters, min/max cluster fraction, and normalized assignment entropy.
+    """
+    counts = np.zeros(n_classes, dtype=np.int64)
+    device = clust_dbn.dbn_trunk.torch_device
+    with torch.no_grad():
+        for i in range(0, embeddings.shape[0], batch_size):
+            y = torch.as_tensor(np.array(embeddings[i:i+batch_size]))
+            y = torch.as_tensor(clust_dbn.scaler.transform(y), dtype=torch.float32).to(device, non_blocking = True)
+            probs = unwrap(clust_dbn.fc)(y)[0]
+            counts = counts + np.bincount(torch.argmax(probs, dim=1).cpu().numpy(), minlength=n_classes)
+    frac = counts / max(1, counts.sum())
+    nonzero = frac[frac > 0]
+    entropy = 0.0
+    if n_classes > 1:
+        entropy = float(-np.sum(nonzero * np.log(nonzero)) / np.log(n_classes))
+    return {"occupied_clusters": int(np.count_nonzero(counts)), "min_cluster_fraction": float(frac.min()),
+        "max_cluster_fraction": float(frac.max()), "assignment_entropy": entropy}
+
+
+def run_cluster_sweep(dbn, x2, ks, input_fc, out_dir, model_fname, use_gpu, cluster_batch_size, cluster_epochs,
+    cluster_gauss_noise_stdev, cluster_lambda, early_stopping = None, num_loader_workers = 0, pin_memory = False):
+    """
+    Train once, fit many: embeds the training set with the (already trained, frozen) DBN trunk a single time and fits
+    one deep clustering head per requested cluster count on the cached embeddings. Heads are independent, so cluster
+    counts are divided among ranks rather than training each head with DDP.
+
+    Every head, its scaler and its training statistics are written to out_dir/k_<k>/, in the same layout as a
+    single-k run, and a summary of all heads is written to out_dir/cluster_sweep_summary.csv.
+
+    :param dbn: Trained DBN trunk.
+    :param x2: Training dataset.
+    :param ks: List of cluster counts to fit heads for.
+    :param input_fc: Size of the trunk output.
+    :param out_dir: Output directory of the run.
+    :param model_fname: Model file name (without extension).
+    :param use_gpu: Whether or not GPUs are to be used.
+    :param cluster_batch_size: Amount of samples per batch for clustering head training.
+    :param cluster_epochs: Maximum number of epochs per head.
+    :param cluster_gauss_noise_stdev: Standard deviations of the noise used to generate paired views.
+    :param cluster_lambda: Entropy weighting of the IID loss.
+    :param early_stopping: Optional early stopping configuration. Applied to each head independently.
+    :param num_loader_workers: Number of workers to be used for DataLoader.
+    :param pin_memory: Whether or not to use pinned memory with the DataLoader.
+
+    :return: Dictionary of k -> trained ClustDBN (rank 0 returns all heads, other ranks only their own).
+    """
+    rank = get_rank()
+    emb_fname = os.path.join(out_dir, "sweep_embeddings.npy")
+    scaler_fname = os.path.join(out_dir, "fc_clust_scaler.pkl")
+    device = get_device(use_gpu)
+    dbn.eval()
+
+    #Embed training set once, shared by all heads and ranks
+    if rank == 0:
+        base = ClustDBN(dbn, input_fc, ks[0], use_gpu)
+        n_samples = x2.data_full.shape[0]
+        embeddings = None
+        for i in tqdm(range(0, n_samples, cluster_batch_size)):
+            x_batch = torch.as_tensor(x2.decode(x2.data_full[i:i+cluster_batch_size])).to(device, non_blocking = True)
+            y = torch.flatten(base.embed(x_batch), start_dim = 1).detach().cpu().numpy()
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(emb_fname, mode="w+", dtype=np.float32, shape=(n_samples, y.shape[1]))
+            embeddings[i:i+y.shape[0]] = y
+        embeddings.flush()
+        del embeddings
+
+        #One scaler for all heads
+        for i in range(0, n_samples, cluster_batch_size):
+            base.scaler.partial_fit(torch.as_tensor(np.load(emb_fname, mmap_mode="r")[i:i+cluster_batch_size]))
+        with open(scaler_fname, "wb") as f:
+            dump(base.scaler, f, True, pickle.HIGHEST_PROTOCOL)
+        del base
+    barrier()
+
+    #Embeddings stay on disk - the tensor shares memory with the memmap (as in ActivationStore), so batches page in only
+    #the rows they fetch. The memmap is opened r+ only because torch.from_numpy needs a writable array, nothing writes to it.
+    embeddings = np.load(emb_fname, mmap_mode="r+")
+    with open(scaler_fname, "rb") as f:
+        clust_scaler = load(f)
+    emb_dataset = TensorDataset(torch.from_numpy(embeddings), torch.as_tensor(np.array(x2.targets_full)))
+    emb_dataset.sample_weights = getattr(x2, "counts_full", None)
+
+    heads = {}
+    for k in ks[rank::get_world_size()]:
+        k_dir = sweep_subdir(out_dir, k)
+        os.makedirs(k_dir, exist_ok=True)
+        print("FITTING CLUSTERING HEAD, K =", k)
+
+        clust_dbn = ClustDBN(dbn, input_fc, k, use_gpu, copy.deepcopy(clust_scaler))
+        loader, sampler = get_loader(emb_dataset, cluster_batch_size, num_workers = num_loader_workers,
+            pin_memory = pin_memory, partition = False)
+        start = timer()
+        stopped_epoch = clust_dbn.fit(emb_dataset, cluster_batch_size, cluster_epochs, loader, sampler,
+            cluster_gauss_noise_stdev, cluster_lambda, ConvergenceMonitor.from_config(early_stopping, synchronize = False),
+            None, embedded = True, synchronize = False)
+        train_time = timer() - start
+        clust_dbn.eval()
+        clust_dbn.fc.eval()
+
+        losses = clust_dbn.history.get("loss", [])
+        stats = {"k": k, "final_loss": float(losses[-1]) if len(losses) > 0 else None,
+            "best_loss": float(min(losses)) if len(losses) > 0 else None, "epochs": len(losses),
+            "stopped_epoch": stopped_epoch, "train_time": train_time}
+        stats.update(cluster_occupancy(clust_dbn, embeddings, k, cluster_batch_size))
+
+        torch.save(clust_dbn.fc.state_dict(), os.path.join(k_dir, model_fname + "_fc_clust.ckpt"))
+        with open(os.path.join(k_dir, "fc_clust_scaler.pkl"), "wb") as f:
+            dump(clust_dbn.scaler, f, True, pickle.HIGHEST_PROTOCOL)
+        trunk_link = os.path.join(k_dir, model_fname + ".ckpt")
+        if not os.path.lexists(trunk_link):
+            os.symlink(os.path.join("..", model_fname + ".ckpt"), trunk_link)
+        with open(os.path.join(k_dir, "sweep_stats.json"), "w") as f:
+            json.dump(stats, f, indent=4)
+
+        if len(losses) > 0:
+            converge.plot(losses, labels=['IID loss'], title='convergence', subtitle='Model: Deep Clustering Head, k = ' + str(k))
+            mark_stop(plt, stopped_epoch)
+            plt.savefig(os.path.join(k_dir, "clust_loss_plot.png"))
+            plt.clf()
+        heads[k] = clust_dbn
+    barrier()
+
+    if rank == 0:
+        rows = []
+        for k in ks:
+            k_dir = sweep_subdir(out_dir, k)
+            with open(os.path.join(k_dir, "sweep_stats.json"), "r") as f:
+                rows.append(json.load(f))
+            if k not in heads:
+                clust_dbn = ClustDBN(dbn, input_fc, k, use_gpu, copy.deepcopy(clust_scaler))
+                load_state_dict(clust_dbn.fc, torch.load(os.path.join(k_dir, model_fname + "_fc_clust.ckpt"), map_location=device))
+                clust_dbn.eval()
+                clust_dbn.fc.eval()
+                heads[k] = clust_dbn
+        with open(os.path.join(out_dir, "cluster_sweep_summary.csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+        print("WROTE", os.path.join(out_dir, "cluster_sweep_summary.csv"))
+    return heads
 
 
 def run_dbn(yml_conf):
@@ -122,6 +411,45 @@ def run_dbn(yml_conf):
     training_mse = yml_conf["output"]["training_mse"]
     testing_output = yml_conf["output"]["testing_output"]
     testing_mse = yml_conf["output"]["testing_mse"]
+    #Per-phase telemetry is always written (out_dir/telemetry.jsonl). Profiler traces of each phase are opt in.
+    profile = None
+    if "profile" in yml_conf["output"]:
+        profile = yml_conf["output"]["profile"]
+    #Optional - also write the preprocessed input of each output file (<output>.input)
+    write_input = False
+    if "write_input" in yml_conf["output"]:
+        write_input = yml_conf["output"]["write_input"]
+    #Optional - write argmax labels (uint8 / uint16), with top-k float16 scores and / or a confidence plane, rather than every class score
+    compact = None
+    if "compact" in yml_conf["output"] and yml_conf["output"]["compact"] not in [None, False]:
+        compact = {}
+        if isinstance(yml_conf["output"]["compact"], dict):
+            compact = yml_conf["output"]["compact"]
+    #Optional - scatter labels straight into a (georeferenced) raster per file, instead of writing per-sample outputs
+    raster = None
+    if "raster" in yml_conf["output"] and yml_conf["output"]["raster"] not in [None, False]:
+        raster = {}
+        if isinstance(yml_conf["output"]["raster"], dict):
+            raster = yml_conf["output"]["raster"]
+    #Optional (CPU only) - generate outputs with an int8 quantized copy of the model, if it agrees with the fp32 model
+    quantize = None
+    if "quantize" in yml_conf["output"] and yml_conf["output"]["quantize"] not in [None, False]:
+        quantize = {}
+        if isinstance(yml_conf["output"]["quantize"], dict):
+            quantize = yml_conf["output"]["quantize"]
+    #Optional - run the model over whole (tiled) scenes, with its first layer as a convolution, instead of over
+    #per-pixel neighborhood samples
+    scene_inference = None
+    if "scene_inference" in yml_conf["output"] and yml_conf["output"]["scene_inference"] not in [None, False]:
+        scene_inference = {}
+        if isinstance(yml_conf["output"]["scene_inference"], dict):
+            scene_inference = yml_conf["output"]["scene_inference"]
+    #Optional (fully convolutional models) - run the model over whole scenes with overlapping, blended tiles, straight into a raster
+    tiled_inference = None
+    if "tiled_inference" in yml_conf["output"] and yml_conf["output"]["tiled_inference"] not in [None, False]:
+        tiled_inference = {}
+        if isinstance(yml_conf["output"]["tiled_inference"], dict):
+            tiled_inference = yml_conf["output"]["tiled_inference"]
 
     overwrite_model = yml_conf["dbn"]["overwrite_model"] 
     tune_scaler = yml_conf["dbn"]["tune_scaler"]
@@ -129,6 +457,9 @@ def run_dbn(yml_conf):
     tune_clust = yml_conf["dbn"]["tune_clust"]
     use_gpu_pre = yml_conf["dbn"]["training"]["use_gpu_preprocessing"]
     device_ids = yml_conf["dbn"]["training"]["device_ids"] 
+    backend = "auto"
+    if "backend" in yml_conf["dbn"]["training"]:
+        backend = yml_conf["dbn"]["training"]["backend"]
 
     temp = None
     nesterov_accel = None
@@ -141,6 +472,7 @@ def run_dbn(yml_conf):
     normalize_learnergy = None
     batch_normalize = None
     fcn = False
+    sobel_layer = False
     tile = False
     tile_size = None 
     tile_step = None
@@ -171,9 +503,19 @@ def run_dbn(yml_conf):
         tile_step = yml_conf["data"]["tile_step"]
         temp = tuple(yml_conf["dbn"]["params"]["temp"])
         fcn = True
+        if "sobel_layer" in yml_conf["data"]:
+            sobel_layer = yml_conf["data"]["sobel_layer"]
     else:
         temp = tuple(yml_conf["dbn"]["params"]["temp"])
     nesterov_accel = tuple(yml_conf["dbn"]["params"]["nesterov_accel"])
+    if raster is not None and fcn and tiled_inference is None:
+        raise ValueError("output/raster assembles per-pixel samples, so is only available for fully convolutional models with output/tiled_inference")
+    if tiled_inference is not None and not fcn:
+        raise ValueError("output/tiled_inference is only available for fully convolutional models - see output/scene_inference for per-pixel models")
+    if quantize is not None and fcn:
+        raise ValueError("output/quantize is not available for fully convolutional models")
+    if scene_inference is not None and (fcn or quantize is not None):
+        raise ValueError("output/scene_inference runs per-pixel fp32 models, so cannot be combined with fully convolutional models or output/quantize")
  
     auto_clust = yml_conf["dbn"]["deep_cluster"]
     use_gpu = yml_conf["dbn"]["training"]["use_gpu"]
@@ -189,6 +531,54 @@ def run_dbn(yml_conf):
     if "stratify_data" in yml_conf["dbn"]["training"]:
         stratify_data = yml_conf["dbn"]["training"]["stratify_data"]
 
+    cluster_sweep = None
+    if "deep_cluster_sweep" in yml_conf["dbn"] and yml_conf["dbn"]["deep_cluster_sweep"] is not None:
+        cluster_sweep = [int(k) for k in yml_conf["dbn"]["deep_cluster_sweep"]]
+
+    early_stopping = None
+    holdout_fraction = 0.0
+    if "early_stopping" in yml_conf["dbn"]["training"]:
+        early_stopping = yml_conf["dbn"]["training"]["early_stopping"]
+        holdout_fraction = float(early_stopping.get("holdout_fraction", 0.0))
+
+    shared_dir = None
+    if "shared_memory" in yml_conf["data"]:
+        shared_dir = get_shared_dir(yml_conf["data"]["shared_memory"], out_dir)
+
+    storage_dtype = "float32"
+    if "storage_dtype" in yml_conf["data"]:
+        storage_dtype = yml_conf["data"]["storage_dtype"]
+
+    shard_data = False
+    if "shard_preprocessing" in yml_conf["data"]:
+        shard_data = yml_conf["data"]["shard_preprocessing"] and not fcn
+    if shard_data and shared_dir is not None:
+        raise ValueError("data/shard_preprocessing and data/shared_memory are mutually exclusive")
+    if shard_data and cluster_sweep is not None:
+        raise ValueError("dbn/deep_cluster_sweep requires every rank to hold the full training set, so cannot be used with data/shard_preprocessing")
+
+    subset_method = "random"
+    subset_weighted = False
+    if "subset_selection" in yml_conf["dbn"]:
+        subset_method = yml_conf["dbn"]["subset_selection"].get("method", "random")
+        subset_weighted = yml_conf["dbn"]["subset_selection"].get("weighted", False)
+
+    dedup_tolerance = None
+    if "deduplicate" in yml_conf["data"] and yml_conf["data"]["deduplicate"] not in [None, False]:
+        dedup_tolerance = 0.0
+        if isinstance(yml_conf["data"]["deduplicate"], dict):
+            dedup_tolerance = float(yml_conf["data"]["deduplicate"].get("tolerance", 0.0))
+
+    cache_dir = None
+    if "activation_cache" in yml_conf["dbn"]["training"]:
+        cache_dir = get_cache_dir(yml_conf["dbn"]["training"]["activation_cache"], out_dir)
+
+    random_crops = None
+    if "random_crops" in yml_conf["data"] and fcn:
+        random_crops = yml_conf["data"]["random_crops"]
+        if shared_dir is not None or cache_dir is not None or dedup_tolerance is not None:
+            raise ValueError("data/random_crops draws tiles on the fly, so cannot be used with data/shared_memory, data/deduplicate or dbn/training/activation_cache")
+
     scaler = None
     scaler_train = True 
     scaler_fname = os.path.join(out_dir, "dbn_scaler.pkl")
@@ -212,60 +602,137 @@ def run_dbn(yml_conf):
         if tune_scaler:
             scaler_train = True
 
+    #Optional per-pixel spectral reduction, fit after (and saved alongside) the scaler
+    reducer = None
+    reducer_train = False
+    reducer_fname = os.path.join(out_dir, "dbn_reducer.pkl")
+    if "spectral_reduction" in yml_conf["data"] and not fcn:
+        if not os.path.exists(reducer_fname) or (preprocess_train == True and overwrite_model):
+            reducer = SpectralReducer.from_config(yml_conf["data"]["spectral_reduction"])
+            reducer_train = True
+        else:
+            reducer = load(reducer_fname)
+    if shard_data and reducer_train:
+        raise ValueError("data/spectral_reduction is fit on the full training set, so cannot be fit with data/shard_preprocessing. Fit it first (e.g. with dbn_datasets.py).")
+
     os.environ['PREPROCESS_GPU'] = str(int(use_gpu_pre))
+    if "batch_fetch" in yml_conf["dbn"]["training"]:
+        os.environ['BATCH_FETCH'] = str(int(yml_conf["dbn"]["training"]["batch_fetch"]))
+
+    fused_cd = False
+    if "fused_cd" in yml_conf["dbn"]["training"]:
+        fused_cd = yml_conf["dbn"]["training"]["fused_cd"] and not fcn
 
-    local_rank = 0
-    if "LOCAL_RANK" in os.environ.keys():
-        setup_ddp(device_ids, use_gpu)
-        local_rank = int(os.environ["LOCAL_RANK"])
+    setup_ddp(device_ids, use_gpu, backend)
+    local_rank = get_local_rank()
+    telemetry = configure_telemetry(out_dir, profile, get_rank(), get_world_size())
 
     read_func = get_read_func(data_reader)
 
     if subset_count > 1: 
         print("WARNING: Making subset count > 1 for training data may lead to suboptimal results")
 
-    if not fcn:
-        #TODO stratify conv data
-
-        if preprocess_train: 
-            if stratify_data is not None:
-                strat_read_func = get_read_func(stratify_data["reader"]) 
-                stratify_data["reader"] = strat_read_func
-
-            x2 = DBNDataset()
-            x2.read_and_preprocess_data(data_train, read_func, data_reader_kwargs, pixel_padding, delete_chans=delete_chans, \
-                valid_min=valid_min, valid_max=valid_max, fill_value =fill, chan_dim = chan_dim, transform_chans=transform_chans, \
-                transform_values=transform_values, scaler = scaler, train_scaler = scaler_train, scale = scale_data, \
-                transform=numpy_to_torch, subset=subset_count, subset_training = subset_training, stratify_data=stratify_data)
-        else:
-            x2 = DBNDataset()
-            x2.read_data_preprocessed(data_fname, targets_fname, scaler)
-    else:
-        if preprocess_train:
-            x2 = DBNDatasetConv()
-            x2.read_and_preprocess_data(data_train, read_func, data_reader_kwargs, delete_chans=delete_chans, \
-                 valid_min=valid_min, valid_max=valid_max, fill_value =fill, chan_dim = chan_dim, transform_chans=transform_chans, \
-                 transform_values=transform_values, transform=None, subset=subset_count, tile=tile, tile_size=tile_size, tile_step=tile_step,
-                 subset_training = subset_training)
+    #With shared_memory set, only the first local rank ingests the training data; the others map its published copy
+    telemetry.start("ingest")
+    if shared_dir is None or local_rank == 0:
+        if not fcn:
+            #TODO stratify conv data
+
+            if preprocess_train: 
+                if stratify_data is not None:
+                    strat_read_func = get_read_func(stratify_data["reader"]) 
+                    stratify_data["reader"] = strat_read_func
+
+                x2 = DBNDataset()
+                x2.read_and_preprocess_data(data_train, read_func, data_reader_kwargs, pixel_padding, delete_chans=delete_chans, \
+                    valid_min=valid_min, valid_max=valid_max, fill_value =fill, chan_dim = chan_dim, transform_chans=transform_chans, \
+                    transform_values=transform_values, scaler = scaler, train_scaler = scaler_train, scale = scale_data, \
+                    transform=numpy_to_torch, subset=subset_count, subset_training = subset_training, stratify_data=stratify_data, \
+                    shard = shard_data, storage_dtype = storage_dtype, subset_method = subset_method, subset_weighted = subset_weighted, \
+                    reducer = reducer, train_reducer = reducer_train)
+                if x2.coverage_report is not None and get_rank() == 0:
+                    with open(os.path.join(out_dir, "subset_coverage.json"), "w") as f:
+                        json.dump(x2.coverage_report, f, indent=2)
+            else:
+                x2 = DBNDataset()
+                x2.read_data_preprocessed(data_fname, targets_fname, scaler)
         else:
-           transform = None
-           if os.path.exists(os.path.join(out_dir, "dbn_data_transform.ckpt")):
-               transform = torch.nn.Sequential(
-                                transforms.Normalize(mean_per_channel, std_per_channel)
-                        )            
-               transform.load_state_dict(torch.load(os.path.join(out_dir, "dbn_data_transform.ckpt")))
-
-           x2 = DBNDatasetConv()
-           x2.read_data_preprocessed(data_fname, targets_fname, transform=transform)
+            if random_crops is not None:
+                x2 = DBNDatasetConvCrops(data_train, read_func, data_reader_kwargs, delete_chans=delete_chans, \
+                     valid_min=valid_min, valid_max=valid_max, fill_value =fill, chan_dim = chan_dim, transform_chans=transform_chans, \
+                     transform_values=transform_values, transform=None, tile_size=tile_size, \
+                     samples_per_epoch = int(random_crops.get("samples_per_epoch", 100000)), max_fill = float(random_crops.get("max_fill", 0.5)), \
+                     crops_per_scene = int(random_crops.get("crops_per_scene", 64)), shuffle_buffer = int(random_crops.get("shuffle_buffer", 256)), seed = SEED, \
+                     sobel_features = not sobel_layer)
+            elif preprocess_train:
+                x2 = DBNDatasetConv()
+                x2.read_and_preprocess_data(data_train, read_func, data_reader_kwargs, delete_chans=delete_chans, \
+                     valid_min=valid_min, valid_max=valid_max, fill_value =fill, chan_dim = chan_dim, transform_chans=transform_chans, \
+                     transform_values=transform_values, transform=None, subset=subset_count, tile=tile, tile_size=tile_size, tile_step=tile_step,
+                     subset_training = subset_training, storage_dtype = storage_dtype, sobel_features = not sobel_layer)
+            else:
+               transform = None
+               if os.path.exists(os.path.join(out_dir, "dbn_data_transform.ckpt")):
+                   transform = torch.nn.Sequential(
+                                    transforms.Normalize(mean_per_channel, std_per_channel)
+                            )            
+                   transform.load_state_dict(torch.load(os.path.join(out_dir, "dbn_data_transform.ckpt")))
+
+               x2 = DBNDatasetConv()
+               x2.read_data_preprocessed(data_fname, targets_fname, transform=transform)
+        if shared_dir is not None:
+            x2.publish_shared(shared_dir)
+            #Released on any exit of the publishing process (errors and Ctrl-C included), not only at the end of the run
+            atexit.register(release_shared, shared_dir)
+    if shared_dir is not None:
+        barrier()
+        if local_rank != 0:
+            if not fcn:
+                x2 = DBNDataset()
+            else:
+                x2 = DBNDatasetConv()
+            x2.read_shared(shared_dir, subset_count)
 
     if x2.train_indices is not None:
         np.save(os.path.join(out_dir, "train_indices"), x2.train_indices)
+    #Ranks attached to shared memory get the reducer fit by the publishing rank
+    if getattr(x2, "reducer", None) is not None:
+        reducer = x2.reducer
+    if reducer_train and get_rank() == 0 and getattr(x2, "reduction_report", None) is not None:
+        with open(os.path.join(out_dir, "spectral_reduction.json"), "w") as f:
+            json.dump(x2.reduction_report, f, indent=2)
+    telemetry.stop("ingest", len(x2))
+
+    #Held-out samples for convergence checks (dense DBN and deep clustering only)
+    holdout = None
+    if early_stopping is not None and not fcn:
+        holdout = split_holdout(x2, holdout_fraction)
+    holdout_loader = None
+    if holdout is not None:
+        holdout_loader = DataLoader(holdout, batch_size=cluster_batch_size, shuffle=False, num_workers = 0)
+    stopped_epochs = {}
+
+    #Collapse repeated samples into unique ones with counts - training samples them by count (see dist_utils.get_sampler)
+    dedup_stats = None
+    if dedup_tolerance is not None:
+        start = timer()
+        telemetry.start("deduplicate")
+        dedup_stats = x2.deduplicate(dedup_tolerance)
+        telemetry.stop("deduplicate", len(x2))
+        dedup_stats["dedup_time"] = timer() - start
+
+    #The fork's DBN.fit builds its own loader, so it is bypassed whenever sampling or decoding differs from the default
+    layerwise_fit = early_stopping is not None or cache_dir is not None or shard_data or x2.get_codec() is not None or \
+        x2.sample_weights is not None or fused_cd
+    clust_stopped_epoch = None
  
     #Generate model
     if not fcn:
         chunk_size = 1
         for i in range(1,pixel_padding+1):
             chunk_size = chunk_size + (8*i)
+    elif random_crops is not None:
+        chunk_size = (tile_size[0], tile_size[1])
     else:
         chunk_size = (x2.data_full.shape[2],x2.data_full.shape[3]) #TODO generalize
         #chunk_size = x2.data_full.shape[x2.chan_dim+1] 
@@ -276,61 +743,131 @@ def run_dbn(yml_conf):
         new_dbn = DBN(model=model_type, n_visible=x2.data_full.shape[1], n_hidden=dbn_arch, steps=gibbs_steps, \
             learning_rate=learning_rate, momentum=momentum, decay=decay, temperature=temp, use_gpu=use_gpu)
     else:
+        from rbm_models.fcn_dbn import DBNUnet, SobelFeatures
+        #Sobel features computed by the model from the (normalized) raw channels - see data/sobel_layer
+        sobel = None
+        if sobel_layer:
+            sobel = SobelFeatures()
+            if x2.transform is not None:
+                sobel = SobelFeatures(x2.transform[0].mean, x2.transform[0].std)
         new_dbn = DBNUnet(model=model_type,visible_shape=chunk_size, in_channels=number_channel*2, steps=gibbs_steps, \
-            out_channels=auto_clust, learning_rate=learning_rate, momentum=momentum, decay=decay, use_gpu=use_gpu)
+            out_channels=auto_clust, learning_rate=learning_rate, momentum=momentum, decay=decay, use_gpu=use_gpu, sobel=sobel)
  
     if use_gpu:
         torch.cuda.manual_seed_all(SEED)
-        device = torch.device("cuda:{}".format(local_rank))
-    else:
-        device = torch.device("cpu:{}".format(local_rank))
+    device = get_device(use_gpu)
 
     for i in range(len(new_dbn.models)):
         if not isinstance(new_dbn.models[i], torch.nn.MaxPool2d):
            new_dbn.models[i]._optimizer = opt.SGD(new_dbn.models[i].parameters(), lr=learning_rate[i], momentum=momentum[i], weight_decay=decay[i], nesterov=nesterov_accel[i])
            new_dbn.models[i].normalize = normalize_learnergy[i]
            new_dbn.models[i].batch_normalize = batch_normalize[i]
-        if "LOCAL_RANK" in os.environ.keys():
-            if not isinstance(new_dbn.models[i], torch.nn.MaxPool2d):
-                new_dbn.models[i] = DDP(new_dbn.models[i], device_ids=[new_dbn.models[i].torch_device], output_device=new_dbn.models[i].torch_device) #, device_ids=device_ids)
-            else:
-                new_dbn.models[i] = new_dbn.models[i]
+           #DDP (gradient all-reduce) only when running multi-process
+           new_dbn.models[i] = wrap_ddp(new_dbn.models[i])
  
 
     if not os.path.exists(model_file + ".ckpt") or overwrite_model: 
         #Train model
         count = 0
         pl = None
+        train_start = timer()
+        n_trained = 0
+        telemetry.start("dbn_train")
         while(count == 0 or x2.has_next_subset()):
             if fcn:
                 mse = \
                     new_dbn.fit(x2, batch_size=batch_size, epochs=epochs,
-                        is_distributed = True, num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre)) #int(os.cpu_count() / 3))
+                        is_distributed = is_distributed(), num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre),
+                        early_stopping = early_stopping, cache_dir = cache_dir) #int(os.cpu_count() / 3))
+                stopped_epochs = new_dbn.stopped_epochs
+            elif layerwise_fit:
+                mse, pl, stopped_epochs = \
+                    fit_dbn_layerwise(new_dbn, x2, batch_size, epochs, early_stopping, holdout, cache_dir,
+                        num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre), fused_cd = fused_cd)
             else:
                 mse, pl = \
                     new_dbn.fit(x2, batch_size=batch_size, epochs=epochs,
-                        is_distributed = True, num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre)) #int(os.cpu_count() / 3))
+                        is_distributed = is_distributed(), num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre)) #int(os.cpu_count() / 3))
             count = count + 1
+            n_trained = n_trained + len(x2)
             x2.next_subset()
         new_dbn.eval() 
-        dist.barrier()
+        barrier()
+        #Samples seen by all layers over their scheduled epochs (early stopping makes this an upper bound)
+        telemetry.stop("dbn_train", n_trained * sum(epochs), subsets = count, layers = len(new_dbn.models))
+        if dedup_stats is not None and local_rank == 0:
+            #Per-sample cost is unchanged, so training time scales with the samples drawn per epoch
+            dedup_stats["train_time"] = timer() - train_start
+            dedup_stats["estimated_train_time_without_dedup"] = dedup_stats["train_time"] * dedup_stats["epoch_speedup"]
+            with open(os.path.join(out_dir, "dedup_report.json"), "w") as f:
+                json.dump(dedup_stats, f, indent=2)
         if local_rank == 0:
             for i in range(len(new_dbn.models)):	
                 if not isinstance(new_dbn.models[i], torch.nn.MaxPool2d):
-                    converge.plot(new_dbn.models[i].module._history['mse'],
+                    converge.plot(unwrap(new_dbn.models[i])._history['mse'],
                         labels=['MSE'], title='convergence', subtitle='Model: Restricted Boltzmann Machine')
+                    mark_stop(plt, stopped_epochs.get(i))
                     plt.savefig(os.path.join(out_dir, "mse_plot_layer" + str(i) + ".png"))
                     plt.clf()
                     if pl is not None:
-                        converge.plot( new_dbn.models[i].module._history['pl'],
+                        converge.plot( unwrap(new_dbn.models[i])._history['pl'],
                             labels=['log-PL'], title='Log-PL', subtitle='Model: Restricted Boltzmann Machine')
                         plt.savefig(os.path.join(out_dir, "log-pl_plot_layer" + str(i) + ".png"))
                         plt.clf()
-                    converge.plot( new_dbn.models[i].module._history['time'],
+                    converge.plot( unwrap(new_dbn.models[i])._history['time'],
                         labels=['time (s)'], title='Training Time', subtitle='Model: Restricted Boltzmann Machine')
                     plt.savefig(os.path.join(out_dir, "time_plot_layer" + str(i) + ".png"))
                     plt.clf()
 
+    if cluster_sweep is not None and not fcn:
+        #Train (or load) the trunk once, then fit one clustering head per cluster count
+        if os.path.exists(model_file + ".ckpt") and not overwrite_model:
+            print("Loading pre-existing model")
+            load_state_dict(new_dbn, torch.load(model_file + ".ckpt", map_location=device))
+        elif local_rank == 0:
+            torch.save(new_dbn.state_dict(), model_file + ".ckpt")
+            if hasattr(x2, "scaler") and x2.scaler is not None:
+                with open(os.path.join(out_dir, "dbn_scaler.pkl"), "wb") as f:
+                    dump(x2.scaler, f, True, pickle.HIGHEST_PROTOCOL)
+            if reducer is not None:
+                with open(reducer_fname, "wb") as f:
+                    dump(reducer, f, True, pickle.HIGHEST_PROTOCOL)
+        barrier()
+        telemetry.start("cluster_train")
+        heads = run_cluster_sweep(new_dbn, x2, cluster_sweep, dbn_arch[-1], out_dir, model_fname, use_gpu,
+            cluster_batch_size, cluster_epochs, cluster_gauss_noise_stdev, cluster_lambda, early_stopping,
+            num_loader_workers, (not use_gpu_pre))
+        telemetry.stop("cluster_train", len(x2) * cluster_epochs * len(cluster_sweep), heads = len(cluster_sweep))
+
+        if local_rank == 0:
+            scaler = x2.scaler
+            transform = x2.transform
+            del x2
+            files = [(f, testing_output, testing_mse, raster_options(raster, "geo_files_test", t)) for t, f in enumerate(data_test)]
+            if generate_train_output:
+                files = files + [(f, training_output, training_mse, raster_options(raster, "geo_files_train", t)) for t, f in enumerate(data_train)]
+            #Each file is read and preprocessed once, then run through every head
+            for fle, output_name, mse_name, raster_opts in files:
+                fbase = fle
+                while isinstance(fbase, list):
+                    fbase = fbase[0]
+                fname_begin = os.path.basename(fbase) + ".clust"
+                phase = "output_test" if output_name == testing_output else "output_train"
+                telemetry.start(phase)
+                x3 = DBNDataset()
+                x3.read_and_preprocess_data([fle], read_func, data_reader_kwargs, pixel_padding, delete_chans=delete_chans, valid_min=valid_min, valid_max=valid_max, \
+                    fill_value = fill, chan_dim = chan_dim, transform_chans=transform_chans, transform_values=transform_values, scaler=scaler, scale = scale_data, \
+                    transform=transform,  subset=subset_count, reducer = reducer)
+                for k in cluster_sweep:
+                    generate_output(x3, heads[k], use_gpu, sweep_subdir(out_dir, k), fname_begin + output_name, mse_name,
+                        output_subset_count, (not use_gpu_pre), fcn, write_input, compact, raster_opts)
+                telemetry.stop(phase, x3.data_full.shape[0] * len(cluster_sweep), file = fbase)
+                del x3
+        if shared_dir is not None and local_rank == 0:
+            release_shared(shared_dir)
+        cleanup_ddp()
+        return
+
     final_model = new_dbn
     if auto_clust > 0:
         #sze = 0
@@ -346,62 +883,68 @@ def run_dbn(yml_conf):
                 with open(os.path.join(out_dir, "fc_clust_scaler.pkl"), "rb") as f:
                     clust_scaler = load(f)
 
-        clust_dbn = ClustDBN(new_dbn, dbn_arch[-1], auto_clust, True, clust_scaler) #TODO parameterize
-        clust_dbn.fc = DDP(clust_dbn.fc, device_ids=[local_rank], output_device=local_rank)
+        clust_dbn = ClustDBN(new_dbn, dbn_arch[-1], auto_clust, use_gpu, clust_scaler) #TODO parameterize
+        clust_dbn.fc = wrap_ddp(clust_dbn.fc)
         final_model = clust_dbn
         if not os.path.exists(model_file + "_fc_clust.ckpt") or overwrite_model:
-           dataset2 = TensorDataset(x2.data, x2.targets)
-           loader = None
-           is_distributed = True 
-           if is_distributed:
-               sampler = DistributedSampler(dataset2, shuffle=True)
-               loader = DataLoader(dataset2, batch_size=cluster_batch_size, shuffle=False,
-                    sampler=sampler, num_workers = num_loader_workers, pin_memory = (not use_gpu_pre),
-                    drop_last=True)
+           dataset2 = x2
+           loader, sampler = get_loader(dataset2, cluster_batch_size, num_workers = num_loader_workers, pin_memory = (not use_gpu_pre))
 
            count = 0
+           n_trained = 0
+           telemetry.start("cluster_train")
            while(count == 0 or x2.has_next_subset()):
-               final_model.fit(dataset2, cluster_batch_size, cluster_epochs, loader, sampler, cluster_gauss_noise_stdev, cluster_lambda)
+               clust_stopped_epoch = final_model.fit(dataset2, cluster_batch_size, cluster_epochs, loader, sampler, cluster_gauss_noise_stdev, cluster_lambda,
+                   ConvergenceMonitor.from_config(early_stopping), holdout_loader)
                count = count + 1
+               n_trained = n_trained + len(x2)
                x2.next_subset()
            final_model.eval()
            final_model.fc.eval()
+           telemetry.stop("cluster_train", n_trained * cluster_epochs, subsets = count)
+           if local_rank == 0 and "loss" in final_model.history:
+               if clust_stopped_epoch is not None:
+                   clust_stopped_epoch = len(final_model.history["loss"]) - 1
+               converge.plot(final_model.history["loss"], labels=['IID loss'], title='convergence', subtitle='Model: Deep Clustering Head')
+               mark_stop(plt, clust_stopped_epoch)
+               plt.savefig(os.path.join(out_dir, "clust_loss_plot.png"))
+               plt.clf()
     if os.path.exists(model_file + ".ckpt") and not overwrite_model:
         print("Loading pre-existing model")
         if auto_clust > 0:
-            final_model.dbn_trunk.load_state_dict(torch.load(model_file + ".ckpt"))
+            load_state_dict(final_model.dbn_trunk, torch.load(model_file + ".ckpt", map_location=device))
             if tune_dbn:
                 count = 0
                 while(count == 0 or x2.has_next_subset()):
                     if fcn:
                       mse = \
                         final_model.dbn_trunk.fit(x2, batch_size=batch_size, epochs=epochs,
-                            is_distributed = True, num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre)) #int(os.cpu_count() / 3))
+                            is_distributed = is_distributed(), num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre),
+                            early_stopping = early_stopping, cache_dir = cache_dir) #int(os.cpu_count() / 3))
+                    elif layerwise_fit:
+                      mse, pl, stopped_epochs = \
+                        fit_dbn_layerwise(final_model.dbn_trunk, x2, batch_size, epochs, early_stopping, holdout, cache_dir,
+                            num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre), fused_cd = fused_cd)
                     else:
                       mse, pl = \
                         final_model.dbn_trunk.fit(x2, batch_size=batch_size, epochs=epochs,
-                            is_distributed = True, num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre)) #int(os.cpu_count() / 3))
+                            is_distributed = is_distributed(), num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre)) #int(os.cpu_count() / 3))
                     count = count + 1
                     x2.next_subset()
                 final_model.dbn_trunk.eval()
                 torch.save(final_model.dbn_trunk.state_dict(), model_file + ".ckpt") 
 
             if os.path.exists(model_file + "_fc_clust.ckpt") and not overwrite_model:
-                final_model.fc.load_state_dict(torch.load(model_file + "_fc_clust.ckpt"))
+                load_state_dict(final_model.fc, torch.load(model_file + "_fc_clust.ckpt", map_location=device))
                 if tune_clust:
                     print("Tuning pre-existing Deep Clustering layers")
-                    dataset2 = TensorDataset(x2.data, x2.targets)
-                    loader = None
-                    is_distributed = True
-                    if is_distributed:
-                        sampler = DistributedSampler(dataset2, shuffle=True)
-                        loader = DataLoader(dataset2, batch_size=cluster_batch_size, shuffle=False,
-                             sampler=sampler, num_workers = num_loader_workers, pin_memory = (not use_gpu_pre),
-                             drop_last=True)
+                    dataset2 = x2
+                    loader, sampler = get_loader(dataset2, cluster_batch_size, num_workers = num_loader_workers, pin_memory = (not use_gpu_pre))
 
                     count = 0
                     while(count == 0 or x2.has_next_subset()):
-                        final_model.fit(dataset2, cluster_batch_size, cluster_epochs, loader, sampler, cluster_gauss_noise_stdev, cluster_lambda)
+                        final_model.fit(dataset2, cluster_batch_size, cluster_epochs, loader, sampler, cluster_gauss_noise_stdev, cluster_lambda,
+                            ConvergenceMonitor.from_config(early_stopping), holdout_loader)
                         count = count + 1
                         x2.next_subset()
                     final_model.eval()
@@ -409,7 +952,7 @@ def run_dbn(yml_conf):
                     torch.save(final_model.fc.state_dict(), model_file + "_fc_clust.ckpt")
 
         else:
-            final_model.load_state_dict(torch.load(model_file + ".ckpt"))
+            load_state_dict(final_model, torch.load(model_file + ".ckpt", map_location=device))
 
             if tune_dbn:
                 count = 0
@@ -417,11 +960,16 @@ def run_dbn(yml_conf):
                     if fcn:
                         mse = \
                         final_model.fit(x2, batch_size=batch_size, epochs=epochs,
-                            is_distributed = True, num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre)) #int(os.cpu_count() / 3))
+                            is_distributed = is_distributed(), num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre),
+                            early_stopping = early_stopping, cache_dir = cache_dir) #int(os.cpu_count() / 3))
+                    elif layerwise_fit:
+                        mse, pl, stopped_epochs = \
+                            fit_dbn_layerwise(final_model, x2, batch_size, epochs, early_stopping, holdout, cache_dir,
+                                num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre), fused_cd = fused_cd)
                     else:
                         mse, pl = \
                             final_model.fit(x2, batch_size=batch_size, epochs=epochs,
-                                is_distributed = True, num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre)) #int(os.cpu_count() / 3))
+                                is_distributed = is_distributed(), num_loader_workers = num_loader_workers, pin_memory=(not use_gpu_pre)) #int(os.cpu_count() / 3))
                     count = count + 1
                     x2.next_subset()
                 torch.save(final_model.state_dict(), model_file + ".ckpt")
@@ -430,18 +978,19 @@ def run_dbn(yml_conf):
         #    new_dbn._models[m].load_state_dict(model_file + "_sub_model_" + str(m) + ".ckpt") 
 
 
-    dist.barrier()
+    barrier()
     if local_rank == 0:
         if not os.path.exists(model_file + ".ckpt") or overwrite_model:
             for i in range(len(new_dbn.models)):
                 if not isinstance(new_dbn.models[i], torch.nn.MaxPool2d):
                     if fcn:
-                        converge.plot(new_dbn.models[i].module._history['mse'], new_dbn.models[i].module._history['time'], 
+                        converge.plot(unwrap(new_dbn.models[i])._history['mse'], unwrap(new_dbn.models[i])._history['time'], 
                             labels=['MSE', 'time (s)'], title='convergence over dataset', subtitle='Model: Restricted Boltzmann Machine')
                     else:
-                        converge.plot(new_dbn.models[i].module._history['mse'], new_dbn.models[i].module._history['pl'],
-                            new_dbn.models[i].module._history['time'], labels=['MSE', 'log-PL', 'time (s)'],
+                        converge.plot(unwrap(new_dbn.models[i])._history['mse'], unwrap(new_dbn.models[i])._history['pl'],
+                            unwrap(new_dbn.models[i])._history['time'], labels=['MSE', 'log-PL', 'time (s)'],
                             title='convergence over dataset', subtitle='Model: Restricted Boltzmann Machine')
+                    mark_stop(plt, stopped_epochs.get(i))
                     plt.savefig(os.path.join(out_dir, "convergence_plot_layer" + str(i) + ".png"))
     
 
@@ -463,6 +1012,9 @@ def run_dbn(yml_conf):
                     dump(x2.scaler, f, True, pickle.HIGHEST_PROTOCOL)
             else:
                 x2.scaler = None             
+            if reducer is not None:
+                with open(reducer_fname, "wb") as f:
+                    dump(reducer, f, True, pickle.HIGHEST_PROTOCOL)
 
             if hasattr(final_model, "scaler") and final_model.scaler is not None:
                 with open(os.path.join(out_dir, "fc_clust_scaler.pkl"), "wb") as f:
@@ -478,9 +1030,22 @@ def run_dbn(yml_conf):
         fname_begin = "file"
         if auto_clust > 0:
             fname_begin = fname_begin +"_clust"
+        final_model = quantized_output_model(final_model, x2, quantize, use_gpu, out_dir, SEED)
         scaler = x2.scaler
         transform = x2.transform
         del x2
+        scene_engine = None
+        if scene_inference is not None:
+            scene_engine = SceneInference(final_model, pixel_padding, int(scene_inference.get("tile_size", 512)))
+        if tiled_inference is not None:
+            overlap = tiled_inference.get("overlap", 0)
+            if not isinstance(overlap, (list, tuple)):
+                overlap = (overlap, overlap)
+            tiled_size = tiled_inference.get("tile_size", chunk_size)
+            if not isinstance(tiled_size, (list, tuple)):
+                tiled_size = (tiled_size, tiled_size)
+            scene_engine = TiledInference(final_model, tiled_size, overlap, tiled_inference.get("blend", "cosine"),
+                transform, sobel_features = not sobel_layer, device = get_device(use_gpu), batch_size = int(tiled_inference.get("batch_size", 4)))
         for t in range(0, len(data_test)):
 	
             fbase = data_test[t]
@@ -488,19 +1053,38 @@ def run_dbn(yml_conf):
                 fbase = fbase[0]
 
             fname_begin = os.path.basename(fbase) + ".clust"
+            telemetry.start("output_test")
+            if scene_inference is not None:
+                scene, valid = DBNDataset().read_and_preprocess_scene(data_test[t], read_func, data_reader_kwargs, pixel_padding, delete_chans=delete_chans,
+                    valid_min=valid_min, valid_max=valid_max, fill_value = fill, chan_dim = chan_dim, transform_chans=transform_chans,
+                    transform_values=transform_values, scaler=scaler, scale = scale_data, reducer = reducer)
+                n_samples = generate_scene_output(scene, valid, scene_engine, out_dir, fname_begin + testing_output, compact,
+                    raster_options(raster, "geo_files_test", t), int(scene_inference.get("check_samples", 0)))
+                telemetry.stop("output_test", n_samples, file = fbase)
+                continue
+            if tiled_inference is not None:
+                scene, valid = read_scene(data_test[t], read_func, data_reader_kwargs, delete_chans, valid_min, valid_max, fill_value = fill,
+                    chan_dim = chan_dim, transform_chans = transform_chans, transform_values = transform_values)
+                n_samples = generate_tiled_output(scene, valid, scene_engine, out_dir, fname_begin + testing_output,
+                    raster_options(raster, "geo_files_test", t), tiled_inference.get("scores", False))
+                telemetry.stop("output_test", n_samples, file = fbase)
+                continue
             if not fcn:
                 x3 = DBNDataset()
                 x3.read_and_preprocess_data([data_test[t]], read_func, data_reader_kwargs, pixel_padding, delete_chans=delete_chans, valid_min=valid_min, valid_max=valid_max, \
                     fill_value = fill, chan_dim = chan_dim, transform_chans=transform_chans, transform_values=transform_values, scaler=scaler, scale = scale_data, \
-				transform=transform,  subset=subset_count)
+				transform=transform,  subset=subset_count, reducer = reducer)
             else:
                 x3 = DBNDatasetConv()
                 x3.read_and_preprocess_data([data_test[t]], read_func, data_reader_kwargs,  delete_chans=delete_chans, valid_min=valid_min, valid_max=valid_max, \
                 fill_value = fill, chan_dim = chan_dim, transform_chans=transform_chans, transform_values=transform_values, transform = transform, \
-                subset=subset_count, tile=tile, tile_size=tile_size, tile_step=tile_step)
+                subset=subset_count, tile=tile, tile_size=tile_size, tile_step=tile_step, sobel_features = not sobel_layer)
                 x3.scaler = None
 
-            generate_output(x3, final_model, use_gpu, out_dir, fname_begin + testing_output, testing_mse, output_subset_count, (not use_gpu_pre), fcn)
+            n_samples = x3.data_full.shape[0]
+            generate_output(x3, final_model, use_gpu, out_dir, fname_begin + testing_output, testing_mse, output_subset_count, (not use_gpu_pre), fcn, write_input, compact,
+                raster_options(raster, "geo_files_test", t))
+            telemetry.stop("output_test", n_samples, file = fbase)
     
  
         x2 = None
@@ -513,102 +1097,181 @@ def run_dbn(yml_conf):
                     fbase = fbase[0]
 
                 fname_begin = os.path.basename(fbase) + ".clust"
+                telemetry.start("output_train")
+                if scene_inference is not None:
+                    scene, valid = DBNDataset().read_and_preprocess_scene(data_train[t], read_func, data_reader_kwargs, pixel_padding, delete_chans=delete_chans,
+                        valid_min=valid_min, valid_max=valid_max, fill_value = fill, chan_dim = chan_dim, transform_chans=transform_chans,
+                        transform_values=transform_values, scaler=scaler, scale = scale_data, reducer = reducer)
+                    n_samples = generate_scene_output(scene, valid, scene_engine, out_dir, fname_begin + training_output, compact,
+                        raster_options(raster, "geo_files_train", t), int(scene_inference.get("check_samples", 0)))
+                    telemetry.stop("output_train", n_samples, file = fbase)
+                    continue
+                if tiled_inference is not None:
+                    scene, valid = read_scene(data_train[t], read_func, data_reader_kwargs, delete_chans, valid_min, valid_max, fill_value = fill,
+                        chan_dim = chan_dim, transform_chans = transform_chans, transform_values = transform_values)
+                    n_samples = generate_tiled_output(scene, valid, scene_engine, out_dir, fname_begin + training_output,
+                        raster_options(raster, "geo_files_train", t), tiled_inference.get("scores", False))
+                    telemetry.stop("output_train", n_samples, file = fbase)
+                    continue
                 if not fcn:
                     x2 = DBNDataset()
                     x2.read_and_preprocess_data([data_train[t]], read_func, data_reader_kwargs, pixel_padding, delete_chans=delete_chans, valid_min=valid_min, \
                        valid_max=valid_max, fill_value =fill, chan_dim = chan_dim, transform_chans=transform_chans, transform_values=transform_values, \
-                       scaler = scaler, scale = scale_data, transform=numpy_to_torch, subset=subset_count)
+                       scaler = scaler, scale = scale_data, transform=numpy_to_torch, subset=subset_count, reducer = reducer)
                 else:
                     x2 = DBNDatasetConv()
                     x2.read_and_preprocess_data([data_train[t]], read_func, data_reader_kwargs,  delete_chans=delete_chans, valid_min=valid_min, valid_max=valid_max, \
                         fill_value = fill, chan_dim = chan_dim, transform_chans=transform_chans, transform_values=transform_values, transform = transform, \
-                        subset=subset_count, tile=tile, tile_size=tile_size, tile_step=tile_step)
+                        subset=subset_count, tile=tile, tile_size=tile_size, tile_step=tile_step, sobel_features = not sobel_layer)
                     x2.scaler = None 
  
-                generate_output(x2, final_model, use_gpu, out_dir, fname_begin + training_output, training_mse, output_subset_count, (not use_gpu_pre), fcn)
-
-    if "LOCAL_RANK" in os.environ.keys():
-        cleanup_ddp() 
+                n_samples = x2.data_full.shape[0]
+                generate_output(x2, final_model, use_gpu, out_dir, fname_begin + training_output, training_mse, output_subset_count, (not use_gpu_pre), fcn, write_input, compact,
+                    raster_options(raster, "geo_files_train", t))
+                telemetry.stop("output_train", n_samples, file = fbase)
+
+    if shared_dir is not None and local_rank == 0:
+        release_shared(shared_dir)
+    cleanup_ddp() 
  
-def generate_output(dat, mdl, use_gpu, out_dir, output_fle, mse_fle, output_subset_count, pin_mem = False, fcn = False):
-    output_full = None
+def generate_output(dat, mdl, use_gpu, out_dir, output_fle, mse_fle, output_subset_count, pin_mem = False, fcn = False, write_input = False,
+    compact = None, raster = None):
     count = 0
     dat.current_subset = -1
     dat.next_subset()
 
-    local_rank = 0
-    if "LOCAL_RANK" in os.environ.keys():
-        local_rank = int(os.environ["LOCAL_RANK"])
-    if use_gpu:
-        device = torch.device("cuda:{}".format(local_rank))
-    else:
-        device = torch.device("cpu:{}".format(local_rank))
+    device = get_device(use_gpu)
 
-    ind = 0
+    #Batch outputs are streamed to disk as they are produced (see output_store), so no scene-sized output is held in memory
+    if raster is not None:
+        #Labels go straight into the scene's raster - no per-sample outputs, indices or inputs are written
+        valid = None
+        if len(getattr(dat, "valid_masks", [])) == 1:
+            valid = unpack_mask(dat.valid_masks[0])
+        writer = RasterWriter(os.path.join(out_dir, output_fle), raster_shape(dat.targets_full, dat.pixel_padding, valid),
+            raster["format"], raster["geo_reference"])
+    else:
+        writer = get_output_writer(os.path.join(out_dir, output_fle), dat.data_full.shape[0], compact)
     while(count == 0 or dat.has_next_subset() or (dat.subset > 1 and dat.current_subset > (dat.subset-2))):
-        output_batch_size = min(5000, int(dat.data_full.shape[0] / 5))
-
-        output_sze = dat.data_full.shape[0]
-        append_remainder = int(output_batch_size - (output_sze % output_batch_size))
+        output_batch_size = max(1, min(5000, int(dat.data_full.shape[0] / 5)))
 
-        if isinstance(dat.data_full,torch.Tensor):
-            dat.data_full = torch.cat((dat.data_full,dat.data_full[0:append_remainder]))
-            dat.targets_full = torch.cat((dat.targets_full,dat.targets_full[0:append_remainder]))
-        else:
-            dat.data_full = np.concatenate((dat.data_full,dat.data_full[0:append_remainder]))
-            dat.targets_full = np.concatenate((dat.targets_full,dat.targets_full[0:append_remainder]))
-
-        dat.current_subset = -1
-        dat.next_subset()
-
-        test_loader = DataLoader(dat, batch_size=output_batch_size, shuffle=False, \
-        num_workers = 0, drop_last = False, pin_memory = pin_mem) 
-        ind = 0
-        ind2 = 0 
+        test_loader = batch_loader(dat, None, output_batch_size, num_workers = 0, pin_memory = pin_mem, drop_last = False)
         for data in tqdm(test_loader):
-            dat_dev, lab_dev = data[0].to(device=device, non_blocking=True), data[1].to(device=device, non_blocking=True)
-            dev_ds = TensorDataset(dat_dev, lab_dev)
+            dat_dev = data[0].to(device=device, non_blocking=True)
 
-            output = mdl.forward(dat_dev)  
+            with torch.no_grad():
+                output = mdl.forward(dat_dev)  
             if isinstance(output, list):
                 output = output[0] #TODO improve usage uf multi-headed output after single-headed approach validated
 
-            if use_gpu == True:
-                output = output.detach().cpu()
-            loader = DataLoader(dev_ds, batch_size=output_batch_size, shuffle=False, \
-                num_workers = 0, drop_last = False, pin_memory = False)
-            dat_dev = dat_dev.detach().cpu()
-            lab_dev = lab_dev.detach().cpu()
-            del dev_ds
-
-            if output_full is None:
-                if not fcn:
-                    output_full = torch.zeros(dat.data_full.shape[0], output.shape[1], dtype=torch.float32)
-                else:
-                    output_full = torch.zeros(dat.data_full.shape[0], dat.data_full.shape[1], output.shape[2], dtype=torch.float32)       
-            ind1 = ind2 
-            ind2 += dat_dev.shape[0]
-            if ind2 > output_full.shape[0]:
-                ind2 = output_full.shape[0]
-            output_full[ind1:ind2,:] = output
-            ind = ind + 1
+            #Compact outputs and rasters are reduced on the device, ahead of the transfer
+            if raster is not None:
+                writer.write(output.detach(), data[1])
+            else:
+                writer.write(output.detach() if compact is not None else output.detach().cpu())
             del output
             del dat_dev
-            del lab_dev
-            del loader
         count = count + 1
         if dat.has_next_subset():
             dat.next_subset()
         else:
             break 
     #Save training output
+    if raster is not None:
+        print("SAVED", writer.close())
+        return
     print("SAVING", os.path.join(out_dir, output_fle))
-    torch.save(output_full, os.path.join(out_dir, output_fle), pickle_protocol=pickle.HIGHEST_PROTOCOL)
-    torch.save(dat.targets_full, os.path.join(out_dir, output_fle + ".indices"), pickle_protocol=pickle.HIGHEST_PROTOCOL)
-    torch.save(dat.data_full, os.path.join(out_dir, output_fle + ".input"), pickle_protocol=pickle.HIGHEST_PROTOCOL)
-
-
-
+    writer.close()
+    save_indices(os.path.join(out_dir, output_fle + ".indices"), dat.targets_full)
+    #The (preprocessed) input is only duplicated on request - it can be regenerated from the source files
+    if write_input:
+        save_array(os.path.join(out_dir, output_fle + ".input"), dat.data_full)
+    #Validity of the scene's samples, so rasters can be assembled without rediscovering missing data
+    if not fcn and len(getattr(dat, "valid_masks", [])) == 1:
+        save_mask(get_mask_filename(os.path.join(out_dir, output_fle)), dat.valid_masks[0])
+
+
+
+
+
+def generate_scene_output(scene, valid, engine, out_dir, output_fle, compact = None, raster = None, check_samples = 0):
+    """
+    Scene-level counterpart of generate_output: runs a preprocessed scene through a SceneInference engine, tile by tile,
+    and streams the outputs to a raster or to per-sample outputs (in row-major order, with their .indices and validity mask).
+
+    :param scene: Preprocessed scene (see DBNDataset.read_and_preprocess_scene).
+    :param valid: Per-pixel validity mask of the scene.
+    :param engine: SceneInference of the model.
+    :param out_dir: Output directory.
+    :param output_fle: Output name.
+    :param compact: Optional compact output options (see output/compact).
+    :param raster: Optional raster options (see raster_options).
+    :param check_samples: Optional number of samples (in a random block of the scene) whose labels are compared with the model's own forward, with a warning if any differ (see scene_inference.check_parity). Default is 0 (no check).
+
+    :return: Number of samples.
+    """
+    if check_samples > 0:
+        parity = check_parity(engine, scene, valid, check_samples, crop_size = int(np.ceil(np.sqrt(check_samples))))
+        if parity["label_agreement"] < 1.0:
+            print("WARNING: scene inference labels differ from the model's forward on", output_fle, parity)
+    n_samples = engine.count(valid)
+    if raster is not None:
+        writer = RasterWriter(os.path.join(out_dir, output_fle), raster_shape(None, valid = valid), raster["format"], raster["geo_reference"])
+    else:
+        writer = get_output_writer(os.path.join(out_dir, output_fle), n_samples, compact)
+    indices = []
+    for output, coords in engine.tiles(scene, valid):
+        if raster is not None:
+            writer.write(output.detach(), coords)
+        else:
+            writer.write(output.detach() if compact is not None else output.detach().cpu())
+            indices.append(coords)
+    if raster is not None:
+        print("SAVED", writer.close())
+        return n_samples
+    print("SAVING", os.path.join(out_dir, output_fle))
+    writer.close()
+    save_indices(os.path.join(out_dir, output_fle + ".indices"), np.concatenate(indices) if len(indices) > 0 else np.zeros((0, 3), dtype=np.int16))
+    save_mask(get_mask_filename(os.path.join(out_dir, output_fle)), pack_mask(valid))
+    return n_samples
+
+
+def generate_tiled_output(scene, valid, engine, out_dir, output_fle, raster = None, scores = False):
+    """
+    Fully convolutional counterpart of generate_scene_output: runs a scene through a TiledInference engine (overlapping,
+    blended tiles) and streams the blended rows into a label raster and, optionally, a chunked zarr of class scores.
+
+    :param scene: Scene (channels first), as returned by dbn_datasets_conv.read_scene.
+    :param valid: Per-pixel validity mask of the scene.
+    :param engine: TiledInference of the model.
+    :param out_dir: Output directory.
+    :param output_fle: Output name.
+    :param raster: Optional raster options (see raster_options). Defaults to a zarr raster without georeferencing.
+    :param scores: Whether or not to also write the blended class scores (<output>.scores.zarr, classes x rows x columns,
+        NaN where there is no output), chunked by tile.
+
+    :return: Number of pixels with outputs.
+    """
+    if raster is None:
+        raster = {"format": "zarr", "geo_reference": None}
+    writer = RasterWriter(os.path.join(out_dir, output_fle), valid.shape, raster["format"], raster["geo_reference"])
+    store = None
+    n_samples = 0
+    for r0, block, block_valid in engine.run(scene, valid):
+        if scores and store is None:
+            import zarr
+            store = zarr.open(os.path.join(out_dir, output_fle + ".scores.zarr"), mode = "w", shape = (block.shape[0],) + valid.shape,
+                chunks = (block.shape[0],) + engine.tile_size, dtype = np.float32, fill_value = np.nan)
+        if store is not None:
+            store[:, r0:r0 + block.shape[1]] = np.where(block_valid, block, np.nan)
+        rows, cols = np.nonzero(block_valid)
+        if rows.shape[0] == 0:
+            continue
+        coords = np.stack((np.zeros(rows.shape, dtype=np.int64), rows + r0, cols), axis=1)
+        writer.write(torch.as_tensor(block[:, rows, cols].T), coords)
+        n_samples += rows.shape[0]
+    print("SAVED", writer.close())
+    return n_samples
 
 
 def main(yml_fpath):
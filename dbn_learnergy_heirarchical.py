@@ -40,6 +40,7 @@ from learnergy.models.deep import DBN, ResidualDBN
 #from rbm_models.fcn_dbn import DBNUnet
 from rbm_models.clust_dbn import ClustDBN
 from rbm_models.heirarchichal_deep_clust import HeirClust
+from rbm_models.quantize import quantized_output_model
 #from rbm_models.clust_dbn_2d import ClustDBN2D
 #Visualization
 import learnergy.visual.convergence as converge
@@ -53,9 +54,12 @@ from joblib import dump, load
 #Data
 #from dbn_datasets_cupy import DBNDataset
 from dbn_datasets import DBNDataset
+from validity import save_mask, get_mask_filename
+from output_store import OutputWriter, save_indices, save_array
 from dbn_datasets_conv import DBNDatasetConv 
 #from utils_cupy import numpy_to_torch, read_yaml, get_read_func, get_scaler
 from utils import numpy_to_torch, read_yaml, get_read_func, get_scaler
+from dist_utils import setup_backend, cleanup_backend, barrier, get_local_rank, get_device, wrap_ddp, load_state_dict, batch_loader
 
 #Input Parsing
 import yaml
@@ -70,21 +74,16 @@ SEED = 42
 torch.backends.cudnn.benchmark = True
 torch.backends.cudnn.enabled = True
 
-def setup_ddp(device_ids, use_gpu=True):
+def setup_ddp(device_ids, use_gpu=True, backend="auto"):
     #os.environ['MASTER_ADDR'] = 'localhost'
     #os.environ['MASTER_PORT'] = port
-    os.environ['CUDA_VISIBLE_DEVICES'] = ",".join(device_ids)
     #os.environ['NCCL_SOCKET_IFNAME'] = "lo"
 
-    driver = "nccl"
-    if not use_gpu or not torch.cuda.is_available():
-        driver = "gloo"
-
-    # initialize the process group
-    dist.init_process_group(driver, timeout=timedelta(seconds=5400))
+    # initialize the process group (no-op for single-process runs)
+    return setup_backend(device_ids, use_gpu, backend)
 
 def cleanup_ddp():
-    dist.destroy_process_group()
+    cleanup_backend()
 
 
 def run_dbn(yml_conf):
@@ -121,6 +120,16 @@ def run_dbn(yml_conf):
     training_mse = yml_conf["output"]["training_mse"]
     testing_output = yml_conf["output"]["testing_output"]
     testing_mse = yml_conf["output"]["testing_mse"]
+    #Optional - also write the preprocessed input of each output file (<output>.input)
+    write_input = False
+    if "write_input" in yml_conf["output"]:
+        write_input = yml_conf["output"]["write_input"]
+    #Optional (CPU only) - generate outputs with an int8 quantized copy of the model, if it agrees with the fp32 model
+    quantize = None
+    if "quantize" in yml_conf["output"] and yml_conf["output"]["quantize"] not in [None, False]:
+        quantize = {}
+        if isinstance(yml_conf["output"]["quantize"], dict):
+            quantize = yml_conf["output"]["quantize"]
 
     overwrite_model = yml_conf["dbn"]["overwrite_model"] 
     tune_scaler = yml_conf["dbn"]["tune_scaler"]
@@ -128,6 +137,9 @@ def run_dbn(yml_conf):
     tune_clust = yml_conf["dbn"]["tune_clust"]
     use_gpu_pre = yml_conf["dbn"]["training"]["use_gpu_preprocessing"]
     device_ids = yml_conf["dbn"]["training"]["device_ids"] 
+    backend = "auto"
+    if "backend" in yml_conf["dbn"]["training"]:
+        backend = yml_conf["dbn"]["training"]["backend"]
 
     temp = None
     nesterov_accel = None
@@ -203,13 +215,17 @@ def run_dbn(yml_conf):
    
     scaler = load(scaler_fname)
     scaler_train = False
+    #Spectral reduction fit alongside the scaler by the DBN run, if any
+    reducer = None
+    if os.path.exists(os.path.join(out_dir, "dbn_reducer.pkl")):
+        reducer = load(os.path.join(out_dir, "dbn_reducer.pkl"))
 
     os.environ['PREPROCESS_GPU'] = str(int(use_gpu_pre))
+    if "batch_fetch" in yml_conf["dbn"]["training"]:
+        os.environ['BATCH_FETCH'] = str(int(yml_conf["dbn"]["training"]["batch_fetch"]))
 
-    local_rank = 0
-    if "LOCAL_RANK" in os.environ.keys():
-        setup_ddp(device_ids, use_gpu)
-        local_rank = int(os.environ["LOCAL_RANK"])
+    setup_ddp(device_ids, use_gpu, backend)
+    local_rank = get_local_rank()
 
     read_func = get_read_func(data_reader)
 
@@ -226,7 +242,8 @@ def run_dbn(yml_conf):
         x2.read_and_preprocess_data(data_train, read_func, data_reader_kwargs, pixel_padding, delete_chans=delete_chans, \
             valid_min=valid_min, valid_max=valid_max, fill_value =fill, chan_dim = chan_dim, transform_chans=transform_chans, \
             transform_values=transform_values, scaler = scaler, train_scaler = scaler_train, scale = scale_data, \
-            transform=numpy_to_torch, subset=subset_count, subset_training = subset_training, stratify_data=stratify_data)
+            transform=numpy_to_torch, subset=subset_count, subset_training = subset_training, stratify_data=stratify_data, \
+            reducer = reducer)
     else:
         x2 = DBNDataset()
         x2.read_data_preprocessed(data_fname, targets_fname, scaler)
@@ -245,35 +262,30 @@ def run_dbn(yml_conf):
  
     if use_gpu:
         torch.cuda.manual_seed_all(SEED)
-        device = torch.device("cuda:{}".format(local_rank))
-    else:
-        device = torch.device("cpu:{}".format(local_rank))
+    device = get_device(use_gpu)
 
     for i in range(len(new_dbn.models)):
-        if "LOCAL_RANK" in os.environ.keys():
-            if not isinstance(new_dbn.models[i], torch.nn.MaxPool2d):
-                new_dbn.models[i] = DDP(new_dbn.models[i], device_ids=[local_rank], output_device=local_rank) #, device_ids=device_ids)
-            else:
-                new_dbn.models[i] = new_dbn.models[i]
+        if not isinstance(new_dbn.models[i], torch.nn.MaxPool2d):
+            new_dbn.models[i] = wrap_ddp(new_dbn.models[i])
  
     clust_scaler = None
     if os.path.exists(os.path.join(out_dir, "fc_clust_scaler.pkl")) and not overwrite_model:
             with open(os.path.join(out_dir, "fc_clust_scaler.pkl"), "rb") as f:
                 clust_scaler = load(f)
 
-    clust_dbn = ClustDBN(new_dbn, dbn_arch[-1], auto_clust, True, clust_scaler) #TODO parameterize
-    clust_dbn.fc = DDP(clust_dbn.fc, device_ids=[local_rank], output_device=local_rank)
+    clust_dbn = ClustDBN(new_dbn, dbn_arch[-1], auto_clust, use_gpu, clust_scaler) #TODO parameterize
+    clust_dbn.fc = wrap_ddp(clust_dbn.fc)
     final_model = clust_dbn
     final_model.eval()
     final_model.fc.eval()
     final_model.dbn_trunk.eval()
     print("Loading pre-existing model")
-    final_model.dbn_trunk.load_state_dict(torch.load(model_file + ".ckpt"))
+    load_state_dict(final_model.dbn_trunk, torch.load(model_file + ".ckpt", map_location=device))
 
     if os.path.exists(model_file + "_fc_clust.ckpt") and not overwrite_model:
-        final_model.fc.load_state_dict(torch.load(model_file + "_fc_clust.ckpt"))
+        load_state_dict(final_model.fc, torch.load(model_file + "_fc_clust.ckpt", map_location=device))
 
-    dist.barrier()
+    barrier()
     heir_clust = HeirClust(final_model, x2, 5, use_gpu=use_gpu)
 
  
@@ -296,6 +308,7 @@ def run_dbn(yml_conf):
     fname_begin = "file"
     if auto_clust > 0:
         fname_begin = fname_begin +"_clust"
+    heir_clust = quantized_output_model(heir_clust, x2, quantize, use_gpu, out_dir, SEED)
     scaler = x2.scaler
     transform = x2.transform
     del x2
@@ -311,8 +324,8 @@ def run_dbn(yml_conf):
         x3 = DBNDataset()
         x3.read_and_preprocess_data([data_test[t]], read_func, data_reader_kwargs, pixel_padding, delete_chans=delete_chans, valid_min=valid_min, valid_max=valid_max, \
             fill_value = fill, chan_dim = chan_dim, transform_chans=transform_chans, transform_values=transform_values, scaler=scaler, scale = scale_data, \
-            transform=transform,  subset=subset_count)
-        generate_output(x3, heir_clust, use_gpu, out_dir, fname_begin + testing_output, testing_mse, output_subset_count, (not use_gpu_pre))
+            transform=transform,  subset=subset_count, reducer = reducer)
+        generate_output(x3, heir_clust, use_gpu, out_dir, fname_begin + testing_output, testing_mse, output_subset_count, (not use_gpu_pre), write_input)
     
  
     x2 = None
@@ -327,93 +340,54 @@ def run_dbn(yml_conf):
             x2 = DBNDataset()
             x2.read_and_preprocess_data([data_train[t]], read_func, data_reader_kwargs, pixel_padding, delete_chans=delete_chans, valid_min=valid_min, \
                valid_max=valid_max, fill_value =fill, chan_dim = chan_dim, transform_chans=transform_chans, transform_values=transform_values, \
-               scaler = scaler, scale = scale_data, transform=numpy_to_torch, subset=subset_count)
-            generate_output(x2, heir_clust, use_gpu, out_dir, fname_begin + training_output, training_mse, output_subset_count, (not use_gpu_pre))
+               scaler = scaler, scale = scale_data, transform=numpy_to_torch, subset=subset_count, reducer = reducer)
+            generate_output(x2, heir_clust, use_gpu, out_dir, fname_begin + training_output, training_mse, output_subset_count, (not use_gpu_pre), write_input)
 
-    if "LOCAL_RANK" in os.environ.keys():
-        cleanup_ddp() 
+    cleanup_ddp() 
 
 
 
 
-def generate_output(dat, mdl, use_gpu, out_dir, output_fle, mse_fle, output_subset_count, pin_mem = False):
-    output_full = None
+def generate_output(dat, mdl, use_gpu, out_dir, output_fle, mse_fle, output_subset_count, pin_mem = False, write_input = False):
     count = 0
     dat.current_subset = -1
     dat.next_subset()
 
-    local_rank = 0
-    if "LOCAL_RANK" in os.environ.keys():
-        local_rank = int(os.environ["LOCAL_RANK"])
-    if use_gpu:
-        device = torch.device("cuda:{}".format(local_rank))
-    else:
-        device = torch.device("cpu:{}".format(local_rank))
+    device = get_device(use_gpu)
 
-    ind = 0
+    #Batch outputs are streamed to disk as they are produced (see output_store), so no scene-sized output is held in memory
+    writer = OutputWriter(os.path.join(out_dir, output_fle), dat.data_full.shape[0])
     while(count == 0 or dat.has_next_subset() or (dat.subset > 1 and dat.current_subset > (dat.subset-2))):
-        output_batch_size = min(5000, int(dat.data_full.shape[0] / 5))
-
-        output_sze = dat.data_full.shape[0]
-        append_remainder = int(output_batch_size - (output_sze % output_batch_size))
-
-        if isinstance(dat.data_full,torch.Tensor):
-            dat.data_full = torch.cat((dat.data_full,dat.data_full[0:append_remainder]))
-            dat.targets_full = torch.cat((dat.targets_full,dat.targets_full[0:append_remainder]))
-        else:
-            dat.data_full = np.concatenate((dat.data_full,dat.data_full[0:append_remainder]))
-            dat.targets_full = np.concatenate((dat.targets_full,dat.targets_full[0:append_remainder]))
-
-        dat.current_subset = -1
-        dat.next_subset()
+        output_batch_size = max(1, min(5000, int(dat.data_full.shape[0] / 5)))
 
-        test_loader = DataLoader(dat, batch_size=output_batch_size, shuffle=False, \
-        num_workers = 0, drop_last = False, pin_memory = pin_mem) 
-        ind = 0
-        ind2 = 0 
+        test_loader = batch_loader(dat, None, output_batch_size, num_workers = 0, pin_memory = pin_mem, drop_last = False)
         for data in tqdm(test_loader):
-            dat_dev, lab_dev = data[0].to(device=device, non_blocking=True), data[1].to(device=device, non_blocking=True)
-            dev_ds = TensorDataset(dat_dev, lab_dev)
+            dat_dev = data[0].to(device=device, non_blocking=True)
 
-            output = mdl.forward(dat_dev)  
+            with torch.no_grad():
+                output = mdl.forward(dat_dev)  
             if isinstance(output, list):
                 output = output[0] #TODO improve usage uf multi-headed output after single-headed approach validated
 
-            if use_gpu == True:
-                output = output.detach().cpu()
-            loader = DataLoader(dev_ds, batch_size=output_batch_size, shuffle=False, \
-                num_workers = 0, drop_last = False, pin_memory = False)
-            dat_dev = dat_dev.detach().cpu()
-            lab_dev = lab_dev.detach().cpu()
-            del dev_ds
-
-            if output_full is None:
-                #if not fcn:
-                print(dat.data_full.shape, output.shape)
-                output_full = torch.zeros(dat.data_full.shape[0], 1, dtype=torch.float32)
-                #else:
-                #    output_full = torch.zeros(dat.data_full.shape[0], dat.data_full.shape[1], output.shape[2], dtype=torch.float32)       
-            ind1 = ind2 
-            ind2 += dat_dev.shape[0]
-            if ind2 > output_full.shape[0]:
-                ind2 = output_full.shape[0]
-            output_full[ind1:ind2,:] = output
-            ind = ind + 1
+            #One (hierarchical) label per sample
+            writer.write(output.detach().cpu().reshape(output.shape[0], -1))
             del output
             del dat_dev
-            del lab_dev
-            del loader
         count = count + 1
         if dat.has_next_subset():
             dat.next_subset()
         else:
             break 
     #Save training output
-    print("FILLING OUTPUT", ind1, ind2, torch.unique(output_full), torch.unique(output_full).shape)
     print("SAVING", os.path.join(out_dir, output_fle))
-    torch.save(output_full, os.path.join(out_dir, output_fle), pickle_protocol=pickle.HIGHEST_PROTOCOL)
-    torch.save(dat.targets_full, os.path.join(out_dir, output_fle + ".indices"), pickle_protocol=pickle.HIGHEST_PROTOCOL)
-    torch.save(dat.data_full, os.path.join(out_dir, output_fle + ".input"), pickle_protocol=pickle.HIGHEST_PROTOCOL)
+    writer.close()
+    save_indices(os.path.join(out_dir, output_fle + ".indices"), dat.targets_full)
+    #The (preprocessed) input is only duplicated on request - it can be regenerated from the source files
+    if write_input:
+        save_array(os.path.join(out_dir, output_fle + ".input"), dat.data_full)
+    #Validity of the scene's samples, so rasters can be assembled without rediscovering missing data
+    if len(getattr(dat, "valid_masks", [])) == 1:
+        save_mask(get_mask_filename(os.path.join(out_dir, output_fle)), dat.valid_masks[0])
 
 
 def main(yml_fpath):
@@ -20,8 +20,10 @@ import dask
 import dask.array as da
 
 from utils import read_yaml
+from validity import load_mask, get_mask_filename
+from output_store import load_labels, load_indices
 
-def plot_clusters(coord, labels, output_basename, min_clust, max_clust, pixel_padding = 1):
+def plot_clusters(coord, labels, output_basename, min_clust, max_clust, pixel_padding = 1, valid = None):
 
         n_clusters_local = max_clust - min_clust
 
@@ -33,12 +35,16 @@ def plot_clusters(coord, labels, output_basename, min_clust, max_clust, pixel_pa
  
 
         #1 subtracted to separate No Data from areas that have cluster value 0.
-        data = np.zeros((((int)(max_dim1-strt_dim1)+1+pixel_padding), ((int)(max_dim2-strt_dim2)+pixel_padding+1))) - 1 
+        #With the scene's validity mask, the raster has the scene's full extent
+        if valid is not None:
+            data = np.zeros(valid.shape) - 1
+        else:
+            data = np.zeros((((int)(max_dim1-strt_dim1)+1+pixel_padding), ((int)(max_dim2-strt_dim2)+pixel_padding+1))) - 1 
         labels = np.array(labels)
         print("ASSIGNING LABELS", min_clust, max_clust)
         print(data.shape, labels.shape, coord.shape)
-        for i in range(labels.shape[0]):
-            data[coord[i,1], coord[i,2]] = labels[i]
+        coord = np.asarray(coord)
+        data[coord[:,1], coord[:,2]] = labels
 
         print("FINISHED WITH LABEL ASSIGNMENT")
         print("FINAL DATA TO DASK")
@@ -73,22 +79,16 @@ def main(yml_fpath):
             continue
 
         print(dat[i])
-        data = torch.load(dat[i]).numpy()
-        indices = torch.load(dat[i] + ".indices")
+        #Per-class outputs are reduced to their argmax, compact outputs are read as stored
+        disc_data, max_cluster = load_labels(dat[i])
+        indices = load_indices(dat[i] + ".indices")
 
-        max_cluster = data.shape[1]
         min_cluster = 0
-        if data.shape[1] > 1:
-            max_cluster = data.shape[1]
-            disc_data = np.argmax(data, axis = 1)
-            del data
-        else:
-            disc_data = data.astype(np.int32)
+        if max_cluster is None:
             max_cluster = disc_data.max() #TODO this better!!!
-            del data    
 
         print(np.unique(disc_data).shape, "UNIQUE LABELS")
-        plot_clusters(indices, np.squeeze(disc_data), dat[i], min_cluster, max_cluster)
+        plot_clusters(indices, np.squeeze(disc_data), dat[i], min_cluster, max_cluster, valid = load_mask(get_mask_filename(dat[i])))
 
 
 
@@ -0,0 +1,442 @@
+"""
+Copyright [2022-23], by the California Institute of Technology and Chapman University.
+ALL RIGHTS RESERVED. United States Government Sponsorship acknowledged. Any commercial use must be negotiated with the
+Office of Technology Transfer at the California Institute of Technology and Chapman University.
+This software may be subject to U.S. export control laws. By accepting this software, the user agrees to comply with all
+applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be
+required before exporting such information to foreign countries or providing access to foreign persons.
+"""
+import os
+import re
+from datetime import timedelta
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler, Sampler, IterableDataset
+from torch.utils.data.distributed import DistributedSampler
+from sklearn.preprocessing import StandardScaler, MaxAbsScaler
+
+#Execution backends
+#   single - one process, no process group. Barriers and all-reduces are no-ops, models are not wrapped in DDP.
+#   gloo   - multi-process CPU training (torchrun), can span sockets and nodes.
+#   nccl   - multi-process GPU training (torchrun).
+BACKEND_SINGLE = "single"
+BACKEND_GLOO = "gloo"
+BACKEND_NCCL = "nccl"
+
+
+def get_backend_name(backend = "auto", use_gpu = True):
+    """
+    Resolves the execution backend to use.
+
+    :param backend: One of "auto", "single", "gloo", or "nccl". With "auto", a process launched by torchrun (LOCAL_RANK set) uses nccl if use_gpu is set and CUDA is available, gloo otherwise. Processes not launched via torchrun run single-process.
+    :param use_gpu: Whether or not GPUs are to be used for training.
+
+    :return: Name of the resolved backend.
+    """
+    if backend is None or backend == "auto":
+        if "LOCAL_RANK" not in os.environ.keys():
+            return BACKEND_SINGLE
+        if use_gpu and torch.cuda.is_available():
+            return BACKEND_NCCL
+        return BACKEND_GLOO
+    if backend not in [BACKEND_SINGLE, BACKEND_GLOO, BACKEND_NCCL]:
+        raise ValueError("Unknown execution backend " + str(backend))
+    if backend != BACKEND_SINGLE and "LOCAL_RANK" not in os.environ.keys():
+        raise ValueError("Execution backend " + backend + " requires launching via torchrun")
+    return backend
+
+
+def setup_backend(device_ids = None, use_gpu = True, backend = "auto", timeout = 5400):
+    """
+    Initializes the execution backend. For the gloo backend, intra-op threads are divided among the local ranks
+    so that ranks on the same node do not oversubscribe cores.
+
+    :param device_ids: Optional list of GPU ids to expose via CUDA_VISIBLE_DEVICES (nccl only).
+    :param use_gpu: Whether or not GPUs are to be used for training.
+    :param backend: One of "auto", "single", "gloo", or "nccl". See get_backend_name.
+    :param timeout: Process group timeout, in seconds.
+
+    :return: Name of the backend that was initialized.
+    """
+    backend = get_backend_name(backend, use_gpu)
+    if backend == BACKEND_SINGLE:
+        return backend
+
+    if backend == BACKEND_NCCL and device_ids is not None and len(device_ids) > 0:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ",".join(device_ids)
+    if backend == BACKEND_GLOO:
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        torch.set_num_threads(max(1, os.cpu_count() // local_world_size))
+
+    if not is_distributed():
+        dist.init_process_group(backend, timeout=timedelta(seconds=timeout))
+    if backend == BACKEND_NCCL:
+        torch.cuda.set_device(get_local_rank())
+    return backend
+
+
+def cleanup_backend():
+    """
+    Tears down the process group, if one was initialized.
+    """
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    """
+    :return: Whether or not a process group is initialized.
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    """
+    :return: Global rank of this process (0 when single-process).
+    """
+    if is_distributed():
+        return dist.get_rank()
+    return 0
+
+
+def get_world_size():
+    """
+    :return: Number of processes taking part in training (1 when single-process).
+    """
+    if is_distributed():
+        return dist.get_world_size()
+    return 1
+
+
+def get_local_rank():
+    """
+    :return: Node-local rank of this process (0 when single-process).
+    """
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def get_device(use_gpu = True):
+    """
+    :param use_gpu: Whether or not GPUs are to be used.
+
+    :return: torch.device this process should compute on.
+    """
+    if use_gpu and torch.cuda.is_available():
+        return torch.device("cuda:{}".format(get_local_rank()))
+    return torch.device("cpu")
+
+
+def barrier():
+    """
+    Synchronizes all processes. No-op when single-process.
+    """
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce(tensor, op = None):
+    """
+    In-place all-reduce of a tensor across processes. No-op when single-process.
+
+    :param tensor: Tensor to reduce. Must live on a device supported by the backend (CPU for gloo, CUDA for nccl).
+    :param op: torch.distributed.ReduceOp to apply. Default is SUM.
+
+    :return: The reduced tensor.
+    """
+    if is_distributed():
+        if op is None:
+            op = dist.ReduceOp.SUM
+        dist.all_reduce(tensor, op=op)
+    return tensor
+
+
+def all_gather(tensor):
+    """
+    Gathers a tensor from every process. When single-process, returns a list holding the tensor itself.
+
+    :param tensor: Tensor to gather. Must have the same shape on every process and live on collective_device().
+
+    :return: List of tensors, indexed by rank.
+    """
+    if not is_distributed():
+        return [tensor]
+    gathered = [torch.zeros_like(tensor) for _ in range(get_world_size())]
+    dist.all_gather(gathered, tensor)
+    return gathered
+
+
+def collective_device():
+    """
+    :return: Device that tensors passed to collectives must live on for the current backend.
+    """
+    if is_distributed() and dist.get_backend() == BACKEND_NCCL:
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
+def _is_scaler(scaler, cls):
+    #cuML's scalers mirror sklearn's (same names and fitted attributes) but do not subclass them
+    return isinstance(scaler, cls) or (type(scaler).__module__.startswith("cuml") and type(scaler).__name__ == cls.__name__)
+
+
+def _host(arr):
+    #cuML scalers hold their statistics as cupy arrays
+    if hasattr(arr, "get"):
+        return arr.get()
+    return np.asarray(arr)
+
+
+def _like(arr, ref):
+    if type(ref).__module__.startswith("cupy"):
+        import cupy
+        return cupy.asarray(arr)
+    return arr
+
+
+def all_reduce_scaler(scaler, strict = True):
+    """
+    Combines the statistics of a scaler fit (via partial_fit) independently on each rank, so that every rank ends up with
+    the scaler that fitting on the union of all ranks' data would produce. Means and variances are merged with the same
+    pairwise update partial_fit uses. No-op when single-process.
+
+    :param scaler: StandardScaler or MaxAbsScaler (sklearn or cuML).
+    :param strict: Whether or not to raise an error for unsupported scalers. If False, they are left as-is.
+    """
+    if get_world_size() < 2:
+        return
+    if _is_scaler(scaler, MaxAbsScaler):
+        max_abs = torch.as_tensor(_host(scaler.max_abs_), dtype=torch.float64).to(collective_device())
+        n_seen = torch.tensor([int(_host(scaler.n_samples_seen_))], dtype=torch.int64, device=collective_device())
+        all_reduce(max_abs, op=dist.ReduceOp.MAX)
+        all_reduce(n_seen)
+        ref = scaler.max_abs_
+        scaler.max_abs_ = _like(max_abs.cpu().numpy(), ref)
+        scaler.n_samples_seen_ = int(n_seen.item())
+        scale = max_abs.cpu().numpy()
+        scale[scale == 0.0] = 1.0
+        scaler.scale_ = _like(scale, ref)
+        return
+    if not _is_scaler(scaler, StandardScaler):
+        if not strict:
+            return
+        raise ValueError("Cannot combine statistics of scaler " + type(scaler).__name__ + " across ranks")
+
+    n_feat = scaler.n_features_in_
+    n_seen_local = _host(scaler.n_samples_seen_)
+    n_seen = np.broadcast_to(n_seen_local.astype(np.float64), (n_feat,))
+    mean = _host(scaler.mean_) if scaler.mean_ is not None else np.zeros(n_feat)
+    var = _host(scaler.var_) if scaler.var_ is not None else np.zeros(n_feat)
+    local = torch.as_tensor(np.stack((n_seen, mean, var)), dtype=torch.float64).to(collective_device())
+    stats = [t.cpu().numpy() for t in all_gather(local)]
+
+    n_total, mean_total, var_total = stats[0]
+    for n_r, mean_r, var_r in stats[1:]:
+        n_new = n_total + n_r
+        delta = mean_r - mean_total
+        m2 = var_total * n_total + var_r * n_r + delta ** 2 * n_total * n_r / np.maximum(n_new, 1)
+        mean_total = mean_total + delta * n_r / np.maximum(n_new, 1)
+        var_total = m2 / np.maximum(n_new, 1)
+        n_total = n_new
+
+    if np.ndim(n_seen_local) == 0:
+        scaler.n_samples_seen_ = int(n_total[0])
+    else:
+        scaler.n_samples_seen_ = _like(n_total.astype(np.int64), scaler.n_samples_seen_)
+    if scaler.mean_ is not None:
+        scaler.mean_ = _like(mean_total, scaler.mean_)
+    if scaler.var_ is not None:
+        ref = scaler.var_
+        scaler.var_ = _like(var_total, ref)
+        scale = np.sqrt(var_total)
+        scale[scale == 0.0] = 1.0
+        scaler.scale_ = _like(scale, ref)
+
+
+def wrap_ddp(module):
+    """
+    Wraps a module in DistributedDataParallel when a process group is initialized, so gradients are all-reduced
+    across processes. When single-process the module is returned as-is.
+
+    :param module: Module to wrap.
+
+    :return: Wrapped (or original) module.
+    """
+    if not is_distributed():
+        return module
+    if len(list(module.parameters())) == 0:
+        return module
+    if dist.get_backend() == BACKEND_NCCL:
+        local_rank = get_local_rank()
+        return DDP(module, device_ids=[local_rank], output_device=local_rank)
+    return DDP(module)
+
+
+def unwrap(module):
+    """
+    :param module: Module that may or may not be wrapped in DDP.
+
+    :return: The underlying module.
+    """
+    if hasattr(module, "module"):
+        return module.module
+    return module
+
+
+class WeightedDistributedSampler(Sampler):
+    """
+    Draws sample indices with replacement, with probability proportional to per-sample weights, and partitions the draws
+    across ranks. With the multiplicity counts of deduplicated samples as weights, every epoch sees the same data
+    distribution as the original (duplicated) dataset, while drawing only as many samples as there are unique ones.
+    Drop-in for DistributedSampler: call set_epoch every epoch to change the draws.
+    """
+
+    def __init__(self, weights, num_samples = None, num_replicas = None, rank = None, seed = 0, drop_last = False):
+        """
+        :param weights: Non-negative per-sample weights (e.g. multiplicity counts).
+        :param num_samples: Total amount of samples drawn per epoch, across all replicas. Default is len(weights).
+        :param num_replicas: Number of processes the draws are partitioned across. Default is the world size.
+        :param rank: Rank of the current process. Default is the current rank.
+        :param seed: Sampling seed (must be identical across ranks).
+        :param drop_last: Whether or not to drop the tail of the draws to make them evenly divisible across replicas. Otherwise extra samples are drawn.
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        self.p = weights / weights.sum()
+        self.num_replicas = get_world_size() if num_replicas is None else num_replicas
+        self.rank = get_rank() if rank is None else rank
+        self.seed = seed
+        self.epoch = 0
+        if num_samples is None:
+            num_samples = len(weights)
+        if drop_last:
+            self.num_samples = num_samples // self.num_replicas
+        else:
+            self.num_samples = int(np.ceil(num_samples / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.choice(len(self.p), size=self.total_size, replace=True, p=self.p)
+        return iter(indices[self.rank:self.total_size:self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        """
+        :param epoch: Current epoch. Seeds the draws, so all ranks draw the same indices each epoch.
+        """
+        self.epoch = epoch
+
+
+def get_sampler(dataset, shuffle = True, seed = 0, drop_last = False, partition = True):
+    """
+    Builds a sampler that partitions the dataset across processes. Single-process runs get a DistributedSampler over
+    one replica, so the set_epoch/shuffling semantics of training loops are the same for every backend.
+
+    :param dataset: Dataset to sample from.
+    :param shuffle: Whether or not to shuffle each epoch.
+    :param seed: Shuffling seed (must be identical across ranks).
+    :param drop_last: Whether or not to drop the tail of the dataset to make it evenly divisible across replicas.
+    :param partition: Whether or not to partition the dataset across ranks. If False, every rank samples the full dataset (e.g. when ranks train independent models). Datasets flagged as sharded (each rank already holds only its own shard) are never partitioned again.
+
+    :return: A DistributedSampler, or a WeightedDistributedSampler if the dataset carries per-sample weights (sample_weights, see DBNDataset.deduplicate) and shuffle is set.
+    """
+    weights = getattr(dataset, "sample_weights", None)
+    if shuffle and weights is not None:
+        epoch_size = getattr(dataset, "epoch_size", None)
+        if is_distributed() and partition and not getattr(dataset, "sharded", False):
+            return WeightedDistributedSampler(weights, epoch_size, seed=seed, drop_last=drop_last)
+        return WeightedDistributedSampler(weights, epoch_size, num_replicas=1, rank=0, seed=seed, drop_last=drop_last)
+    if is_distributed() and partition and not getattr(dataset, "sharded", False):
+        return DistributedSampler(dataset, shuffle=shuffle, seed=seed, drop_last=drop_last)
+    return DistributedSampler(dataset, num_replicas=1, rank=0, shuffle=shuffle, seed=seed, drop_last=drop_last)
+
+
+def batch_fetch_enabled():
+    """
+    :return: Whether or not DataLoaders fetch whole batches at once (see batch_loader). Controlled via the BATCH_FETCH environment variable, enabled by default.
+    """
+    return bool(int(os.environ.get("BATCH_FETCH", 1)))
+
+
+def batch_loader(dataset, sampler, batch_size, num_workers = 0, pin_memory = False, drop_last = False):
+    """
+    Builds a DataLoader that fetches a whole batch with a single indexing call (dataset[list_of_indices]) instead of
+    one __getitem__ call per sample followed by collation. Batches, their order, and drop_last behaviour are identical
+    to DataLoader(dataset, batch_size, sampler=sampler, drop_last=drop_last), as the same sampler drives both.
+
+    The dataset's __getitem__ must accept a list of indices (tensor-backed datasets, TensorDataset, DBNDataset).
+
+    :param dataset: Dataset to load from.
+    :param sampler: Per-sample index sampler (e.g. a DistributedSampler). Its set_epoch still controls shuffling.
+    :param batch_size: Amount of samples per batch.
+    :param num_workers: Number of DataLoader worker processes. Each worker fetches whole batches.
+    :param pin_memory: Whether or not to use pinned memory.
+    :param drop_last: Whether or not to drop the last, incomplete, batch.
+
+    :return: The DataLoader.
+    """
+    if sampler is None:
+        sampler = SequentialSampler(dataset)
+    return DataLoader(dataset, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last),
+        num_workers = num_workers, pin_memory = pin_memory)
+
+
+def get_loader(dataset, batch_size, shuffle = True, num_workers = 0, pin_memory = False, drop_last = True, partition = True, batched = None):
+    """
+    Builds a DataLoader and its sampler for the current backend.
+
+    :param dataset: Dataset to load from.
+    :param batch_size: Amount of samples per batch.
+    :param shuffle: Whether or not to shuffle each epoch.
+    :param num_workers: Number of DataLoader worker processes.
+    :param pin_memory: Whether or not to use pinned memory.
+    :param drop_last: Whether or not to drop the last, incomplete, batch.
+    :param partition: Whether or not to partition the dataset across ranks. See get_sampler.
+    :param batched: Whether or not to fetch whole batches at once. See batch_loader. If None, batch_fetch_enabled decides.
+
+    :return: The DataLoader and its sampler. Iterable datasets (e.g. DBNDatasetConvCrops) partition and shuffle themselves, and
+        are returned in place of the sampler, as they provide set_epoch.
+    """
+    if isinstance(dataset, IterableDataset):
+        loader = DataLoader(dataset, batch_size=batch_size, num_workers = num_workers, pin_memory = pin_memory,
+            drop_last=drop_last)
+        return loader, dataset
+    sampler = get_sampler(dataset, shuffle=shuffle, partition=partition)
+    if batched is None:
+        batched = batch_fetch_enabled()
+    if batched:
+        loader = batch_loader(dataset, sampler, batch_size, num_workers, pin_memory, drop_last)
+    else:
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False,
+            sampler=sampler, num_workers = num_workers, pin_memory = pin_memory,
+            drop_last=drop_last)
+    return loader, sampler
+
+
+def _strip_ddp(key):
+    return re.sub(r"(^|\.)module\.", r"\1", key)
+
+
+def load_state_dict(module, state_dict):
+    """
+    Loads a state dictionary regardless of whether it was saved from, or is being loaded into, DDP-wrapped modules
+    (whose parameter names carry extra "module." components). Checkpoints written by any backend can thus be
+    reused by any other.
+
+    :param module: Module to load into.
+    :param state_dict: State dictionary to load.
+
+    :return: Result of module.load_state_dict.
+    """
+    own_keys = {}
+    for key in module.state_dict().keys():
+        own_keys[_strip_ddp(key)] = key
+    remapped = {}
+    for key, value in state_dict.items():
+        remapped[own_keys.get(_strip_ddp(key), key)] = value
+    return module.load_state_dict(remapped)
+
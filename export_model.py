@@ -0,0 +1,129 @@
+"""
+Copyright [2022-23], by the California Institute of Technology and Chapman University.
+ALL RIGHTS RESERVED. United States Government Sponsorship acknowledged. Any commercial use must be negotiated with the
+Office of Technology Transfer at the California Institute of Technology and Chapman University.
+This software may be subject to U.S. export control laws. By accepting this software, the user agrees to comply with all
+applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be
+required before exporting such information to foreign countries or providing access to foreign persons.
+"""
+import os
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from joblib import load
+
+from inference_service import build_model, checkpoint_n_visible
+from dist_utils import load_state_dict
+from output_store import load_output
+from utils import read_yaml
+from rbm_models import frozen_graph
+
+
+def load_heir_children(yml_conf, model):
+    """
+    Rebuilds the sub-clusterings of a HeirClust run (see dbn_learnergy_heirarchical.py) on top of a trained ClustDBN.
+
+    :param yml_conf: Configuration of the (trained) run.
+    :param model: Trained ClustDBN (the base clustering).
+
+    :return: Object with the base_clust and clust_tree a HeirClust would have.
+    """
+    from rbm_models.clust_dbn import ClustDBN
+    from rbm_models.heirarchichal_deep_clust import HeirClust
+
+    out_dir = yml_conf["output"]["out_dir"]
+    heir_dict = torch.load(os.path.join(out_dir, "heir_" + yml_conf["output"]["model"] + ".ckpt"), map_location="cpu")
+    clust_tree = {"0": {"-1": model}, "1": {}}
+    for key in heir_dict["1"].keys():
+        child = ClustDBN(model.dbn_trunk, model.input_fc, frozen_graph.HEIR_LABEL_OFFSET, yml_conf["dbn"]["training"]["use_gpu"],
+            load(heir_dict["1"][key]["scaler"]))
+        load_state_dict(child, heir_dict["1"][key]["model"])
+        child.eval()
+        clust_tree["1"][key] = child
+    #HeirClust's constructor labels its training set - only its routing (forward) is needed here
+    heir = SimpleNamespace(base_clust = model, clust_tree = clust_tree)
+    heir.forward = lambda x: HeirClust.forward(heir, x)
+    return heir
+
+
+def load_run_model(yml_conf, heir = False, n_visible = None):
+    """
+    :param yml_conf: Configuration of the (trained) run.
+    :param heir: Whether or not to include the HeirClust sub-clusterings (heir_<model>.ckpt).
+    :param n_visible: Input size, if it cannot be read from the checkpoint.
+
+    :return: The trained DBN, ClustDBN or HeirClust routing (see load_heir_children), in eval mode, its input size and its device.
+    """
+    if "FCDBN" in yml_conf["dbn"]["params"]["model_type"][0]:
+        raise ValueError("Only per-pixel models are supported")
+    out_dir = yml_conf["output"]["out_dir"]
+    model_file = os.path.join(out_dir, yml_conf["output"]["model"])
+    state_dict = torch.load(model_file + ".ckpt", map_location="cpu")
+    fc_state_dict = None
+    clust_scaler = None
+    if yml_conf["dbn"]["deep_cluster"] > 0:
+        fc_state_dict = torch.load(model_file + "_fc_clust.ckpt", map_location="cpu")
+        clust_scaler = load(os.path.join(out_dir, "fc_clust_scaler.pkl"))
+    if n_visible is None:
+        n_visible = checkpoint_n_visible(state_dict)
+    if n_visible is None:
+        raise ValueError("Input size could not be read from the checkpoint, pass it with --n-visible")
+    model = build_model(yml_conf, n_visible, state_dict, fc_state_dict, clust_scaler)
+    if heir:
+        model = load_heir_children(yml_conf, model)
+    device = model.base_clust.dbn_trunk.torch_device if heir else \
+        (model.dbn_trunk.torch_device if hasattr(model, "dbn_trunk") else model.torch_device)
+    return model, n_visible, device
+
+
+def main(yml_fpath, out_fname, fmt, heir, n_visible, input_fname, batch_size, n_iter):
+    #Translate config to dictionary
+    yml_conf = read_yaml(yml_fpath)
+    if out_fname is None:
+        out_fname = os.path.join(yml_conf["output"]["out_dir"], yml_conf["output"]["model"]) + \
+            (".frozen.pt2" if fmt == "export" else ".frozen.pt")
+    model, n_visible, device = load_run_model(yml_conf, heir, n_visible)
+
+    #Preprocessed samples (e.g. an output's .input, see output/write_input), or standard normal samples, as the input
+    #scaler produces
+    if input_fname is not None:
+        data = torch.as_tensor(np.array(load_output(input_fname)), dtype=torch.float32)
+    else:
+        data = torch.randn((batch_size * 4, n_visible), generator=torch.Generator().manual_seed(42))
+    data = data.to(device)
+
+    frozen = frozen_graph.freeze(model, data[0:batch_size], fmt)
+    frozen_graph.save(frozen, out_fname)
+    frozen = frozen_graph.load(out_fname, map_location=device)
+
+    #Batches are offset from, and of a different size than, the one the graph was traced with
+    parity_batch = max(2, batch_size // 2 + 1)
+    batches = [data[i:i+parity_batch] for i in range(1, data.shape[0], parity_batch) if data[i:i+parity_batch].shape[0] > 1]
+    report = {"file": out_fname, "format": fmt, "device": str(device), "parity": frozen_graph.check_parity(model, frozen, batches)}
+    x = data[0:batch_size]
+    report["latency_s"] = {"batch_size": int(x.shape[0]), "eager": frozen_graph.benchmark(model.forward, x, n_iter),
+        "frozen": frozen_graph.benchmark(frozen, x, n_iter)}
+    report["latency_s"]["speedup"] = report["latency_s"]["eager"] / report["latency_s"]["frozen"]
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Freezes the inference graph of a trained run (DBN, scaler, deep clustering "
+        "head and HeirClust routing) to a single TorchScript / torch.export file, and reports its parity with, and latency "
+        "against, the Python model. The frozen graph takes preprocessed (scaled / reduced) float32 samples and returns labels and scores.")
+    parser.add_argument("-y", "--yaml", help="YAML file of the trained run (as passed to dbn_learnergy.py).")
+    parser.add_argument("-o", "--output", default=None, help="Path to write the graph to (default: <out_dir>/<model>.frozen.pt, or .frozen.pt2 for export).")
+    parser.add_argument("-f", "--format", default="torchscript", choices=frozen_graph.FREEZE_FORMATS, help="Format to freeze to.")
+    parser.add_argument("--heir", action="store_true", help="Include the HeirClust sub-clusterings (heir_<model>.ckpt).")
+    parser.add_argument("--n-visible", type=int, default=None, help="Input size, if it cannot be read from the checkpoint.")
+    parser.add_argument("-i", "--input", default=None, help="Preprocessed samples to check parity on (e.g. an output's .input file). "
+        "Defaults to random samples.")
+    parser.add_argument("-b", "--batch-size", type=int, default=1000, help="Batch size of the latency measurements.")
+    parser.add_argument("-n", "--n-iter", type=int, default=50, help="Timed iterations of the latency measurements.")
+    args = parser.parse_args()
+    main(args.yaml, args.output, args.format, args.heir, args.n_visible, args.input, args.batch_size, args.n_iter)
@@ -0,0 +1,227 @@
+"""
+Copyright [2022-23], by the California Institute of Technology and Chapman University.
+ALL RIGHTS RESERVED. United States Government Sponsorship acknowledged. Any commercial use must be negotiated with the
+Office of Technology Transfer at the California Institute of Technology and Chapman University.
+This software may be subject to U.S. export control laws. By accepting this software, the user agrees to comply with all
+applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be
+required before exporting such information to foreign countries or providing access to foreign persons.
+"""
+import os
+import re
+import json
+import time
+import traceback
+
+import torch
+import torch.optim as opt
+from joblib import load
+
+from learnergy.models.deep import DBN
+from rbm_models.clust_dbn import ClustDBN
+from dbn_datasets import DBNDataset
+from dbn_learnergy import generate_output
+from dist_utils import load_state_dict
+from utils import numpy_to_torch, read_yaml, get_read_func
+from telemetry import configure_telemetry
+
+#Job files are claimed by renaming them - <job>.json -> <job>.json.running -> <job>.json.done / <job>.json.failed
+JOB_SUFFIX = ".json"
+
+
+def checkpoint_n_visible(state_dict):
+    """
+    :param state_dict: DBN checkpoint.
+
+    :return: Input size of the DBN (its first RBM layer's weights are n_visible x n_hidden), or None if not recognised.
+    """
+    for key, value in state_dict.items():
+        if re.search(r"(^|\.)0\.(module\.)?W$", key) is not None and value.dim() == 2:
+            return int(value.shape[0])
+    return None
+
+
+def build_model(yml_conf, n_visible, state_dict, fc_state_dict = None, clust_scaler = None):
+    """
+    Builds a trained (per-pixel) DBN, and its deep clustering head if the run has one, for inference.
+
+    :param yml_conf: Configuration of the (trained) run.
+    :param n_visible: Input size.
+    :param state_dict: DBN checkpoint (<model>.ckpt).
+    :param fc_state_dict: Deep clustering head checkpoint (<model>_fc_clust.ckpt), if dbn/deep_cluster > 0.
+    :param clust_scaler: Deep clustering head scaler (fc_clust_scaler.pkl), if dbn/deep_cluster > 0.
+
+    :return: The DBN, or ClustDBN, in eval mode.
+    """
+    params = yml_conf["dbn"]["params"]
+    use_gpu = yml_conf["dbn"]["training"]["use_gpu"]
+    dbn = DBN(model=params["model_type"], n_visible=n_visible, n_hidden=tuple(params["dbn_arch"]),
+        steps=tuple(params["gibbs_steps"]), learning_rate=tuple(params["learning_rate"]), momentum=tuple(params["momentum"]),
+        decay=tuple(params["decay"]), temperature=tuple(params["temp"]), use_gpu=use_gpu)
+    for i in range(len(dbn.models)):
+        if not isinstance(dbn.models[i], torch.nn.MaxPool2d):
+            dbn.models[i]._optimizer = opt.SGD(dbn.models[i].parameters(), lr=params["learning_rate"][i])
+            dbn.models[i].normalize = params["normalize_learnergy"][i]
+            dbn.models[i].batch_normalize = params["batch_normalize"][i]
+    load_state_dict(dbn, state_dict)
+    model = dbn
+    if yml_conf["dbn"]["deep_cluster"] > 0:
+        model = ClustDBN(dbn, params["dbn_arch"][-1], yml_conf["dbn"]["deep_cluster"], use_gpu, clust_scaler)
+        load_state_dict(model.fc, fc_state_dict)
+    model.eval()
+    return model
+
+
+class InferenceService(object):
+    """
+    Long running inference worker. The trained DBN (and deep clustering head), scaler and spectral reducer of a run are
+    loaded once, at start up, and stay resident, so each scene costs its read, preprocessing and forward pass only.
+    Scenes are submitted as job files to a watched directory (see watch / run_job), and run through the
+    dataset -> model -> raster path of dbn_learnergy.generate_output (see output/raster).
+
+    Per-pixel (non fully convolutional) models only.
+    """
+
+    def __init__(self, yml_conf):
+        """
+        :param yml_conf: Configuration of the (trained) run, as passed to dbn_learnergy.run_dbn.
+        """
+        self.out_dir = yml_conf["output"]["out_dir"]
+        self.model_file = os.path.join(self.out_dir, yml_conf["output"]["model"])
+        self.output_subset_count = yml_conf["data"]["output_subset_count"]
+
+        self.read_func = get_read_func(yml_conf["data"]["reader_type"])
+        self.read_kwargs = {"read_func_kwargs": yml_conf["data"]["reader_kwargs"],
+            "pixel_padding": yml_conf["data"]["pixel_padding"], "delete_chans": yml_conf["data"]["delete_chans"],
+            "valid_min": yml_conf["data"]["valid_min"], "valid_max": yml_conf["data"]["valid_max"],
+            "fill_value": yml_conf["data"]["fill_value"], "chan_dim": yml_conf["data"]["chan_dim"],
+            "transform_chans": yml_conf["data"]["transform_default"]["chans"],
+            "transform_values": yml_conf["data"]["transform_default"]["transform"],
+            "scale": yml_conf["data"]["scale_data"], "subset": yml_conf["data"]["subset_count"]}
+
+        self.yml_conf = yml_conf
+        if "FCDBN" in yml_conf["dbn"]["params"]["model_type"][0]:
+            raise ValueError("The inference service runs per-pixel models only")
+        self.auto_clust = yml_conf["dbn"]["deep_cluster"]
+        self.use_gpu = yml_conf["dbn"]["training"]["use_gpu"]
+        self.use_gpu_pre = yml_conf["dbn"]["training"]["use_gpu_preprocessing"]
+
+        self.raster = {"format": "tif"}
+        if "raster" in yml_conf["output"] and isinstance(yml_conf["output"]["raster"], dict):
+            self.raster["format"] = yml_conf["output"]["raster"].get("format", "tif")
+
+        self.telemetry = configure_telemetry(self.out_dir)
+        self.telemetry.start("service_start")
+        self.scaler = load(os.path.join(self.out_dir, "dbn_scaler.pkl"))
+        self.reducer = None
+        if os.path.exists(os.path.join(self.out_dir, "dbn_reducer.pkl")):
+            self.reducer = load(os.path.join(self.out_dir, "dbn_reducer.pkl"))
+        self.clust_scaler = None
+        if self.auto_clust > 0:
+            self.clust_scaler = load(os.path.join(self.out_dir, "fc_clust_scaler.pkl"))
+        self.state_dict = torch.load(self.model_file + ".ckpt", map_location="cpu")
+        self.fc_state_dict = None
+        if self.auto_clust > 0:
+            self.fc_state_dict = torch.load(self.model_file + "_fc_clust.ckpt", map_location="cpu")
+        #The model is built as soon as its input size is known - from the checkpoint if possible, else from the first scene
+        self.model = None
+        n_visible = checkpoint_n_visible(self.state_dict)
+        if n_visible is not None:
+            self.__build_model__(n_visible)
+        self.telemetry.stop("service_start")
+
+    def __build_model__(self, n_visible):
+        self.model = build_model(self.yml_conf, n_visible, self.state_dict, self.fc_state_dict, self.clust_scaler)
+
+    def run_job(self, job):
+        """
+        Runs one scene through the resident model.
+
+        :param job: Dictionary with files (scene, as an entry of data/files_test) and, optionally, geo_reference (GeoTIFF
+            the raster is georeferenced from), out_dir (defaults to the run's) and name (output name, defaults to the scene's).
+
+        :return: Dictionary with the raster's path and the job's timings.
+        """
+        fbase = job["files"]
+        while isinstance(fbase, list):
+            fbase = fbase[0]
+        out_dir = job.get("out_dir", self.out_dir)
+        os.makedirs(out_dir, exist_ok=True)
+        name = job.get("name", os.path.basename(fbase) + ".clustoutput.data")
+
+        start = time.perf_counter()
+        self.telemetry.start("job_read")
+        dat = DBNDataset()
+        dat.read_and_preprocess_data([job["files"]], self.read_func, scaler = self.scaler, transform = numpy_to_torch,
+            reducer = self.reducer, **self.read_kwargs)
+        read = self.telemetry.stop("job_read", dat.data_full.shape[0], file = fbase)
+        if self.model is None:
+            self.__build_model__(dat.data_full.shape[1])
+
+        self.telemetry.start("job_infer")
+        raster = {"format": self.raster["format"], "geo_reference": job.get("geo_reference")}
+        generate_output(dat, self.model, self.use_gpu, out_dir, name, None, self.output_subset_count, (not self.use_gpu_pre),
+            raster = raster)
+        infer = self.telemetry.stop("job_infer", dat.data_full.shape[0], file = fbase)
+        return {"file": fbase, "out_dir": out_dir, "name": name, "n_samples": int(dat.data_full.shape[0]),
+            "wall_time_s": time.perf_counter() - start, "read": read, "infer": infer}
+
+    def watch(self, job_dir, poll_interval = 1.0, max_jobs = None):
+        """
+        Runs job files (JSON, see run_job) as they appear in job_dir, oldest first. Each job's result (or error) is
+        written next to it, as <job>.json.done (or <job>.json.failed). Submit jobs atomically - write them under
+        another name (e.g. <job>.tmp) and rename them to <job>.json.
+
+        :param job_dir: Directory to watch.
+        :param poll_interval: Seconds between checks for new jobs.
+        :param max_jobs: Optional number of jobs after which to return. If None, runs until interrupted.
+        """
+        os.makedirs(job_dir, exist_ok=True)
+        n_jobs = 0
+        while max_jobs is None or n_jobs < max_jobs:
+            jobs = [os.path.join(job_dir, f) for f in os.listdir(job_dir) if f.endswith(JOB_SUFFIX)]
+            if len(jobs) == 0:
+                time.sleep(poll_interval)
+                continue
+            running = None
+            try:
+                fname = min(jobs, key = os.path.getmtime)
+                running = fname + ".running"
+                os.rename(fname, running)
+            except OSError:
+                #Claimed by another worker
+                continue
+            try:
+                with open(running, "r") as f:
+                    result = self.run_job(json.load(f))
+                status = ".done"
+                print("DONE", fname, result["wall_time_s"])
+            except Exception as e:
+                result = {"error": repr(e), "traceback": traceback.format_exc()}
+                self.telemetry.abort()
+                status = ".failed"
+                print("FAILED", fname, repr(e))
+            with open(fname + status, "w") as f:
+                json.dump(result, f, indent=2)
+            os.remove(running)
+            n_jobs = n_jobs + 1
+
+
+def main(yml_fpath, job_dir, poll_interval, max_jobs):
+    #Translate config to dictionary
+    yml_conf = read_yaml(yml_fpath)
+    service = InferenceService(yml_conf)
+    print("READY", job_dir)
+    service.watch(job_dir, poll_interval, max_jobs)
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Keeps a trained DBN resident and runs scenes submitted as JSON job files "
+        "({\"files\": ..., \"geo_reference\": ...}) to a directory through it, straight to label rasters.")
+    parser.add_argument("-y", "--yaml", help="YAML file of the trained run (as passed to dbn_learnergy.py).")
+    parser.add_argument("-j", "--jobs", help="Directory to watch for job files.")
+    parser.add_argument("-p", "--poll", type=float, default=1.0, help="Seconds between checks for new jobs.")
+    parser.add_argument("-n", "--max-jobs", type=int, default=None, help="Exit after this many jobs (default: run until interrupted).")
+    args = parser.parse_args()
+    main(args.yaml, args.jobs, args.poll, args.max_jobs)
@@ -0,0 +1,301 @@
+"""
+Copyright [2022-23], by the California Institute of Technology and Chapman University.
+ALL RIGHTS RESERVED. United States Government Sponsorship acknowledged. Any commercial use must be negotiated with the
+Office of Technology Transfer at the California Institute of Technology and Chapman University.
+This software may be subject to U.S. export control laws. By accepting this software, the user agrees to comply with all
+applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be
+required before exporting such information to foreign countries or providing access to foreign persons.
+"""
+import os
+import json
+
+import numpy as np
+import dask.array as da
+import torch
+
+#Outputs are written in the .npy format under their usual names (no .npy extension). Outputs written with torch.save by
+#earlier versions are still read by load_output / load_indices.
+NPY_MAGIC = b"\x93NUMPY"
+
+
+def _to_numpy(arr):
+    if isinstance(arr, torch.Tensor):
+        return arr.detach().cpu().numpy()
+    return np.asarray(arr)
+
+
+def is_npy(fname):
+    """
+    :param fname: Path to an output file.
+
+    :return: Whether or not the file is in the .npy format (rather than a torch.save pickle).
+    """
+    with open(fname, "rb") as f:
+        return f.read(len(NPY_MAGIC)) == NPY_MAGIC
+
+
+class OutputWriter(object):
+    """
+    Streams per-sample outputs to a .npy file as batches are produced, so only one batch is held in memory at a time.
+    The header is written with the first batch (which fixes the per-sample shape); batches are appended in order.
+    """
+
+    def __init__(self, fname, n_samples, dtype = np.float32):
+        """
+        :param fname: Path to write to.
+        :param n_samples: Total number of samples (rows) that will be written.
+        :param dtype: Type outputs are stored as.
+        """
+        self.fname = fname
+        self.n_samples = n_samples
+        self.dtype = np.dtype(dtype)
+        self.n_written = 0
+        self.f = None
+
+    def write(self, batch):
+        """
+        :param batch: Outputs of the next batch of samples (tensor or array, samples first). Rows past n_samples are dropped.
+        """
+        batch = _to_numpy(batch)
+        if self.f is None:
+            self.f = open(self.fname, "wb")
+            np.lib.format.write_array_header_1_0(self.f, {"descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": False, "shape": (self.n_samples,) + tuple(batch.shape[1:])})
+        batch = batch[:self.n_samples - self.n_written]
+        self.f.write(np.ascontiguousarray(batch, dtype=self.dtype).tobytes())
+        self.n_written = self.n_written + batch.shape[0]
+
+    def close(self):
+        """
+        Finishes the file. Raises a ValueError if fewer than n_samples rows were written.
+        """
+        if self.f is None:
+            raise ValueError("No outputs were written to " + self.fname)
+        self.f.close()
+        self.f = None
+        if self.n_written != self.n_samples:
+            raise ValueError("Wrote " + str(self.n_written) + " of " + str(self.n_samples) + " samples to " + self.fname)
+
+
+def label_dtype(n_classes):
+    """
+    :param n_classes: Number of classes.
+
+    :return: Smallest unsigned integer type (uint8 or uint16) that holds class labels 0 to n_classes - 1.
+    """
+    if n_classes <= 256:
+        return np.uint8
+    if n_classes <= 65536:
+        return np.uint16
+    raise ValueError("Compact outputs support at most 65536 classes, got " + str(n_classes))
+
+
+def get_meta_filename(output_filename):
+    """
+    :param output_filename: Path to per-sample output.
+
+    :return: Path the output's metadata (written for compact outputs) is stored at.
+    """
+    return output_filename + ".meta.json"
+
+
+def load_meta(fname):
+    """
+    :param fname: Path to per-sample output.
+
+    :return: The output's metadata, or None if it has none (full, per-class, outputs).
+    """
+    meta_fname = get_meta_filename(fname)
+    if not os.path.exists(meta_fname):
+        return None
+    with open(meta_fname, "r") as f:
+        return json.load(f)
+
+
+class CompactOutputWriter(object):
+    """
+    Writes class scores (samples first, classes second) compactly: the argmax label of each sample (uint8 / uint16) under
+    the output's name and, optionally, the top_k scores (float16) and their classes (<output>.topk_scores / .topk_classes)
+    and / or the maximum score (float16, <output>.confidence). Reductions run on the scores' device, so only the
+    reduced planes are transferred to the host. Same interface as OutputWriter.
+    """
+
+    def __init__(self, fname, n_samples, top_k = 0, confidence = False):
+        """
+        :param fname: Path to write the labels to. Other planes are written alongside.
+        :param n_samples: Total number of samples (rows) that will be written.
+        :param top_k: Number of highest scores (and their classes) to keep per sample. 0 keeps none.
+        :param confidence: Whether or not to keep the maximum score of each sample.
+        """
+        self.fname = fname
+        self.n_samples = n_samples
+        self.top_k = top_k
+        self.confidence = confidence
+        self.n_classes = None
+        self.writers = None
+
+    def write(self, batch):
+        """
+        :param batch: Class scores of the next batch of samples (tensor, samples x classes x ...).
+        """
+        if self.writers is None:
+            self.n_classes = int(batch.shape[1])
+            dtype = label_dtype(self.n_classes)
+            self.writers = {"labels": OutputWriter(self.fname, self.n_samples, dtype)}
+            if self.top_k > 0:
+                self.top_k = min(self.top_k, self.n_classes)
+                self.writers["topk_scores"] = OutputWriter(self.fname + ".topk_scores", self.n_samples, np.float16)
+                self.writers["topk_classes"] = OutputWriter(self.fname + ".topk_classes", self.n_samples, dtype)
+            if self.confidence:
+                self.writers["confidence"] = OutputWriter(self.fname + ".confidence", self.n_samples, np.float16)
+
+        #uint16 is not supported by every torch op / device, int32 is narrowed on the host
+        index_type = torch.uint8 if self.n_classes <= 256 else torch.int32
+        if self.top_k > 0:
+            scores, classes = torch.topk(batch, self.top_k, dim=1)
+            self.writers["labels"].write(classes.select(1, 0).to(index_type).cpu())
+            self.writers["topk_scores"].write(scores.half().cpu())
+            self.writers["topk_classes"].write(classes.to(index_type).cpu())
+            if self.confidence:
+                self.writers["confidence"].write(scores.select(1, 0).half().cpu())
+            return
+        if self.confidence:
+            scores, labels = torch.max(batch, dim=1)
+            self.writers["confidence"].write(scores.half().cpu())
+        else:
+            labels = torch.argmax(batch, dim=1)
+        self.writers["labels"].write(labels.to(index_type).cpu())
+
+    def close(self):
+        """
+        Finishes all planes and writes the output's metadata (see load_meta).
+        """
+        if self.writers is None:
+            raise ValueError("No outputs were written to " + self.fname)
+        for writer in self.writers.values():
+            writer.close()
+        with open(get_meta_filename(self.fname), "w") as f:
+            json.dump({"format": "compact", "n_classes": self.n_classes, "top_k": self.top_k,
+                "confidence": self.confidence}, f, indent=2)
+
+
+def get_output_writer(fname, n_samples, compact = None):
+    """
+    :param fname: Path to write outputs to.
+    :param n_samples: Total number of samples (rows) that will be written.
+    :param compact: Optional dictionary with top_k and confidence (see CompactOutputWriter). If None, outputs are written in full.
+
+    :return: OutputWriter or CompactOutputWriter.
+    """
+    if compact is not None:
+        return CompactOutputWriter(fname, n_samples, int(compact.get("top_k", 0)), bool(compact.get("confidence", False)))
+    #Metadata left by an earlier compact run would mark the full output as compact
+    if os.path.exists(get_meta_filename(fname)):
+        os.remove(get_meta_filename(fname))
+    return OutputWriter(fname, n_samples)
+
+
+def save_array(fname, arr):
+    """
+    Writes an array in the .npy format to exactly fname (np.save would append .npy).
+
+    :param fname: Path to write to.
+    :param arr: Array or tensor.
+    """
+    with open(fname, "wb") as f:
+        np.save(f, _to_numpy(arr))
+
+
+def save_indices(fname, indices):
+    """
+    Writes sample indices (e.g. a dataset's targets_full) once, in the smallest integer type that holds them.
+
+    :param fname: Path to write to.
+    :param indices: Integer array or tensor.
+    """
+    indices = _to_numpy(indices)
+    if indices.size > 0:
+        indices = indices.astype(np.promote_types(np.min_scalar_type(indices.min()), np.min_scalar_type(indices.max())))
+    save_array(fname, indices)
+
+
+def load_output(fname, mmap = True):
+    """
+    :param fname: Output written by OutputWriter / save_array, or by torch.save.
+    :param mmap: Whether or not to memory map .npy outputs rather than reading them into memory.
+
+    :return: Output as a numpy array.
+    """
+    if is_npy(fname):
+        return np.load(fname, mmap_mode = "r" if mmap else None)
+    return _to_numpy(torch.load(fname))
+
+
+def load_indices(fname, dtype = np.int64):
+    """
+    :param fname: Indices written by save_indices, or by torch.save.
+    :param dtype: Integer type to return indices as (None keeps the stored type).
+
+    :return: Indices as a numpy array.
+    """
+    indices = load_output(fname, mmap = False)
+    if dtype is not None:
+        indices = indices.astype(dtype, copy = False)
+    return indices
+
+
+def load_labels(fname):
+    """
+    :param fname: Output written by OutputWriter, CompactOutputWriter or torch.save.
+
+    :return: Class label of each sample and the number of classes (None if the output does not record it, e.g. outputs
+        that are already single labels).
+    """
+    meta = load_meta(fname)
+    if meta is not None and meta["format"] == "compact":
+        return load_output(fname), meta["n_classes"]
+    data = load_output(fname)
+    if data.ndim > 1 and data.shape[1] > 1:
+        return np.argmax(data, axis = 1), data.shape[1]
+    return np.squeeze(data).astype(np.int32), None
+
+
+def _densify(scores, classes, n_classes):
+    dense = np.zeros((scores.shape[0], n_classes), dtype=np.float32)
+    np.put_along_axis(dense, classes.astype(np.int64), scores.astype(np.float32), axis=1)
+    return dense
+
+
+def load_features(fname, chunks):
+    """
+    :param fname: Output written by OutputWriter, CompactOutputWriter or torch.save.
+    :param chunks: Dask chunk size.
+
+    :return: Per-sample features as a (lazy) dask array. Compact outputs are expanded to n_classes columns: the kept
+        top_k scores (or the confidence / 1 at the label, without them) and zeros elsewhere.
+    """
+    meta = load_meta(fname)
+    if meta is None or meta["format"] != "compact":
+        return da.from_array(load_output(fname), chunks=chunks)
+    if meta["top_k"] > 0:
+        scores = da.from_array(load_output(fname + ".topk_scores"), chunks=(chunks, -1))
+        classes = da.from_array(load_output(fname + ".topk_classes"), chunks=(chunks, -1))
+    else:
+        classes = da.from_array(load_output(fname), chunks=chunks)[:,None]
+        if meta["confidence"]:
+            scores = da.from_array(load_output(fname + ".confidence"), chunks=chunks)[:,None]
+        else:
+            scores = da.ones(classes.shape, dtype=np.float16, chunks=classes.chunks)
+    return da.map_blocks(_densify, scores, classes, meta["n_classes"], dtype=np.float32,
+        chunks=(scores.chunks[0], (meta["n_classes"],)))
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Prints the shape and type of output files (either format).")
+    parser.add_argument("files", nargs="+", help="Output, .indices or .input files.")
+    args = parser.parse_args()
+    for fname in args.files:
+        arr = load_output(fname)
+        print(fname, "npy" if is_npy(fname) else "torch", arr.shape, arr.dtype)
@@ -0,0 +1,73 @@
+"""
+Copyright [2022-23], by the California Institute of Technology and Chapman University.
+ALL RIGHTS RESERVED. United States Government Sponsorship acknowledged. Any commercial use must be negotiated with the
+Office of Technology Transfer at the California Institute of Technology and Chapman University.
+This software may be subject to U.S. export control laws. By accepting this software, the user agrees to comply with all
+applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be
+required before exporting such information to foreign countries or providing access to foreign persons.
+"""
+import os
+import json
+
+import numpy as np
+import torch
+
+from export_model import load_run_model
+from output_store import load_output
+from utils import read_yaml
+from rbm_models.quantize import calibrate, throughput_per_core
+
+
+def sample_rows(data, n_samples, seed = 42):
+    """
+    :param data: Samples (array or tensor, samples first).
+    :param n_samples: Number of samples to draw. All are kept if there are fewer.
+    :param seed: Random seed.
+
+    :return: Random subset of the samples (in their original order), as a float32 tensor.
+    """
+    if n_samples is not None and data.shape[0] > n_samples:
+        inds = np.sort(np.random.default_rng(seed).choice(data.shape[0], n_samples, replace = False))
+        data = data[inds]
+    return torch.as_tensor(np.asarray(data), dtype=torch.float32)
+
+
+def main(yml_fpath, input_fname, heir, n_visible, n_samples, threshold, threads, batch_size, out_fname):
+    #Translate config to dictionary
+    yml_conf = read_yaml(yml_fpath)
+    if out_fname is None:
+        out_fname = os.path.join(yml_conf["output"]["out_dir"], "quantization_report.json")
+    model, n_visible, device = load_run_model(yml_conf, heir, n_visible)
+    if torch.device(device).type != "cpu":
+        raise ValueError("Dynamic quantization runs on the CPU only - set dbn/training/use_gpu to False")
+
+    calibration = sample_rows(load_output(input_fname), n_samples)
+    quantized, report = calibrate(model, calibration, threshold)
+    x = calibration[0:batch_size]
+    report["throughput_per_core"] = {"fp32": throughput_per_core(model.forward, x, threads),
+        "int8": throughput_per_core(quantized, x, threads)}
+    with open(out_fname, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({key: report[key] for key in ["n_samples", "label_agreement", "threshold", "accepted",
+        "quantized_rbm_layers", "throughput_per_core"]}, indent=2))
+    return report
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Quantizes (int8, dynamic, CPU) a trained run's DBN and deep clustering head(s), "
+        "and reports label, per-class and confusion agreement with the fp32 model on a sample of training data, "
+        "and the throughput per core of both.")
+    parser.add_argument("-y", "--yaml", help="YAML file of the trained run (as passed to dbn_learnergy.py).")
+    parser.add_argument("-i", "--input", help="Preprocessed training samples (e.g. an output's .input file, see output/write_input).")
+    parser.add_argument("--heir", action="store_true", help="Include the HeirClust sub-clusterings (heir_<model>.ckpt).")
+    parser.add_argument("--n-visible", type=int, default=None, help="Input size, if it cannot be read from the checkpoint.")
+    parser.add_argument("-s", "--samples", type=int, default=20000, help="Number of samples to calibrate on.")
+    parser.add_argument("-t", "--threshold", type=float, default=0.99, help="Label agreement required to accept the quantized model.")
+    parser.add_argument("--threads", type=int, nargs="+", default=None, help="Thread counts to measure throughput at "
+        "(default: 1 and all available cores).")
+    parser.add_argument("-b", "--batch-size", type=int, default=5000, help="Batch size of the throughput measurements.")
+    parser.add_argument("-o", "--output", default=None, help="Path to write the report to (default: <out_dir>/quantization_report.json).")
+    args = parser.parse_args()
+    main(args.yaml, args.input, args.heir, args.n_visible, args.samples, args.threshold, args.threads, args.batch_size, args.output)
@@ -0,0 +1,122 @@
+"""
+Copyright [2022-23], by the California Institute of Technology and Chapman University.
+ALL RIGHTS RESERVED. United States Government Sponsorship acknowledged. Any commercial use must be negotiated with the
+Office of Technology Transfer at the California Institute of Technology and Chapman University.
+This software may be subject to U.S. export control laws. By accepting this software, the user agrees to comply with all
+applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be
+required before exporting such information to foreign countries or providing access to foreign persons.
+"""
+import numpy as np
+import torch
+
+#Raster formats labels can be written to
+RASTER_FORMATS = ["tif", "zarr"]
+
+#Value of raster pixels without a label (No Data), as in discretize_clusters
+NO_LABEL = -1
+
+
+def raster_shape(coords, pixel_padding = 0, valid = None):
+    """
+    :param coords: Sample indices (N x 3: file, row, column), e.g. a dataset's targets_full.
+    :param pixel_padding: Neighborhood padding of the samples. Only used without a validity mask.
+    :param valid: Optional per-pixel validity mask of the scene, which gives its full extent.
+
+    :return: Shape of the label raster, as assembled by discretize_clusters.plot_clusters.
+    """
+    if valid is not None:
+        return tuple(valid.shape)
+    coords = np.asarray(coords)
+    return (int(coords[:,1].max()) + 1 + pixel_padding, int(coords[:,2].max()) + 1 + pixel_padding)
+
+
+class RasterWriter(object):
+    """
+    Scatters per-sample labels into a 2-D raster as batches are produced, then writes it as a GeoTIFF (georeferenced when
+    a reference GeoTIFF of the scene is given) or zarr. Scores (samples x classes) are reduced to labels on their device,
+    so only labels and coordinates reach the host, and no per-sample intermediate files are written.
+    """
+
+    def __init__(self, fname, shape, fmt = "tif", geo_reference = None):
+        """
+        :param fname: Output path, without the cluster count and extension (as passed to discretize_clusters.plot_clusters).
+        :param shape: Raster shape (see raster_shape).
+        :param fmt: One of RASTER_FORMATS.
+        :param geo_reference: Optional GeoTIFF of the scene whose geotransform, projection and metadata are copied.
+        """
+        if fmt not in RASTER_FORMATS:
+            raise ValueError("Unknown raster format " + str(fmt) + ", expected one of " + ", ".join(RASTER_FORMATS))
+        self.fname = fname
+        self.shape = tuple(shape)
+        self.fmt = fmt
+        self.geo_reference = geo_reference
+        self.n_classes = None
+        self.data = None
+
+    def write(self, batch, coords):
+        """
+        :param batch: Model outputs of the next batch of samples (tensor): class scores (samples x classes) or labels (samples x 1).
+        :param coords: Indices of the batch's samples (file, row, column).
+        """
+        if self.data is None:
+            self.n_classes = int(batch.shape[1]) if batch.shape[1] > 1 else None
+            #Labels are shifted to start at 0 and No Data is -1, so the narrowest signed type that fits is used
+            dtype = np.int16 if self.n_classes is not None and self.n_classes < np.iinfo(np.int16).max else np.int32
+            self.data = np.full(self.shape, NO_LABEL, dtype=dtype)
+        if batch.shape[1] > 1:
+            labels = torch.argmax(batch, dim=1)
+        else:
+            labels = batch.reshape(-1)
+        labels = labels.to(torch.int32).cpu().numpy()
+        coords = np.asarray(coords)
+        self.data[coords[:,1], coords[:,2]] = labels
+
+    def close(self):
+        """
+        Writes the raster.
+
+        :return: Path written to.
+        """
+        if self.data is None:
+            raise ValueError("No outputs were written to " + self.fname)
+        n_classes = self.n_classes
+        if n_classes is None:
+            n_classes = int(self.data.max()) + 1
+        base = self.fname + "_" + str(n_classes) + "clusters"
+        if self.fmt == "zarr":
+            import zarr
+            fname = base + ".zarr"
+            zarr.save(fname, self.data)
+        else:
+            fname = self.__write_gtiff__(base)
+        self.data = None
+        return fname
+
+    def __write_gtiff__(self, base):
+        from osgeo import gdal
+
+        data = self.data
+        gdal_type = gdal.GDT_Int16 if data.dtype == np.int16 else gdal.GDT_Int32
+        if self.geo_reference is None:
+            fname = base + ".no_geo.tif"
+            out_ds = gdal.GetDriverByName("GTiff").Create(fname, data.shape[1], data.shape[0], 1, gdal_type)
+        else:
+            fname = base + ".full_geo.tif"
+            dat = gdal.Open(self.geo_reference)
+            #As in generate_cluster_geotiffs - the raster covers both the labels and the reference
+            nx = max(data.shape[1], dat.RasterXSize)
+            ny = max(data.shape[0], dat.RasterYSize)
+            if (ny, nx) != data.shape:
+                full = np.full((ny, nx), NO_LABEL, dtype=data.dtype)
+                full[0:data.shape[0], 0:data.shape[1]] = data
+                data = full
+            out_ds = gdal.GetDriverByName("GTiff").Create(fname, nx, ny, 1, gdal_type)
+            out_ds.SetMetadata(dat.GetMetadata())
+            out_ds.SetGeoTransform(dat.GetGeoTransform())
+            out_ds.SetProjection(dat.GetProjection())
+            dat = None
+        out_ds.GetRasterBand(1).SetNoDataValue(NO_LABEL)
+        out_ds.GetRasterBand(1).WriteArray(data)
+        out_ds.FlushCache()
+        out_ds = None
+        return fname
@@ -0,0 +1,146 @@
+"""Materialized activations of frozen lower layers, for greedy layer-wise training.
+"""
+import os
+import shutil
+from typing import Optional, List
+
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from learnergy.utils import logging
+
+from dist_utils import barrier, get_rank, unwrap, batch_loader
+
+logger = logging.get_logger(__name__)
+
+
+class ActivationStore(Dataset):
+    """Disk-backed (memmapped .npy) store of layer activations for every training sample.
+
+    Samples are paged in by the OS as they are accessed, so stores larger than RAM are
+    streamed rather than loaded. `data` and `targets` are tensors sharing memory with
+    the memmaps, so a store can be passed anywhere a DBNDataset is used for training.
+    """
+
+    def __init__(self, path: str):
+
+        self.path = path
+        self.data = torch.from_numpy(np.load(os.path.join(path, "data.npy"), mmap_mode="r+"))
+        self.targets = torch.from_numpy(np.load(os.path.join(path, "targets.npy"), mmap_mode="r+"))
+        self.transform = None
+        #Multiplicity counts of deduplicated training samples, carried over from the source dataset
+        self.sample_weights = None
+        if os.path.exists(os.path.join(path, "weights.npy")):
+            self.sample_weights = np.load(os.path.join(path, "weights.npy"))
+
+    def __len__(self) -> int:
+        return self.data.shape[0]
+
+    def __getitem__(self, idx):
+        return self.data[idx], self.targets[idx]
+
+    def delete(self) -> None:
+        """Releases the memmaps and removes the store from disk."""
+
+        self.data = None
+        self.targets = None
+        if get_rank() == 0:
+            shutil.rmtree(self.path, ignore_errors=True)
+        logger.info("Deleted activation store %s", self.path)
+
+
+def materialize(layers: List[torch.nn.Module], dataset, path: str, batch_size: Optional[int] = 1000,
+    device: Optional[torch.device] = None, dtype: Optional[np.dtype] = np.float32) -> ActivationStore:
+    """Runs every sample of a dataset through a stack of frozen layers once and stores the result.
+
+    Rank 0 computes and writes the store; other ranks wait and then open it. Per-sample weights
+    (see DBNDataset.deduplicate) are stored alongside, so the store is sampled like its source.
+
+    Args:
+        layers: Frozen layers (RBMs, DBNUnetBlocks, or modules with a forward) to apply, in order.
+        dataset: Dataset (or ActivationStore) of layer inputs.
+        path: Directory to write the store to.
+        batch_size: Amount of samples per batch.
+        device: Device the layers live on.
+        dtype: Storage data type of the activations.
+
+    Returns:
+        (ActivationStore): Store of the output of the last layer.
+
+    """
+
+    if get_rank() == 0:
+        logger.info("Materializing activations of %d frozen layer(s) to %s", len(layers), path)
+        os.makedirs(path, exist_ok=True)
+        loader = batch_loader(dataset, None, batch_size)
+        data = None
+        targets = None
+        ind = 0
+        with torch.no_grad():
+            for x_batch, y_batch in tqdm(loader):
+                if device is not None:
+                    x_batch = x_batch.to(device, non_blocking=True)
+                for layer in layers:
+                    x_batch = apply_layer(layer, x_batch)
+                x_batch = x_batch.detach().cpu().numpy()
+                y_batch = np.asarray(y_batch)
+                if data is None:
+                    data = np.lib.format.open_memmap(os.path.join(path, "data.npy"), mode="w+", dtype=dtype,
+                        shape=(len(dataset),) + x_batch.shape[1:])
+                    targets = np.lib.format.open_memmap(os.path.join(path, "targets.npy"), mode="w+",
+                        dtype=y_batch.dtype, shape=(len(dataset),) + y_batch.shape[1:])
+                data[ind:ind+x_batch.shape[0]] = x_batch
+                targets[ind:ind+x_batch.shape[0]] = y_batch
+                ind = ind + x_batch.shape[0]
+        data.flush()
+        targets.flush()
+        if getattr(dataset, "sample_weights", None) is not None:
+            np.save(os.path.join(path, "weights.npy"), np.asarray(dataset.sample_weights))
+        del data, targets
+    barrier()
+    return ActivationStore(path)
+
+
+def apply_layer(layer: torch.nn.Module, x: torch.Tensor) -> torch.Tensor:
+    """Applies one frozen layer the same way greedy training propagates samples upwards
+    (hidden probabilities for RBMs, forward pass otherwise).
+
+    Args:
+        layer: Layer to apply. May be wrapped in DDP.
+        x: Layer input.
+
+    Returns:
+        (torch.Tensor): Layer output.
+
+    """
+
+    layer = unwrap(layer)
+    if hasattr(layer, "hidden_sampling"):
+        x, _ = layer.hidden_sampling(x)
+        return x
+    x = layer(x)
+    if isinstance(x, tuple):
+        x = x[0]
+    return x
+
+
+def get_cache_dir(conf, out_dir: str) -> Optional[str]:
+    """Resolves the `activation_cache` training option.
+
+    Args:
+        conf: True (cache under out_dir/activation_cache), a directory path, or False/None (disabled).
+        out_dir: Output directory of the run.
+
+    Returns:
+        (str): Directory to write activation stores to, or None if caching is disabled.
+
+    """
+
+    if conf is None or conf is False:
+        return None
+    if conf is True:
+        return os.path.join(out_dir, "activation_cache")
+    return str(conf)
@@ -20,7 +20,14 @@ import learnergy.utils.exception as e
 from learnergy.models.bernoulli import RBM
 from learnergy.utils import logging
 
-from cuml.preprocessing import MinMaxScaler, StandardScaler
+try:
+    from cuml.preprocessing import MinMaxScaler, StandardScaler
+except ImportError:
+    #CPU-only environments
+    from sklearn.preprocessing import MinMaxScaler, StandardScaler
+
+from rbm_models.convergence import ConvergenceMonitor
+from dist_utils import barrier, all_reduce_scaler
  
 import scipy
 from sys import float_info
@@ -30,6 +37,7 @@ from datetime import timedelta
 
 logger = logging.get_logger(__name__)
 
+SEED = 42
 
 
 
@@ -67,11 +75,30 @@ class ClustDBN(Model):
 
         self.initialize_weights()
 
-    def train_scaler(self, batches):
+    def train_scaler(self, batches, embedded = False):
         for x_batch, _ in tqdm(batches):
             x_batch = x_batch.to(self.dbn_trunk.torch_device, non_blocking = True)
             with torch.no_grad():
-                self.scaler.partial_fit(self.dbn_trunk(x_batch))
+                if embedded:
+                    self.scaler.partial_fit(x_batch)
+                else:
+                    self.scaler.partial_fit(self.dbn_trunk(x_batch))
+
+    def embed(self, x: torch.Tensor) -> torch.Tensor:
+        """Runs the (frozen) DBN trunk over a batch.
+
+        Args:
+            x: An input tensor.
+
+        Returns:
+            (torch.Tensor): Unscaled trunk outputs, i.e. the inputs expected by fit/evaluate with embedded=True.
+
+        """
+        with torch.no_grad():
+            y = self.dbn_trunk(x)
+            if isinstance(y,tuple):
+                y = y[0]
+        return y
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Performs a forward pass over the data.
@@ -118,7 +145,7 @@ class ClustDBN(Model):
         }
         
         dt = numpy_to_torch_dtype_dict[x.dtype]
-        t = torch.from_numpy(x).cuda()
+        t = torch.from_numpy(x).to(self.dbn_trunk.torch_device)
         y = self.dbn_trunk.forward(t)
         if isinstance(y,list) or isinstance(y,tuple):
             y = y[0]
@@ -160,7 +187,7 @@ class ClustDBN(Model):
         }
         
         dt = numpy_to_torch_dtype_dict[x.dtype]
-        t = torch.from_numpy(x).cuda()
+        t = torch.from_numpy(x).to(self.dbn_trunk.torch_device)
         y = self.dbn_trunk.forward(t)
         if isinstance(y,list) or isinstance(y,tuple):
             y = y[0]
@@ -184,9 +211,34 @@ class ClustDBN(Model):
         sampler: Optional[torch.utils.data.distributed.DistributedSampler] = None,
         cluster_gauss_noise_stdev: Optional[int] = 1,
         cluster_lambda: Optional[float] = 1.0,
+        monitor: Optional[ConvergenceMonitor] = None,
+        holdout: Optional[torch.utils.data.DataLoader] = None,
+        embedded: Optional[bool] = False,
+        synchronize: Optional[bool] = True,
     ) -> Tuple[float, float]:
+        """Fits the deep clustering head on top of the (frozen) DBN trunk.
+
+        Args:
+            dataset: A Dataset object containing the training data.
+            batch_size: Amount of samples per batch.
+            epochs: Maximum number of training epochs.
+            batches: DataLoader to be used. If None (default), DataLoader is initialized in function.
+            sampler: DistributedSampler associated with batches, if any.
+            cluster_gauss_noise_stdev: Per-epoch (cycled) standard deviations of the noise used to generate the paired view.
+            cluster_lambda: Entropy weighting of the IID loss.
+            monitor: Optional ConvergenceMonitor. If set, training stops early once the loss stops improving.
+            holdout: Optional DataLoader of held-out samples. If set (with monitor), the held-out IID loss
+                is monitored instead of the training loss.
+            embedded: Whether or not dataset/batches (and holdout) already hold trunk outputs (see embed), in which
+                case the trunk is not re-run. Used to fit several heads from one set of cached embeddings.
+            synchronize: Whether or not to synchronize processes every epoch. Must be False when ranks
+                train independent heads.
+
+        Returns:
+            (int): Zero-based epoch at which training stopped early, or None if all epochs were run.
+
+        """
 
- 
         # Transforming the dataset into training batches
         if batches is None:
            batches = DataLoader(
@@ -199,7 +251,10 @@ class ClustDBN(Model):
 
  
         if self.fit_scaler:
-            self.train_scaler(batches)
+            self.train_scaler(batches, embedded)
+            #Each rank only saw its own partition of the data
+            if synchronize:
+                all_reduce_scaler(self.scaler)
 
         for e in range(epochs):
 
@@ -215,7 +270,8 @@ class ClustDBN(Model):
             ind = 0
             # For every possible batch
             loss = 0
-            dist.barrier()
+            if synchronize:
+                barrier()
             rng = np.random.default_rng(None)
             for x_batch, _ in tqdm(batches): 
                 start_time = time.monotonic()
@@ -233,11 +289,12 @@ class ClustDBN(Model):
                     y = None
                     y2 = None
                     with torch.no_grad():
-                        y = self.dbn_trunk(x_batch)
-                        y2 = self.dbn_trunk(x2)
-                        if isinstance(y,tuple):
-                            y = y[0]
-                            y2 = y2[0]
+                        if embedded:
+                            y = x_batch
+                            y2 = x2
+                        else:
+                            y = self.embed(x_batch)
+                            y2 = self.embed(x2)
                         y = torch.flatten(torch.as_tensor(self.scaler.transform(y), dtype=dt), start_dim = 1)
                         y = y.to(self.dbn_trunk.torch_device, non_blocking = True)
                         y2 = torch.flatten(torch.as_tensor(self.scaler.transform(y2), dtype=dt), start_dim = 1)
@@ -299,6 +356,54 @@ class ClustDBN(Model):
                 end_time = time.monotonic()
 
             logger.info("LOSS: %f", (train_loss/len(batches)))
+            self.dump(loss=(train_loss/len(batches)))
+
+            if monitor is not None:
+                value = train_loss/len(batches)
+                if holdout is not None:
+                    value = self.evaluate(holdout, cluster_gauss_noise_stdev[0], cluster_lambda, embedded)
+                    logger.info("HELD-OUT LOSS: %f", value)
+                if monitor.update(value):
+                    return e
+
+        return None
+
+
+    def evaluate(self, batches, noise_stdev = 0.0, cluster_lambda = 1.0, embedded = False):
+        """Computes the mean IID loss over a set of batches without updating any weights.
+
+        Args:
+            batches: DataLoader (or iterable of (samples, indices) batches) to evaluate on.
+            noise_stdev: Standard deviation of the noise used to generate the paired view.
+            cluster_lambda: Entropy weighting of the IID loss.
+            embedded: Whether or not batches already hold trunk outputs.
+
+        Returns:
+            (float): Mean IID loss per batch.
+
+        """
+        total_loss = 0.0
+        n_batches = 0
+        rng = np.random.default_rng(SEED)
+        with torch.no_grad():
+            for x_batch, _ in batches:
+                x_batch = x_batch.to(self.dbn_trunk.torch_device, non_blocking = True)
+                y = x_batch
+                if not embedded:
+                    y = self.embed(x_batch)
+                y = torch.flatten(torch.as_tensor(self.scaler.transform(y), dtype=x_batch.dtype), start_dim = 1)
+                y = y.to(self.dbn_trunk.torch_device, non_blocking = True)
+                y2 = y
+                if noise_stdev > 0.0:
+                    y2 = y + torch.from_numpy(rng.normal(0,noise_stdev, y.shape)).type(y.dtype).to(y.device)
+                y = self.fc(y)
+                y2 = self.fc(y2)
+                loss = 0
+                for h in range(self.number_heads):
+                    loss = loss + IID_loss(y[h], y2[h], cluster_lambda)[0]
+                total_loss = total_loss + (loss / self.number_heads).item()
+                n_batches = n_batches + 1
+        return total_loss / max(n_batches, 1)
 
 
     def initialize_weights(self):
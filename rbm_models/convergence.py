@@ -0,0 +1,212 @@
+"""Convergence monitoring and early stopping for layer-wise and deep clustering training.
+"""
+from typing import Dict, Optional, Tuple, List, Union
+
+import numpy as np
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import TensorDataset
+
+from learnergy.utils import logging
+
+from dist_utils import all_reduce, collective_device, unwrap
+
+logger = logging.get_logger(__name__)
+
+
+class ConvergenceMonitor(object):
+    """Tracks a per-epoch metric (training MSE, held-out reconstruction error, IID loss, ...)
+    and signals when it has stopped improving.
+
+    An epoch counts as an improvement when the metric drops by more than `rel_tol` relative
+    to the best value seen so far. Training stops once `patience` consecutive epochs
+    have passed without improvement (and at least `min_epochs` have been run).
+    """
+
+    def __init__(self, patience: Optional[int] = 5, rel_tol: Optional[float] = 1e-3,
+        min_epochs: Optional[int] = 1, synchronize: Optional[bool] = True):
+
+        self.patience = patience
+        self.rel_tol = rel_tol
+        self.min_epochs = min_epochs
+        self.synchronize = synchronize
+        self.reset()
+
+    @classmethod
+    def from_config(cls, conf: Optional[dict], synchronize: Optional[bool] = True):
+        """Builds a monitor from the `early_stopping` config sub-dictionary.
+
+        Args:
+            conf: Dictionary with optional keys patience, rel_tol and min_epochs. If None, early stopping is disabled.
+            synchronize: Whether or not stop decisions are made collectively across ranks. Must be False
+                when ranks train independent models.
+
+        Returns:
+            (ConvergenceMonitor): A new monitor, or None if conf is None.
+
+        """
+
+        if conf is None:
+            return None
+        return cls(patience = int(conf.get("patience", 5)), rel_tol = float(conf.get("rel_tol", 1e-3)),
+            min_epochs = int(conf.get("min_epochs", 1)), synchronize = synchronize)
+
+    def reset(self) -> None:
+        """Clears all state so the monitor can be reused for a new layer."""
+
+        self.history = []
+        self.best_value = None
+        self.best_epoch = -1
+        self.wait = 0
+        self.stopped_epoch = None
+
+    def update(self, value: float) -> bool:
+        """Records the metric for the epoch that just finished.
+
+        Args:
+            value: Metric value for the current epoch. Lower is better.
+
+        Returns:
+            (bool): Whether or not training should stop after this epoch.
+
+        """
+
+        value = float(value)
+        epoch = len(self.history)
+        self.history.append(value)
+
+        if self.best_value is None or \
+            (self.best_value - value) > self.rel_tol * max(abs(self.best_value), np.finfo(np.float32).eps):
+            self.best_value = value
+            self.best_epoch = epoch
+            self.wait = 0
+        else:
+            self.wait = self.wait + 1
+
+        stop = self.wait >= self.patience and (epoch + 1) >= self.min_epochs
+        if self.synchronize:
+            stop = sync_stop(stop)
+        if stop:
+            self.stopped_epoch = epoch
+            logger.info("Converged at epoch %d (best %f at epoch %d)", epoch + 1, self.best_value, self.best_epoch + 1)
+        return stop
+
+
+def sync_stop(stop: bool) -> bool:
+    """Makes the stop decision consistent across ranks, so that no rank is left waiting
+    in a collective while the others have moved on to the next layer.
+
+    Args:
+        stop: Local stop decision.
+
+    Returns:
+        (bool): True if any rank decided to stop.
+
+    """
+
+    flag = torch.tensor([int(stop)], dtype=torch.int32, device=collective_device())
+    all_reduce(flag, op=dist.ReduceOp.MAX)
+    return bool(flag.item())
+
+
+def split_holdout(dataset, fraction: float) -> Optional[TensorDataset]:
+    """Carves a held-out set off the tail of an (already shuffled) DBNDataset.
+    The held-out samples are removed from the training data.
+
+    Args:
+        dataset: DBNDataset (or subclass) with data_full and targets_full.
+        fraction: Fraction of samples to hold out. If <= 0, nothing is held out.
+
+    Returns:
+        (TensorDataset): The held-out samples and their indices, or None.
+
+    """
+
+    if fraction is None or fraction <= 0.0:
+        return None
+    n_holdout = int(dataset.data_full.shape[0] * fraction)
+    if n_holdout < 1:
+        return None
+
+    data = dataset.data_full[-n_holdout:]
+    targets = dataset.targets_full[-n_holdout:]
+    if not torch.is_tensor(data):
+        data = torch.from_numpy(np.array(data))
+        targets = torch.from_numpy(np.array(targets))
+    #Reduced-precision storage (see sample_codec) - held-out samples are small, keep them upcast
+    if hasattr(dataset, "decode"):
+        data = dataset.decode(data)
+    holdout = TensorDataset(data, targets)
+
+    dataset.data_full = dataset.data_full[:-n_holdout]
+    dataset.targets_full = dataset.targets_full[:-n_holdout]
+    if getattr(dataset, "counts_full", None) is not None:
+        dataset.counts_full = dataset.counts_full[:-n_holdout]
+    dataset.current_subset = -1
+    dataset.next_subset()
+
+    logger.info("Holding out %d samples for convergence checks", n_holdout)
+    return holdout
+
+
+def holdout_layer_input(lower_layers: List[torch.nn.Module], holdout: TensorDataset, device) -> torch.Tensor:
+    """Propagates held-out samples through the frozen lower layers, producing the visible
+    input of the layer currently being trained.
+
+    Args:
+        lower_layers: Already trained (frozen) RBM layers, in order.
+        holdout: Held-out samples.
+        device: Device the layers live on.
+
+    Returns:
+        (torch.Tensor): Input to the next layer for every held-out sample.
+
+    """
+
+    x = holdout.tensors[0].to(device, non_blocking = True)
+    with torch.no_grad():
+        for layer in lower_layers:
+            x, _ = unwrap(layer).hidden_sampling(x)
+    return x
+
+
+def holdout_reconstruction_mse(model: torch.nn.Module, x: torch.Tensor) -> float:
+    """Held-out reconstruction MSE of a single RBM layer (one up-down pass).
+
+    Args:
+        model: RBM layer.
+        x: Visible input of the layer (see holdout_layer_input).
+
+    Returns:
+        (float): Per-sample summed squared reconstruction error, as in learnergy's reconstruct.
+
+    """
+
+    model = unwrap(model)
+    with torch.no_grad():
+        _, hidden_states = model.hidden_sampling(x)
+        _, visible_states = model.visible_sampling(hidden_states)
+        mse = torch.div(torch.sum(torch.pow(x - visible_states, 2)), x.shape[0])
+    return mse.item()
+
+
+def mark_stop(plt, stopped_epoch: Optional[Union[int, Dict[int, int]]]) -> None:
+    """Marks the epoch training stopped at on the current convergence plot.
+
+    Args:
+        plt: matplotlib.pyplot module (or Axes) currently being drawn on.
+        stopped_epoch: Zero-based epoch at which training stopped, or, for multi-layer DBNUnetBlocks, a dictionary of
+            the block's layer index -> zero-based epoch that layer stopped at (one marker per layer). If None, nothing is drawn.
+
+    """
+
+    if isinstance(stopped_epoch, dict):
+        colors = ["red", "darkorange", "purple"]
+        for n, layer in enumerate(sorted(stopped_epoch.keys())):
+            plt.axvline(x=stopped_epoch[layer] + 1, color=colors[n % len(colors)], linestyle="--",
+                label="early stop (layer " + str(layer) + ")")
+        return
+    if not isinstance(stopped_epoch, (int, np.integer)):
+        return
+    plt.axvline(x=stopped_epoch + 1, color="red", linestyle="--", label="early stop")
@@ -3,12 +3,17 @@
 import numpy as np
 import math
 
-from GPUtil import showUtilization as gpu_usage
+try:
+    from GPUtil import showUtilization as gpu_usage
+except ImportError:
+    #CPU-only environments - nothing to report
+    def gpu_usage():
+        pass
 
 from typing import List, Optional, Tuple, Union
 
 import torch
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import DataLoader, TensorDataset, IterableDataset
 from torch.utils.data.distributed import DistributedSampler
 import torch.distributed as dist
 from tqdm import tqdm
@@ -19,7 +24,13 @@ from learnergy.models.bernoulli import ConvRBM, ConvTransposeRBM
 from learnergy.models.gaussian import GaussianConvRBM, GaussianConvTransposeRBM
 from learnergy.utils import logging
 
+from rbm_models.convergence import ConvergenceMonitor
+from dist_utils import barrier, get_loader, unwrap
+
+from rbm_models.activation_cache import materialize
+
 import copy
+import os
 
 logger = logging.get_logger(__name__)
 
@@ -45,6 +56,87 @@ def get_upsampling_weight(in_channels, out_channels, filter_shape):
 
 
 
+class SobelFeatures(torch.nn.Module):
+    """Fixed (non-trainable) sobel edge features, computed on the fly and prepended to the input channels, so datasets
+    no longer store them.
+
+    Matches skimage.filters.sobel(x, axis=(1,2)) as applied by dbn_datasets_conv.prepare_scene. skimage's n-d sobel also
+    smooths along the channel axis and divides the magnitude by sqrt(3), so the filter is a 3x3x3 convolution over
+    (channel, row, column) rather than a per-channel one. Replicate padding reproduces skimage's reflect mode for a one
+    pixel border. Inputs are already imputed, so invalid pixels contribute their imputed value rather than the fill value.
+    """
+
+    def __init__(self, mean: Optional[List[float]] = None, std: Optional[List[float]] = None):
+        """Initialization method.
+
+        Args:
+            mean: Per-channel means inputs were normalized with (see DBNDatasetConv). If None, inputs are used as-is.
+            std: Per-channel standard deviations inputs were normalized with.
+
+        """
+
+        super(SobelFeatures, self).__init__()
+
+        smooth = torch.tensor([0.25, 0.5, 0.25], dtype=torch.float64)
+        #scipy convolves (flipped kernel), conv3d correlates
+        edge = torch.tensor([-1.0, 0.0, 1.0], dtype=torch.float64)
+        k_row = smooth[:, None, None] * edge[None, :, None] * smooth[None, None, :]
+        k_col = smooth[:, None, None] * smooth[None, :, None] * edge[None, None, :]
+        self.register_buffer("weight", torch.stack((k_row, k_col))[:, None].float())
+
+        if mean is None:
+            self.register_buffer("mean", None)
+            self.register_buffer("std", None)
+        else:
+            self.register_buffer("mean", torch.as_tensor(mean, dtype=torch.float32).reshape(1, -1, 1, 1))
+            self.register_buffer("std", torch.as_tensor(std, dtype=torch.float32).reshape(1, -1, 1, 1))
+
+    def edges(self, x: torch.Tensor) -> torch.Tensor:
+        """Sobel edge magnitude of every channel.
+
+        Args:
+            x: Normalized input (N x C x H x W).
+
+        Returns:
+            (torch.Tensor): Edge magnitude of the unnormalized input (N x C x H x W).
+
+        """
+
+        raw = x
+        if self.mean is not None:
+            raw = x * self.std + self.mean
+        raw = torch.nn.functional.pad(raw.unsqueeze(1).float(), (1, 1, 1, 1, 1, 1), mode="replicate")
+        grad = torch.nn.functional.conv3d(raw, self.weight)
+        return torch.sqrt(torch.sum(grad ** 2, dim=1) / 3.0).to(x.dtype)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Performs a forward pass over the data.
+
+        Args:
+            x: Normalized input (N x C x H x W).
+
+        Returns:
+            (torch.Tensor): Edge magnitudes followed by the input (N x 2C x H x W), as DBNDatasetConv stores them without it.
+
+        """
+
+        return torch.cat((self.edges(x), x), dim=1)
+
+    def hidden_sampling(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Same interface as the RBMs it is stacked in front of, so it can be used as an input layer.
+
+        Args:
+            x: Normalized input (N x C x H x W).
+
+        Returns:
+            (Tuple[torch.Tensor, torch.Tensor]): Features, twice (as probabilities and states).
+
+        """
+
+        h = self.forward(x)
+        return h, h
+
+
 class DBNUnetBlock(Model):
     def __init__(self, model: Optional[str] = "bernoulli",
         visible_shape: Optional[Tuple[int, int]] = (28, 28),
@@ -70,6 +162,7 @@ class DBNUnetBlock(Model):
         self.mse = []
         self.input_layers = input_layers
         self.skip_connection = skip_connection
+        self.stopped_epochs = {}
 
         # Shape of filters
         self.filter_shape = (3,3)
@@ -303,7 +396,9 @@ class DBNUnetBlock(Model):
         epochs: Optional[Tuple[int, ...]] = (10, 10),
         is_distributed: Optional[bool] = False,
         num_loader_workers: Optional[int] = 0,
-        pin_memory: Optional[bool] = False
+        pin_memory: Optional[bool] = False,
+        early_stopping: Optional[dict] = None,
+        cached_input: Optional[bool] = False
     ) -> float:
         """Fits a new DBNUnetBlock model.
 
@@ -314,6 +409,9 @@ class DBNUnetBlock(Model):
             is_distributed: Whether or not implementation is using PyTorch Distributed Data Parallel (DDP)
             num_loader_workers: Number of workers to be used for DataLoader.
             pin_memory: Whether or not to use pinned memory with the DataLoader
+            early_stopping: Optional early stopping configuration (patience, rel_tol, min_epochs) applied per layer.
+            cached_input: Whether or not dataset already holds this block's input (see activation_cache), in which
+                case only the block's own layers are applied to each batch. Not supported for upsampling blocks.
 
         Returns:
             (float): MSE (mean squared error) from the training step.
@@ -327,7 +425,7 @@ class DBNUnetBlock(Model):
 
         # Initializing MSE as a list
         mse = []
-        self.n_samples = dataset.data.shape[0]
+        self.n_samples = len(dataset)
 
         print("PRE TRAIN", str(self.sample))
         gpu_usage()
@@ -337,6 +435,10 @@ class DBNUnetBlock(Model):
         print(epochs)
 
         conv_ind = 0
+        #Layers that are not part of this block are already applied to cached inputs
+        n_prior = 0
+        if cached_input:
+            n_prior = len(self.input_layers)
         print("INPUT_LAYERS1", len(self.input_layers))
         if self.sample == 1:
             #if len(self.input_layers) == 0:
@@ -351,7 +453,7 @@ class DBNUnetBlock(Model):
             logger.info("Fitting layer up")
             self.fit_layer(self.up, dataset, None, epochs[0], batch_size, 0, 
                 self.input_layers.copy(), 
-                mse, num_loader_workers, pin_memory, is_distributed) 
+                mse, num_loader_workers, pin_memory, is_distributed, early_stopping) 
             print("INPUT_LAYERS3", len(self.input_layers))
             #if len(self.input_layers) == 0:
             #    self.input_layers.append([self.up])
@@ -365,7 +467,7 @@ class DBNUnetBlock(Model):
             print("INPUT_LAYERS4.5", len(self.input_layers))
         logger.info("Fitting layer conv1_1")
         self.fit_layer(self.conv1_1, dataset, None, epochs[conv_ind], batch_size, 
-            conv_ind, next_inp, mse, num_loader_workers, pin_memory, is_distributed)
+            conv_ind, next_inp[n_prior:], mse, num_loader_workers, pin_memory, is_distributed, early_stopping)
         print("INPUT_LAYERS5", len(self.input_layers))
         #if len(self.input_layers) == 0:
         #    self.input_layers.append([self.conv1_1])
@@ -378,16 +480,18 @@ class DBNUnetBlock(Model):
         num_loader_workers = 0
         pin_memory = False
 
-        dataset.data = dataset.data.cpu()
-        dataset.targets = dataset.targets.cpu()
-        dataset.data = dataset.data.detach()
-        dataset.targets = dataset.targets.detach()
+        #Streamed datasets (e.g. DBNDatasetConvCrops) hold no data
+        if hasattr(dataset, "data"):
+            dataset.data = dataset.data.cpu()
+            dataset.targets = dataset.targets.cpu()
+            dataset.data = dataset.data.detach()
+            dataset.targets = dataset.targets.detach()
         torch.cuda.empty_cache()
         print("LAYER 1")
         logger.info("Fitting layer conv1_2")
         gpu_usage()
         self.fit_layer(self.conv1_2, dataset, None, epochs[conv_ind+1], batch_size, 
-            conv_ind + 1, self.input_layers.copy(), mse, num_loader_workers, pin_memory, is_distributed)
+            conv_ind + 1, self.input_layers[n_prior:], mse, num_loader_workers, pin_memory, is_distributed, early_stopping)
         #self.input_layers[0].append(self.conv1_2)
         self.input_layers.append(self.conv1_2)
         print("INPUT_LAYERS_LAST",self.input_layers)
@@ -408,7 +512,8 @@ class DBNUnetBlock(Model):
         mse,
         num_loader_workers = 0,
         pin_memory = False,
-        is_distributed = True
+        is_distributed = True,
+        early_stopping = None
     ):
         # For every possible model (ConvRBM)
         logger.info("Fitting layer %d/%d ...", i + 1, self.n_layers)
@@ -416,11 +521,9 @@ class DBNUnetBlock(Model):
 
         loader = None
         sampler = None
-        if is_distributed:
-            sampler = DistributedSampler(dataset, shuffle=True)
-            loader = DataLoader(dataset, batch_size=batch_size, shuffle=False,
-                sampler=sampler, num_workers = num_loader_workers, pin_memory =pin_memory,
-                drop_last=True)
+        #The fork's own loader shuffles by index, which streamed datasets do not support
+        if is_distributed or isinstance(dataset, IterableDataset):
+            loader, sampler = get_loader(dataset, batch_size, num_workers = num_loader_workers, pin_memory = pin_memory)
 
         print("INIT USAGE FIT_LAYER")
         gpu_usage()
@@ -428,7 +531,20 @@ class DBNUnetBlock(Model):
         mods = input_layer
         if len(input_layer) == 0:
             mods = None
-        model_mse = model.fit(dataset, batch_size, epochs, loader, sampler, mods).item()
+        monitor = ConvergenceMonitor.from_config(early_stopping)
+        if monitor is None:
+            model_mse = model.fit(dataset, batch_size, epochs, loader, sampler, mods).item()
+        else:
+            #Train one epoch at a time, so training can stop once the layer's MSE has converged
+            offset = len(model._history.get("mse", []))
+            for ep in range(epochs):
+                if sampler is not None:
+                    sampler.set_epoch(ep)
+                model_mse = model.fit(dataset, batch_size, 1, loader, sampler, mods).item()
+                if monitor.update(model_mse):
+                    break
+            if monitor.stopped_epoch is not None:
+                self.stopped_epochs[i] = offset + monitor.stopped_epoch
 
         print("0 USAGE FIT_LAYER")
         gpu_usage()
@@ -588,7 +704,8 @@ class DBNUnet(Model):
         momentum: Optional[Tuple[float, ...]] = (0.0,),
         decay: Optional[Tuple[float, ...]] = (0.0,),
         sample: Optional[int] = 0,
-        use_gpu: Optional[bool] = False):
+        use_gpu: Optional[bool] = False,
+        sobel: Optional[SobelFeatures] = None):
 
 
         super(DBNUnet, self).__init__(use_gpu=use_gpu)
@@ -601,6 +718,7 @@ class DBNUnet(Model):
         self.visible_shape = visible_shape
         self.current_layer_samples = None
         self.mse = []
+        self.stopped_epochs = {}
 
         # Shape of filters
         self.filter_shape = (3,3)
@@ -642,7 +760,14 @@ class DBNUnet(Model):
         quad = trip*2
         quint = quad*2
 
+        #Sobel features are computed in front of every layer, in_channels counts them
+        self.sobel = sobel
         input_layers = []
+        if self.sobel is not None:
+            self.sobel.to(self.torch_device)
+            input_layers.append(self.sobel)
+        #Skip connections index input_layers, which the sobel layer shifts
+        n_front = len(input_layers)
         self.inConv = DBNUnetBlock(model, self.visible_shape,
             self.n_channels, single, self.steps[0:2], self.lr[0:2],
                 self.momentum[0:2], self.decay[0:2], 0, input_layers, -1, use_gpu)
@@ -674,24 +799,24 @@ class DBNUnet(Model):
         self.dec4 = DBNUnetBlock(model, self.inConv.output_shapes[-1],
             quint, trip, self.steps[10:13], self.lr[10:13],
                 self.momentum[10:13], self.decay[10:13], 2, 
-                    self.enc4.input_layers, 10, use_gpu)
+                    self.enc4.input_layers, 10 + n_front, use_gpu)
 
 
 
         self.dec3 = DBNUnetBlock(model, self.inConv.output_shapes[-1],
             quad, double, self.steps[13:16], self.lr[13:16],
                 self.momentum[13:16], self.decay[13:16], 2, 
-                    self.dec4.input_layers, 7, use_gpu)
+                    self.dec4.input_layers, 7 + n_front, use_gpu)
 
         self.dec2 = DBNUnetBlock(model, self.inConv.output_shapes[-1],
             trip, single, self.steps[16:19], self.lr[16:19],
                 self.momentum[16:19], self.decay[16:19], 2,
-                self.dec3.input_layers, 4, use_gpu)
+                self.dec3.input_layers, 4 + n_front, use_gpu)
 
         self.dec1 = DBNUnetBlock(model, self.inConv.output_shapes[-1],
             double, single, self.steps[19:22], self.lr[19:22],
                 self.momentum[19:22], self.decay[19:22], 2, 
-                self.dec2.input_layers, 1, use_gpu)
+                self.dec2.input_layers, 1 + n_front, use_gpu)
 
         print("HERE", self.dec1.output_shapes[-1], (1,1), self.n_filters, single, 1, 0, self.steps[22], self.lr[22], self.momentum[22], self.decay[22], False, None, use_gpu)
         self.outConv = conv(self.dec1.output_shapes[-1],
@@ -710,7 +835,9 @@ class DBNUnet(Model):
         epochs: Optional[Tuple[int, ...]] = (10, 10),
         is_distributed: Optional[bool] = False,
         num_loader_workers: Optional[int] = 0,
-        pin_memory: Optional[bool] = False
+        pin_memory: Optional[bool] = False,
+        early_stopping: Optional[dict] = None,
+        cache_dir: Optional[str] = None
     ) -> float:
         """Fits a new DBNUnet model.
 
@@ -721,6 +848,10 @@ class DBNUnet(Model):
             is_distributed: Whether or not implementation is using PyTorch Distributed Data Parallel (DDP)
             num_loader_workers: Number of workers to be used for DataLoader.
             pin_memory: Whether or not to use pinned memory with the DataLoader
+            early_stopping: Optional early stopping configuration (patience, rel_tol, min_epochs) applied per layer.
+            cache_dir: Optional directory for activation stores. If set, the input of each encoder block is
+                materialized once from the (frozen) block below it, instead of re-running all lower blocks
+                on every batch. Decoder blocks, which also need skip connections, are trained from the raw data.
 
         Returns:
             (float): MSE (mean squared error) from the training step.
@@ -733,7 +864,7 @@ class DBNUnet(Model):
 
         # Initializing MSE as a list
         mse = []
-        self.n_samples = dataset.data.shape[0]
+        self.n_samples = len(dataset)
 
         print("PRE TRAIN")
         gpu_usage()
@@ -744,19 +875,34 @@ class DBNUnet(Model):
 
         conv_ind = 0
         internal_ind = 0
+        store = None
+        block_input = dataset
         for i in range(len(self.models)):
             if i < len(self.models) - 1:
                 logger.info("Fitting Unet Block " + str(i))
                 increase = 3
                 if i <= 4:
                     increase = 2    
-                err = self.models[i].module.fit(dataset, batch_size, epochs[internal_ind: internal_ind + increase],
-                    is_distributed, num_loader_workers, pin_memory)
+                cached = cache_dir is not None and unwrap(self.models[i]).sample != 2
+                if cached and i > 0:
+                    prev_store = store
+                    layers = [self.models[i-1]]
+                    if i == 1 and self.sobel is not None:
+                        layers = [self.sobel] + layers
+                    store = materialize(layers, block_input, os.path.join(cache_dir, "block_" + str(i)),
+                        batch_size, self.torch_device)
+                    if prev_store is not None:
+                        prev_store.delete()
+                    block_input = store
+                elif not cached and store is not None:
+                    store.delete()
+                    store = None
+                    block_input = dataset
+                err = unwrap(self.models[i]).fit(block_input, batch_size, epochs[internal_ind: internal_ind + increase],
+                    is_distributed, num_loader_workers, pin_memory, early_stopping, cached)
+                self.stopped_epochs[i] = dict(unwrap(self.models[i]).stopped_epochs)
                 if i < len(self.models)-1:
-                    if hasattr(self.models[i+1], "module"):    
-                        self.models[i+1].module.input_layers = self.models[i].module.input_layers.copy()
-                    else:
-                        self.models[i+1].input_layers = self.models[i].input_layers.copy()
+                    unwrap(self.models[i+1]).input_layers = unwrap(self.models[i]).input_layers.copy()
                 mse.extend(err)
                 internal_ind = internal_ind + increase
             else:  
@@ -765,16 +911,25 @@ class DBNUnet(Model):
  
                 loader = None
                 sampler = None
-                if is_distributed:
-                    sampler = DistributedSampler(dataset, shuffle=True)
-                    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False,
-                        sampler=sampler, num_workers = num_loader_workers, pin_memory =pin_memory,
-                        drop_last=True)
+                if is_distributed or isinstance(dataset, IterableDataset):
+                    loader, sampler = get_loader(dataset, batch_size, num_workers = num_loader_workers, pin_memory = pin_memory)
 
                 print("INIT USAGE FIT_LAYER")
                 gpu_usage()
                 # Fits the RBM
-                model_mse = self.models[i].module.fit(dataset, batch_size, epochs[-1], loader, sampler, self.dec1.input_layers).item()
+                monitor = ConvergenceMonitor.from_config(early_stopping)
+                if monitor is None:
+                    model_mse = unwrap(self.models[i]).fit(dataset, batch_size, epochs[-1], loader, sampler, self.dec1.input_layers).item()
+                else:
+                    offset = len(unwrap(self.models[i])._history.get("mse", []))
+                    for ep in range(epochs[-1]):
+                        if sampler is not None:
+                            sampler.set_epoch(ep)
+                        model_mse = unwrap(self.models[i]).fit(dataset, batch_size, 1, loader, sampler, self.dec1.input_layers).item()
+                        if monitor.update(model_mse):
+                            break
+                    if monitor.stopped_epoch is not None:
+                        self.stopped_epochs[i] = offset + monitor.stopped_epoch
 
                 print("0 USAGE FIT_LAYER")
                 gpu_usage()
@@ -783,16 +938,11 @@ class DBNUnet(Model):
                 # Appending the metrics
                 self.mse.append(model_mse)
          
-                if hasattr(self.models[i], "module"): 
-                    self.models[i].module.W.detach()
-                    self.models[i].module.a.detach()
-                    self.models[i].module.b.detach()
-                else:
-                    self.models[i].W.detach()
-                    self.models[i].a.detach()
-                    self.models[i].b.detach()
+                unwrap(self.models[i]).W.detach()
+                unwrap(self.models[i]).a.detach()
+                unwrap(self.models[i]).b.detach()
                 torch.cuda.empty_cache()
-            dist.barrier()
+            barrier()
         return mse
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
@@ -806,6 +956,8 @@ class DBNUnet(Model):
 
         """
         h = x
+        if self.sobel is not None:
+            h = self.sobel(h)
         x1 = self.inConv(h)
         x2 = self.enc1(x1)
         x3 = self.enc2(x2)
@@ -853,6 +1005,8 @@ class DBNUnet(Model):
 
         # For every batch
         for samples, _ in tqdm(batches):
+            if self.sobel is not None:
+                samples = self.sobel(samples.to(self.torch_device))
             # Flattening the samples' batch
             samples = samples.reshape(
                 len(samples),
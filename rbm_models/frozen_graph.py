@@ -0,0 +1,291 @@
+import re
+import time
+from typing import Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from dist_utils import unwrap
+
+#Formats a graph can be frozen to
+#   torchscript - torch.jit.trace + torch.jit.freeze, loaded with torch.jit.load
+#   export      - torch.export (dynamic batch dimension), loaded with torch.export.load(...).module()
+FREEZE_FORMATS = ["torchscript", "export"]
+
+#Offset between the labels of HeirClust's sub-clusterings (label = sub-cluster + offset * base cluster)
+HEIR_LABEL_OFFSET = 15
+
+
+def _to_numpy(values):
+    #cuML scalers hold cupy arrays
+    if hasattr(values, "get"):
+        values = values.get()
+    return np.asarray(values, dtype=np.float64)
+
+
+class AffineScaler(nn.Module):
+    """Fitted scikit-learn / cuML StandardScaler, MinMaxScaler or MaxAbsScaler as a module: ((x - sub) / div) * mul + add.
+
+    """
+
+    def __init__(self, sub: np.ndarray, div: np.ndarray, mul: np.ndarray, add: np.ndarray):
+        """Initialization method.
+
+        Args:
+            sub: Per-feature value subtracted first.
+            div: Per-feature divisor.
+            mul: Per-feature multiplier.
+            add: Per-feature value added last.
+
+        """
+        super(AffineScaler, self).__init__()
+        self.register_buffer("sub", torch.as_tensor(sub, dtype=torch.float32))
+        self.register_buffer("div", torch.as_tensor(div, dtype=torch.float32))
+        self.register_buffer("mul", torch.as_tensor(mul, dtype=torch.float32))
+        self.register_buffer("add", torch.as_tensor(add, dtype=torch.float32))
+
+    @classmethod
+    def from_scaler(cls, scaler, n_features: int):
+        """Builds the module from a fitted scaler, following the order of operations of its transform.
+
+        Args:
+            scaler: Fitted StandardScaler, MinMaxScaler or MaxAbsScaler.
+            n_features: Number of features.
+
+        Returns:
+            (AffineScaler): The scaler as a module.
+
+        """
+        zeros = np.zeros(n_features)
+        ones = np.ones(n_features)
+        if hasattr(scaler, "min_"):
+            return cls(zeros, ones, _to_numpy(scaler.scale_), _to_numpy(scaler.min_))
+        if hasattr(scaler, "max_abs_"):
+            return cls(zeros, _to_numpy(scaler.scale_), ones, zeros)
+        if hasattr(scaler, "mean_") or hasattr(scaler, "scale_"):
+            sub = zeros if getattr(scaler, "mean_", None) is None else _to_numpy(scaler.mean_)
+            div = ones if getattr(scaler, "scale_", None) is None else _to_numpy(scaler.scale_)
+            return cls(sub, div, ones, zeros)
+        raise ValueError("Unsupported scaler " + type(scaler).__name__)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return ((x - self.sub) / self.div) * self.mul + self.add
+
+
+class FrozenHead(nn.Module):
+    """Deep clustering head (scaler and MultiPrototypes) of a ClustDBN, without the trunk.
+
+    """
+
+    def __init__(self, clust_dbn):
+        """Initialization method.
+
+        Args:
+            clust_dbn: Trained ClustDBN.
+
+        """
+        super(FrozenHead, self).__init__()
+        self.scaler = AffineScaler.from_scaler(clust_dbn.scaler, clust_dbn.input_fc)
+        self.fc = unwrap(clust_dbn.fc)
+
+    def forward(self, y: torch.Tensor) -> torch.Tensor:
+        scores = self.fc(self.scaler(y))
+        if isinstance(scores, (list, tuple)):
+            scores = scores[0]
+        return scores
+
+
+class InferenceGraph(nn.Module):
+    """Full inference graph of a trained model: DBN trunk, then (optionally) the deep clustering head and HeirClust
+    routing. Takes a float32 batch of (preprocessed) samples and returns labels and scores, with no dependency on
+    pickled scalers or the Python routing code once frozen.
+
+    """
+
+    def __init__(self, model):
+        """Initialization method.
+
+        Args:
+            model: Trained DBN, ClustDBN or HeirClust (anything with base_clust and clust_tree).
+
+        """
+        super(InferenceGraph, self).__init__()
+        clust = model
+        children = {}
+        if hasattr(model, "clust_tree"):
+            clust = model.base_clust
+            children = model.clust_tree["1"]
+        self.head = None
+        if hasattr(clust, "fc"):
+            self.trunk = clust.dbn_trunk
+            self.head = FrozenHead(clust)
+        else:
+            self.trunk = clust
+
+        #HeirClust keys its sub-clusterings by the string of the base cluster's (tensor) label, e.g. "tensor(3)"
+        self.child_labels = []
+        self.children_heads = nn.ModuleList()
+        for key in sorted(children.keys(), key = lambda k: int(re.search(r"-?\d+", k).group())):
+            if children[key] is not None:
+                self.child_labels.append(int(re.search(r"-?\d+", key).group()))
+                self.children_heads.append(FrozenHead(children[key]))
+        self.routed = hasattr(model, "clust_tree")
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Performs a forward pass over the data.
+
+        Args:
+            x: A float32 batch of samples.
+
+        Returns:
+            (Tuple[torch.Tensor, torch.Tensor]): Labels (int64) and scores - the head's class scores (the base clustering's, with
+                HeirClust routing), or the trunk's outputs without a head.
+
+        """
+        y = self.trunk(x)
+        if isinstance(y, (list, tuple)):
+            y = y[0]
+        if self.head is None:
+            return torch.argmax(y, dim=1), y
+        scores = self.head(y)
+        labels = torch.argmax(scores, dim=1)
+        if self.routed:
+            #All sub-clusterings run over the batch and each sample keeps its base cluster's
+            routed = labels * HEIR_LABEL_OFFSET
+            for label, child in zip(self.child_labels, self.children_heads):
+                routed = torch.where(labels == label, torch.argmax(child(y), dim=1) + label * HEIR_LABEL_OFFSET, routed)
+            labels = routed
+        return labels, scores
+
+
+def freeze(model, example: torch.Tensor, fmt: str = "torchscript"):
+    """Builds and freezes the inference graph of a trained model.
+
+    Args:
+        model: Trained DBN, ClustDBN or HeirClust.
+        example: Example float32 batch, on the device the graph runs on.
+        fmt: One of FREEZE_FORMATS.
+
+    Returns:
+        The frozen graph (a ScriptModule, or an ExportedProgram for fmt="export").
+
+    """
+    if fmt not in FREEZE_FORMATS:
+        raise ValueError("Unknown format " + str(fmt) + ", expected one of " + ", ".join(FREEZE_FORMATS))
+    graph = InferenceGraph(model).eval()
+    #DBN layers are not necessarily registered submodules (learnergy keeps them in a list), in which case their weights
+    #are traced as constants, which must not require gradients
+    layers = list(graph.modules()) + list(getattr(graph.trunk, "models", []))
+    for layer in layers:
+        for param in layer.parameters():
+            param.requires_grad_(False)
+    with torch.no_grad():
+        if fmt == "export":
+            batch = torch.export.Dim("batch", min=2)
+            return torch.export.export(graph, (example,), dynamic_shapes=({0: batch},))
+        traced = torch.jit.trace(graph, example, check_trace=False)
+    return torch.jit.freeze(traced.eval())
+
+
+def save(frozen, fname: str):
+    """Saves a graph returned by freeze.
+
+    Args:
+        frozen: Frozen graph.
+        fname: Path to write to.
+
+    """
+    if isinstance(frozen, torch.jit.ScriptModule):
+        torch.jit.save(frozen, fname)
+    else:
+        torch.export.save(frozen, fname)
+
+
+def load(fname: str, map_location = None):
+    """Loads a graph saved by save.
+
+    Args:
+        fname: Path to the graph.
+        map_location: Optional device to load a TorchScript graph onto.
+
+    Returns:
+        A callable taking a float32 batch and returning labels and scores.
+
+    """
+    try:
+        return torch.jit.load(fname, map_location=map_location)
+    except RuntimeError:
+        return torch.export.load(fname).module()
+
+
+def eager(model, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Labels and scores of the Python model, as generate_output and discretize_clusters derive them.
+
+    Args:
+        model: Trained DBN, ClustDBN or HeirClust.
+        x: A float32 batch of samples.
+
+    Returns:
+        (Tuple[torch.Tensor, torch.Tensor]): Labels and scores (None for HeirClust, whose forward returns labels only).
+
+    """
+    with torch.no_grad():
+        out = model.forward(x)
+    if isinstance(out, (list, tuple)):
+        out = out[0]
+    if hasattr(model, "clust_tree"):
+        return out.reshape(-1).long(), None
+    return torch.argmax(out, dim=1), out
+
+
+def check_parity(model, frozen, batches) -> dict:
+    """Compares a frozen graph with the Python model it was built from.
+
+    Args:
+        model: Trained DBN, ClustDBN or HeirClust.
+        frozen: Frozen graph (see freeze / load).
+        batches: Iterable of float32 batches.
+
+    Returns:
+        (dict): Number of samples, fraction of identical labels and maximum absolute score difference.
+
+    """
+    n_samples = 0
+    n_agree = 0
+    max_diff = 0.0
+    for x in batches:
+        labels, scores = eager(model, x)
+        with torch.no_grad():
+            frozen_labels, frozen_scores = frozen(x)
+        n_samples = n_samples + x.shape[0]
+        n_agree = n_agree + int((labels.to(frozen_labels.device) == frozen_labels).sum())
+        if scores is not None:
+            max_diff = max(max_diff, float((scores.to(frozen_scores.device) - frozen_scores).abs().max()))
+    return {"n_samples": n_samples, "label_agreement": n_agree / max(n_samples, 1), "max_abs_score_diff": max_diff}
+
+
+def benchmark(fn, x: torch.Tensor, n_iter: int = 50, n_warmup: int = 5) -> float:
+    """Times a forward pass.
+
+    Args:
+        fn: Callable taking a batch.
+        x: Batch.
+        n_iter: Timed iterations.
+        n_warmup: Untimed iterations first (graph optimization, allocator warm up).
+
+    Returns:
+        (float): Mean seconds per batch.
+
+    """
+    with torch.no_grad():
+        for i in range(n_warmup):
+            fn(x)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for i in range(n_iter):
+            fn(x)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / n_iter
@@ -0,0 +1,323 @@
+"""Fused contrastive divergence (CD-k) for Gaussian-ReLU and Gaussian-SeLU RBMs.
+
+learnergy's fit builds the CD-k cost from two energy evaluations and differentiates it with autograd, allocating new
+tensors for every matmul, activation and Gibbs step. For these RBMs sampling is deterministic (hidden states equal
+their probabilities, visible states equal their activations), so the gradient of
+cost = mean(E(v_0)) - mean(E(v_k)) has a closed form:
+
+    dW = (v_k^T sigmoid(v_k W + b) - v_0^T sigmoid(v_0 W + b)) / N
+    da = mean(v_k) - mean(v_0)
+    db = mean(sigmoid(v_k W + b)) - mean(sigmoid(v_0 W + b))
+
+The TorchScript kernel below computes it without autograd, in preallocated buffers reused across batches, with
+in-place activations and one hidden pre-activation shared between the Gibbs chain and the energy gradient
+(1 + 2k matrix products per batch instead of 4 + 2k). Matrix products go through the multithreaded BLAS torch is built with.
+"""
+import argparse
+import json
+import time
+from typing import Optional, Tuple, List
+
+import numpy as np
+
+import torch
+
+import learnergy.utils.constants as c
+from learnergy.utils import logging
+
+from dist_utils import all_reduce, get_world_size, is_distributed, unwrap
+
+logger = logging.get_logger(__name__)
+
+
+@torch.jit.script
+def _activate(pre: torch.Tensor, out: torch.Tensor, temperature: float, selu: bool) -> torch.Tensor:
+    out.copy_(pre)
+    if temperature != 1.0:
+        out.div_(temperature)
+    if selu:
+        return torch.selu_(out)
+    return out.relu_()
+
+
+@torch.jit.script
+def _cd_k(v0: torch.Tensor, W: torch.Tensor, a: torch.Tensor, b: torch.Tensor, steps: int, temperature: float,
+    selu: bool, pre: torch.Tensor, h: torch.Tensor, vk: torch.Tensor, grad_W: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    n = float(v0.shape[0])
+
+    #Positive phase - hidden states, then the energy term sigmoid(v_0 W + b) in the same buffer
+    torch.addmm(b, v0, W, out=pre)
+    h = _activate(pre, h, 1.0, selu)
+    pre.sigmoid_()
+    torch.mm(v0.t(), pre, out=grad_W)
+    grad_b = -pre.mean(0)
+
+    #Negative phase - the last hidden pre-activation is only needed for the energy term
+    for step in range(steps):
+        torch.addmm(a, h, W.t(), out=vk)
+        if temperature != 1.0:
+            vk.div_(temperature)
+        torch.addmm(b, vk, W, out=pre)
+        if step < steps - 1:
+            h = _activate(pre, h, temperature, selu)
+    pre.sigmoid_()
+
+    grad_W.mul_(-1.0 / n).addmm_(vk.t(), pre, alpha=1.0 / n)
+    grad_a = vk.mean(0) - v0.mean(0)
+    grad_b = grad_b + pre.mean(0)
+    mse = torch.sum((v0 - vk) ** 2) / n
+    return grad_W, grad_a, grad_b, mse
+
+
+def _device(model: torch.nn.Module):
+    #learnergy's Model only names its device, this repo's layers also carry torch_device
+    return getattr(model, "torch_device", model.device)
+
+
+def fused_activation(model: torch.nn.Module) -> Optional[str]:
+    """Whether or not the fused kernel reproduces a model's training step.
+
+    Args:
+        model: RBM layer. May be wrapped in DDP.
+
+    Returns:
+        (str): "relu" or "selu", or None if the model (or a subclass overriding its sampling or energy) is not supported.
+            Layers with batch_normalize set (this repo's learnergy fork) are not supported either - they keep their own fit.
+
+    """
+
+    from learnergy.models.gaussian import GaussianRBM, GaussianReluRBM, GaussianSeluRBM
+
+    if getattr(unwrap(model), "batch_normalize", False):
+        return None
+    cls = type(unwrap(model))
+    if cls.visible_sampling is not GaussianRBM.visible_sampling or cls.energy is not GaussianRBM.energy or \
+        cls.gibbs_sampling is not GaussianRBM.gibbs_sampling:
+        return None
+    if cls.hidden_sampling is GaussianReluRBM.hidden_sampling:
+        return "relu"
+    if cls.hidden_sampling is GaussianSeluRBM.hidden_sampling:
+        return "selu"
+    return None
+
+
+class FusedCD(object):
+    """Fused CD-k training step for one RBM layer. Buffers are allocated once per batch size and reused."""
+
+    def __init__(self, model: torch.nn.Module):
+        """Initialization method.
+
+        Args:
+            model: Gaussian-ReLU or Gaussian-SeLU RBM (see fused_activation). May be wrapped in DDP.
+
+        """
+
+        self.model = unwrap(model)
+        activation = fused_activation(self.model)
+        if activation is None:
+            raise ValueError("Fused CD-k does not support " + type(self.model).__name__)
+        self.selu = activation == "selu"
+        self.buffers = {}
+
+    def gradients(self, v0: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Computes the CD-k gradients of one batch.
+
+        Args:
+            v0: Batch of visible samples (N x n_visible), already normalized if the model normalizes its inputs.
+
+        Returns:
+            (Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]): Gradients of W, a and b, and the batch reconstruction MSE.
+
+        """
+
+        model = self.model
+        W = model.W.detach()
+        key = (v0.shape[0], v0.dtype, v0.device)
+        if key not in self.buffers:
+            self.buffers = {key: (torch.empty(v0.shape[0], W.shape[1], dtype=v0.dtype, device=v0.device),
+                torch.empty(v0.shape[0], W.shape[1], dtype=v0.dtype, device=v0.device),
+                torch.empty(v0.shape[0], W.shape[0], dtype=v0.dtype, device=v0.device),
+                torch.empty(W.shape, dtype=v0.dtype, device=v0.device))}
+        pre, h, vk, grad_W = self.buffers[key]
+        with torch.no_grad():
+            return _cd_k(v0, W, model.a.detach(), model.b.detach(), int(model.steps), float(model.T), self.selu,
+                pre, h, vk, grad_W)
+
+    def step(self, v0: torch.Tensor) -> float:
+        """Applies one CD-k update with the model's optimizer. Gradients are averaged across ranks when distributed,
+        as DDP would.
+
+        Args:
+            v0: Batch of visible samples (N x n_visible).
+
+        Returns:
+            (float): Batch reconstruction MSE.
+
+        """
+
+        model = self.model
+        grad_W, grad_a, grad_b, mse = self.gradients(v0)
+        for param, grad in ((model.W, grad_W), (model.a, grad_a), (model.b, grad_b)):
+            if param.grad is None:
+                param.grad = grad.clone()
+            else:
+                param.grad.copy_(grad)
+            if is_distributed():
+                all_reduce(param.grad)
+                param.grad.div_(get_world_size())
+        model.optimizer.step()
+        return mse.item()
+
+
+def fit_fused(model: torch.nn.Module, loader: torch.utils.data.DataLoader, sampler, epochs: int,
+    input_layers: Optional[List[torch.nn.Module]] = None) -> Tuple[float, float]:
+    """Trains one RBM layer with the fused kernel, in place of its fit. Training history (mse, pl, time) is recorded the
+    same way. The log pseudo-likelihood is only evaluated on the last batch of each epoch.
+
+    Args:
+        model: Gaussian-ReLU or Gaussian-SeLU RBM (see fused_activation). May be wrapped in DDP.
+        loader: DataLoader of (samples, targets) batches.
+        sampler: The loader's sampler (set_epoch is called each epoch), or None.
+        epochs: Number of training epochs.
+        input_layers: Frozen lower layers, applied to every batch (hidden probabilities).
+
+    Returns:
+        (Tuple[float, float]): MSE and log pseudo-likelihood of the last epoch.
+
+    """
+
+    fused = FusedCD(model)
+    model = fused.model
+    offset = len(model._history.get("mse", []))
+    mse = 0.0
+    pl = 0.0
+    for epoch in range(epochs):
+        if sampler is not None:
+            sampler.set_epoch(offset + epoch)
+        start = time.time()
+        mse = 0.0
+        n_batches = 0
+        samples = None
+        for samples, _ in loader:
+            samples = samples.to(_device(model), non_blocking = True).float()
+            with torch.no_grad():
+                for layer in input_layers or []:
+                    samples, _ = unwrap(layer).hidden_sampling(samples)
+                samples = samples.reshape(len(samples), model.n_visible)
+                if model.normalize:
+                    samples = (samples - torch.mean(samples, 0, True)) / (torch.std(samples, 0, True) + c.EPSILON)
+            mse = mse + fused.step(samples.contiguous())
+            n_batches = n_batches + 1
+        mse = mse / max(n_batches, 1)
+        if samples is not None:
+            with torch.no_grad():
+                pl = model.pseudo_likelihood(samples).item()
+        model.dump(mse=mse, pl=pl, time=time.time() - start)
+        logger.info("Epoch %d/%d (fused CD-%d) | MSE: %f | log-PL: %f", epoch + 1, epochs, model.steps, mse, pl)
+    return mse, pl
+
+
+def reference_gradients(model: torch.nn.Module, v0: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """learnergy's CD-k gradients (autograd through the energy difference), for comparison with FusedCD.gradients.
+
+    Args:
+        model: RBM layer.
+        v0: Batch of visible samples (N x n_visible).
+
+    Returns:
+        (Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]): Gradients of W, a and b, and the batch reconstruction MSE.
+
+    """
+
+    model = unwrap(model)
+    model.zero_grad()
+    _, _, _, _, visible_states = model.gibbs_sampling(v0)
+    visible_states = visible_states.detach()
+    cost = torch.mean(model.energy(v0)) - torch.mean(model.energy(visible_states))
+    cost.backward()
+    mse = torch.div(torch.sum(torch.pow(v0 - visible_states, 2)), v0.size(0)).detach()
+    grads = (model.W.grad.clone(), model.a.grad.clone(), model.b.grad.clone(), mse)
+    model.zero_grad()
+    return grads
+
+
+def check_against_reference(model: torch.nn.Module, v0: torch.Tensor) -> dict:
+    """
+    Args:
+        model: Gaussian-ReLU or Gaussian-SeLU RBM.
+        v0: Batch of visible samples (N x n_visible).
+
+    Returns:
+        (dict): Maximum absolute difference (relative to the largest reference value) of each gradient and of the MSE.
+
+    """
+
+    fused = FusedCD(model).gradients(v0)
+    reference = reference_gradients(model, v0)
+    report = {}
+    for name, f, r in zip(["W", "a", "b", "mse"], fused, reference):
+        report[name] = float((f - r).abs().max() / max(r.abs().max().item(), np.finfo(np.float32).tiny))
+    return report
+
+
+def benchmark(model: torch.nn.Module, batch_size: int = 1024, n_batches: int = 50) -> dict:
+    """Training throughput of learnergy's step (autograd, optimizer step) and of the fused step, on random batches.
+
+    Args:
+        model: Gaussian-ReLU or Gaussian-SeLU RBM.
+        batch_size: Amount of samples per batch.
+        n_batches: Amount of timed batches (after one warm-up batch).
+
+    Returns:
+        (dict): Samples/s and samples/s per core (torch intra-op threads) of each implementation, and the speedup.
+
+    """
+
+    model = unwrap(model)
+    batches = torch.randn(n_batches + 1, batch_size, model.n_visible, device=_device(model))
+    fused = FusedCD(model)
+    report = {"batch_size": batch_size, "n_visible": model.n_visible, "n_hidden": model.n_hidden, "steps": model.steps,
+        "threads": torch.get_num_threads()}
+    for name in ["reference", "fused"]:
+        for i in range(n_batches + 1):
+            if i == 1:
+                start = time.perf_counter()
+            if name == "fused":
+                fused.step(batches[i])
+            else:
+                _, _, _, _, visible_states = model.gibbs_sampling(batches[i])
+                cost = torch.mean(model.energy(batches[i])) - torch.mean(model.energy(visible_states.detach()))
+                model.optimizer.zero_grad()
+                cost.backward()
+                model.optimizer.step()
+        rate = n_batches * batch_size / (time.perf_counter() - start)
+        report[name] = {"samples_per_s": rate, "samples_per_s_per_core": rate / report["threads"]}
+    report["speedup"] = report["fused"]["samples_per_s"] / report["reference"]["samples_per_s"]
+    return report
+
+
+def main(n_visible, n_hidden, steps, batch_size, n_batches, threads):
+    from learnergy.models.gaussian import GaussianReluRBM, GaussianSeluRBM
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    for cls in [GaussianSeluRBM, GaussianReluRBM]:
+        model = cls(n_visible = n_visible, n_hidden = n_hidden, steps = steps, temperature = 0.9)
+        v0 = torch.randn(batch_size, n_visible)
+        print(cls.__name__, "max relative gradient difference", json.dumps(check_against_reference(model, v0)))
+        print(cls.__name__, "throughput", json.dumps(benchmark(model, batch_size, n_batches), indent=2))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Checks the fused CD-k kernel against learnergy's gradients and benchmarks both.")
+    parser.add_argument("-v", "--visible", type=int, default=200, help="Visible units.")
+    parser.add_argument("-n", "--hidden", type=int, default=2000, help="Hidden units.")
+    parser.add_argument("-k", "--steps", type=int, default=1, help="Gibbs steps.")
+    parser.add_argument("-b", "--batch-size", type=int, default=1024, help="Samples per batch.")
+    parser.add_argument("-i", "--batches", type=int, default=50, help="Timed batches.")
+    parser.add_argument("-t", "--threads", type=int, default=None, help="torch intra-op threads (default: torch's).")
+    args = parser.parse_args()
+    main(args.visible, args.hidden, args.steps, args.batch_size, args.batches, args.threads)
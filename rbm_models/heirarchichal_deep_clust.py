@@ -23,11 +23,16 @@ import learnergy.utils.exception as e
 from learnergy.models.bernoulli import RBM
 from learnergy.utils import logging
 
-from cuml.preprocessing import MinMaxScaler, StandardScaler
+try:
+    from cuml.preprocessing import MinMaxScaler, StandardScaler
+except ImportError:
+    #CPU-only environments
+    from sklearn.preprocessing import MinMaxScaler, StandardScaler
 
 
 from dbn_datasets import DBNDataset
 from rbm_models.clust_dbn import ClustDBN
+from dist_utils import get_local_rank, get_device, wrap_ddp, get_loader, load_state_dict, batch_loader
  
 import scipy
 from sys import float_info
@@ -37,10 +42,27 @@ from datetime import timedelta
 
 import os
 
-from GPUtil import showUtilization as gpu_usage
+try:
+    from GPUtil import showUtilization as gpu_usage
+except ImportError:
+    #CPU-only environments - nothing to report
+    def gpu_usage():
+        pass
 
 logger = logging.get_logger(__name__)
 
+#Relative gap between the top two sub-clustering scores below which HeirClust.forward re-runs a sample on its own - far
+#above the last-bit differences between batched and single-sample passes
+ROUTING_TIE_TOLERANCE = 1e-4
+
+
+def _first_output(y):
+    if isinstance(y, tuple):
+        y = y[0]
+    if isinstance(y, list):
+        y = y[0]
+    return y
+
 
 from joblib import dump, load
 
@@ -59,12 +81,11 @@ class HeirClust(Model):
         super(HeirClust, self).__init__(use_gpu=use_gpu)
 
         self.base_clust = base_clust
+        self.use_gpu = use_gpu
     
-        self.local_rank = 0
-        if "LOCAL_RANK" in os.environ.keys():
-                self.local_rank = int(os.environ["LOCAL_RANK"])
+        self.local_rank = get_local_rank()
  
-        self.generate_label_set(train_data)
+        self.generate_label_set(train_data, use_gpu)
 
 
         self.clust_tree = {"0": {"-1": self.base_clust}, "1": {}}
@@ -81,21 +102,18 @@ class HeirClust(Model):
 
             print("TRAINING MODEL ", str(count), " / ", str(len(self.lab_full.keys())))
 
-            use_gpu = True
             n_classes = 15
             self.clust_tree["1"][key] = ClustDBN(self.base_clust.dbn_trunk, self.base_clust.input_fc, n_classes,
-               use_gpu, None)
+               self.use_gpu, None)
             self.clust_tree["1"][key].fc.train()
             self.clust_tree["1"][key].dbn_trunk.eval()
-            self.clust_tree["1"][key].fc = DDP(self.clust_tree["1"][key].fc, device_ids=[self.local_rank], output_device=self.local_rank)
+            self.clust_tree["1"][key].fc = wrap_ddp(self.clust_tree["1"][key].fc)
 
             train_subset = DBNDataset()
             print("HERE SUBSET STATS", train_data.data_full[self.lab_full[key]].min(), train_data.data_full[self.lab_full[key]].max(), train_data.data_full[self.lab_full[key]].mean(), train_data.data_full[self.lab_full[key]].std())
             train_subset.init_from_array(train_data.data_full[self.lab_full[key]], train_data.targets_full[self.lab_full[key]], train_data.scaler)
-            sampler = DistributedSampler(train_subset, shuffle=True)
             batch_size = min(100, int(train_subset.data_full.shape[0] / 15))
-            loader = DataLoader(train_subset, batch_size=batch_size, shuffle=False,
-                sampler=sampler, num_workers = 10, pin_memory = False, drop_last=True)
+            loader, sampler = get_loader(train_subset, batch_size, num_workers = 10, pin_memory = False)
             gpu_usage()
             self.clust_tree["1"][key].fit(train_subset, batch_size, 15, loader, sampler, [0.001, 0.0001, 0.00001, 0.000001, 0.0], 1.0) #TODO
             self.clust_tree["1"][key].eval()
@@ -125,17 +143,13 @@ class HeirClust(Model):
             data.current_subset = -1
             data.next_subset()
 
-            test_loader = DataLoader(data, batch_size=batch_size, shuffle=False, \
-            num_workers = 0, drop_last = False, pin_memory = False)
+            test_loader = batch_loader(data, None, batch_size, num_workers = 0, pin_memory = False, drop_last = False)
             ind = 0
             ind2 = 0
 
  
 
-            if use_gpu:
-                device = torch.device("cuda:{}".format(self.local_rank))
-            else:
-                device = torch.device("cpu:{}".format(self.local_rank))
+            device = get_device(use_gpu)
  
             for data2 in tqdm(test_loader):
                 dat_dev, lab_dev = data2[0].to(device=device, non_blocking=True), data2[1].to(device=device, non_blocking=True)
@@ -177,6 +191,57 @@ class HeirClust(Model):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Performs a forward pass over the data.
 
+        The batch is routed in groups: the top-level labels are computed once, the batch is partitioned by label (one
+        stable sort, group sizes from a bincount) and each sub-clustering runs once over its whole group. A batched pass
+        may round differently from a single-sample pass in the last bits, which can only change a label where the top two
+        scores of the sub-clustering are that close - samples whose top two scores are within ROUTING_TIE_TOLERANCE
+        (relative) are re-run one at a time, as forward_per_sample runs them, so labels are those of forward_per_sample.
+
+        Args:
+            x: An input tensor for computing the forward pass.
+
+        Returns:
+            (torch.Tensor): A tensor containing the DBN's outputs.
+
+        """
+        #TODO fix for multi-head
+        y = self.base_clust.forward(x)
+
+        if isinstance(y,tuple):
+            y = y[0]
+
+        if isinstance(y,list):
+            y = y[0]
+
+        top = torch.argmax(y, dim=1)
+        tmp_full = torch.zeros((y.shape[0], 1), device=y.device)
+        tmp_full[:, 0] = 15*top
+
+        order = torch.argsort(top, stable=True)
+        counts = torch.bincount(top).tolist()
+        start = 0
+        for lab, count in enumerate(counts):
+            inds = order[start:start + count]
+            start = start + count
+            #Sub-clusterings are keyed by the string of the (CPU) label tensor, as generate_label_set stores them
+            key = str(torch.tensor(lab))
+            if count == 0 or key not in self.clust_tree["1"].keys() or self.clust_tree["1"][key] is None:
+                continue
+            sub = self.clust_tree["1"][key]
+            tmp = _first_output(sub.forward(x[inds]))
+            sub_lab = torch.argmax(tmp, dim=1)
+            if tmp.shape[1] > 1:
+                top2 = torch.topk(tmp, 2, dim=1)[0]
+                scale = torch.clamp(top2[:, 0].abs(), min=1.0)
+                for i in torch.nonzero(top2[:, 0] - top2[:, 1] <= ROUTING_TIE_TOLERANCE * scale).flatten().tolist():
+                    sub_lab[i] = torch.argmax(_first_output(sub.forward(torch.unsqueeze(x[inds[i]], dim=0))), dim=1)[0]
+            tmp_full[inds, 0] = (sub_lab + (15*lab)).to(tmp_full.dtype)
+
+        return tmp_full
+
+    def forward_per_sample(self, x: torch.Tensor) -> torch.Tensor:
+        """Performs a forward pass over the data, routing one sample at a time (reference for forward).
+
         Args:
             x: An input tensor for computing the forward pass.
 
@@ -241,7 +306,6 @@ class HeirClust(Model):
 
     def load_model(self, state_dict):
         n_classes = 15
-        use_gpu = True
         print("LOADING MODEL")
         for lab1 in self.clust_tree.keys():
             if lab1 == "0":
@@ -250,12 +314,9 @@ class HeirClust(Model):
                 self.clust_tree[lab1][lab2] = None
                 if lab2 in state_dict[lab1].keys():
                     self.clust_tree[lab1][lab2] = ClustDBN(self.base_clust.dbn_trunk, self.base_clust.input_fc, n_classes,
-                        use_gpu, self.base_clust.scaler)
-                    self.clust_tree[lab1][lab2].fc = DDP(self.clust_tree[lab1][lab2].fc, device_ids=[self.local_rank], output_device=self.local_rank)
-                    self.clust_tree[lab1][lab2].load_state_dict(state_dict[lab1][lab2]["model"])
+                        self.use_gpu, self.base_clust.scaler)
+                    self.clust_tree[lab1][lab2].fc = wrap_ddp(self.clust_tree[lab1][lab2].fc)
+                    load_state_dict(self.clust_tree[lab1][lab2], state_dict[lab1][lab2]["model"])
                     self.clust_tree[lab1][lab2].scaler = load(state_dict[lab1][lab2]["scaler"])
         print(self.clust_tree["1"].keys(), self.lab_full.keys(), "KEYS") 
 
-
-
-
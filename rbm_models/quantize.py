@@ -0,0 +1,255 @@
+import os
+import json
+from typing import Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from dist_utils import unwrap, get_rank
+from rbm_models.frozen_graph import InferenceGraph, eager, benchmark
+
+#Hidden activations of the (per-pixel) RBM types, by class name. Layers of other types, or whose hidden_sampling is not
+#reproduced on the calibration samples, are kept in fp32.
+RBM_ACTIVATIONS = {"selu": F.selu, "relu": F.relu, "sigmoid": torch.sigmoid}
+
+
+def activation_name(layer) -> str:
+    """Key of RBM_ACTIVATIONS for an RBM layer.
+
+    Args:
+        layer: RBM layer.
+
+    Returns:
+        (str): Activation of the layer's hidden pass, by its type.
+
+    """
+    name = type(layer).__name__.lower()
+    for key in ["selu", "relu"]:
+        if key in name:
+            return key
+    return "sigmoid"
+
+
+class LinearRBM(nn.Module):
+    """Deterministic hidden pass of an RBM layer (activation(v W + b)) as an nn.Linear, so it can be quantized.
+
+    """
+
+    def __init__(self, layer, activation: str):
+        """Initialization method.
+
+        Args:
+            layer: RBM layer (with W, n_visible x n_hidden, and b).
+            activation: Key of RBM_ACTIVATIONS.
+
+        """
+        super(LinearRBM, self).__init__()
+        self.linear = nn.Linear(layer.W.shape[0], layer.W.shape[1])
+        with torch.no_grad():
+            self.linear.weight.copy_(layer.W.detach().t())
+            self.linear.bias.copy_(layer.b.detach())
+        self.activation = activation
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return RBM_ACTIVATIONS[self.activation](self.linear(x))
+
+
+class SampledRBM(nn.Module):
+    """Hidden pass of an RBM layer kept as is (probabilities of its hidden_sampling).
+
+    """
+
+    def __init__(self, layer):
+        super(SampledRBM, self).__init__()
+        self.layer = layer
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.layer.hidden_sampling(x)[0]
+
+
+def _convert_trunk(trunk, calibration: torch.Tensor, atol: float = 1e-5):
+    #Returns the trunk as a Sequential of LinearRBM / SampledRBM layers, or None if its forward is not a plain layer by
+    #layer hidden pass (on the calibration samples)
+    if not hasattr(trunk, "models"):
+        return None
+    layers = []
+    x = calibration
+    with torch.no_grad():
+        for model in trunk.models:
+            layer = unwrap(model)
+            if not hasattr(layer, "hidden_sampling"):
+                return None
+            expected = layer.hidden_sampling(x)[0]
+            converted = SampledRBM(layer)
+            if hasattr(layer, "W") and hasattr(layer, "b") and layer.W.dim() == 2:
+                linear = LinearRBM(layer, activation_name(layer)).to(x.device)
+                if torch.allclose(linear(x), expected, atol=atol):
+                    converted = linear
+            layers.append(converted)
+            x = expected
+        converted = nn.Sequential(*layers)
+        y = trunk.forward(calibration)
+        if isinstance(y, (list, tuple)):
+            y = y[0]
+        if not torch.allclose(converted(calibration), y, atol=atol):
+            return None
+    return converted
+
+
+class QuantizedModel(nn.Module):
+    """int8 dynamically quantized (CPU) counterpart of a trained DBN, ClustDBN or HeirClust. Dense layers - the RBM
+    layers' hidden passes and the deep clustering heads - run with int8 weights and dynamically quantized activations;
+    scalers and activations stay in fp32. forward returns what the model's forward does (class scores, or HeirClust
+    labels), so it can be passed to generate_output in place of the model.
+
+    """
+
+    def __init__(self, model, calibration: torch.Tensor):
+        """Initialization method.
+
+        Args:
+            model: Trained DBN, ClustDBN or HeirClust, on the CPU.
+            calibration: Sample of (preprocessed) training data, used to check each layer's conversion.
+
+        """
+        super(QuantizedModel, self).__init__()
+        if calibration.is_cuda:
+            raise ValueError("Dynamic quantization runs on the CPU only")
+        graph = InferenceGraph(model).eval()
+        trunk = _convert_trunk(graph.trunk, calibration)
+        if trunk is not None:
+            graph.trunk = trunk
+        self.n_quantized = sum(isinstance(layer, LinearRBM) for layer in graph.trunk.modules()) if trunk is not None else 0
+        #Quantizes a copy - the graph shares its layers with the model
+        self.graph = torch.ao.quantization.quantize_dynamic(graph, {nn.Linear}, dtype=torch.qint8)
+        self.heir = graph.routed
+
+    def predict(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Labels and scores (see frozen_graph.InferenceGraph).
+
+        Args:
+            x: A float32 batch of samples.
+
+        """
+        return self.graph(x)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        labels, scores = self.graph(x)
+        if self.heir:
+            return labels.reshape(-1, 1).to(x.dtype)
+        return scores
+
+
+def agreement_report(reference: np.ndarray, labels: np.ndarray) -> dict:
+    """Compares the labels of a model with those of a reference.
+
+    Args:
+        reference: Labels of the reference (fp32) model.
+        labels: Labels of the model being evaluated.
+
+    Returns:
+        (dict): Number of samples, label agreement, per-class agreement (fraction of each reference class's samples
+            that keep their label) and the confusion matrix (rows: reference, columns: labels) over the classes present.
+
+    """
+    reference = np.asarray(reference).reshape(-1).astype(np.int64)
+    labels = np.asarray(labels).reshape(-1).astype(np.int64)
+    classes, inverse = np.unique(np.concatenate((reference, labels)), return_inverse=True)
+    confusion = np.zeros((classes.shape[0], classes.shape[0]), dtype=np.int64)
+    np.add.at(confusion, (inverse[:reference.shape[0]], inverse[reference.shape[0]:]), 1)
+    per_class = {}
+    for i in range(classes.shape[0]):
+        if confusion[i].sum() > 0:
+            per_class[str(classes[i])] = float(confusion[i,i] / confusion[i].sum())
+    return {"n_samples": int(reference.shape[0]), "label_agreement": float(np.mean(reference == labels)) if reference.shape[0] > 0 else 1.0,
+        "per_class_agreement": per_class, "classes": classes.tolist(), "confusion": confusion.tolist()}
+
+
+def calibrate(model, calibration: torch.Tensor, threshold: float = 0.99, batch_size: int = 5000) -> Tuple[QuantizedModel, dict]:
+    """Quantizes a model and measures its agreement with the fp32 model on a sample of training data.
+
+    Args:
+        model: Trained DBN, ClustDBN or HeirClust, on the CPU.
+        calibration: Sample of (preprocessed) training data.
+        threshold: Label agreement the quantized model must reach to be used.
+        batch_size: Batch size of the comparison.
+
+    Returns:
+        (Tuple[QuantizedModel, dict]): The quantized model and its agreement report, with accepted set if the
+            agreement clears the threshold.
+
+    """
+    quantized = QuantizedModel(model, calibration[0:batch_size])
+    reference = []
+    labels = []
+    with torch.no_grad():
+        for i in range(0, calibration.shape[0], batch_size):
+            x = calibration[i:i+batch_size]
+            reference.append(eager(model, x)[0].cpu().numpy())
+            labels.append(quantized.predict(x)[0].cpu().numpy())
+    report = agreement_report(np.concatenate(reference), np.concatenate(labels))
+    report["quantized_rbm_layers"] = quantized.n_quantized
+    report["threshold"] = threshold
+    report["accepted"] = report["label_agreement"] >= threshold
+    return quantized, report
+
+
+def throughput_per_core(fn, x: torch.Tensor, threads = None, n_iter: int = 20) -> dict:
+    """Measures CPU throughput at different thread counts.
+
+    Args:
+        fn: Callable taking a batch.
+        x: Batch.
+        threads: Thread counts to measure at. Defaults to 1 and all available cores.
+        n_iter: Timed iterations per thread count.
+
+    Returns:
+        (dict): Samples per second per core, by thread count.
+
+    """
+    if threads is None:
+        threads = sorted(set([1, len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()]))
+    n_threads = torch.get_num_threads()
+    results = {}
+    try:
+        for n in threads:
+            torch.set_num_threads(n)
+            results[str(n)] = x.shape[0] / benchmark(fn, x, n_iter) / n
+    finally:
+        torch.set_num_threads(n_threads)
+    return results
+
+
+def quantized_output_model(model, dat, quantize, use_gpu: bool, out_dir: str, seed: int = 42):
+    """Picks the model outputs are generated with, following the output/quantize configuration.
+
+    Args:
+        model: Trained (per-pixel) DBN, ClustDBN or HeirClust.
+        dat: Training dataset, sampled to calibrate the quantized model on.
+        quantize: output/quantize configuration (threshold, samples), or None.
+        use_gpu: Whether or not the model runs on the GPU (quantized models run on the CPU only).
+        out_dir: Directory the agreement report (quantization_report.json) is written to.
+        seed: Random seed of the calibration sample.
+
+    Returns:
+        The int8 quantized copy of the model if its agreement clears the threshold, else the model.
+
+    """
+    if quantize is None:
+        return model
+    if use_gpu:
+        print("output/quantize runs on the CPU only - generating outputs with the fp32 model")
+        return model
+    n_samples = dat.data_full.shape[0]
+    inds = np.sort(np.random.default_rng(seed).choice(n_samples, min(n_samples, int(quantize.get("samples", 20000))), replace=False))
+    calibration = torch.as_tensor(dat.decode(dat.data_full[inds]), dtype=torch.float32)
+    quantized, report = calibrate(model, calibration, float(quantize.get("threshold", 0.99)))
+    if get_rank() == 0:
+        with open(os.path.join(out_dir, "quantization_report.json"), "w") as f:
+            json.dump(report, f, indent=2)
+    print("QUANTIZED LABEL AGREEMENT", report["label_agreement"], "ACCEPTED" if report["accepted"] else "REJECTED")
+    if report["accepted"]:
+        return quantized
+    return model
@@ -0,0 +1,198 @@
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from skimage.util import view_as_windows
+
+from dist_utils import unwrap
+from validity import window_mask
+from rbm_models.quantize import RBM_ACTIVATIONS, activation_name
+
+
+def conv_kernel(W: torch.Tensor, size_wind: int) -> torch.Tensor:
+    """Rearranges the weights of a dense layer over flattened neighborhoods into a Conv2d kernel.
+
+    Neighborhood samples are (size_wind x size_wind x channels) windows flattened in row-major order (see
+    DBNDataset), so input (row * size_wind + column) * channels + channel of the dense layer is kernel tap (channel, row, column).
+
+    Args:
+        W: Weights of the layer (n_visible x n_hidden, n_visible = size_wind^2 * channels).
+        size_wind: Neighborhood size (1 + 2 * pixel_padding).
+
+    Returns:
+        (torch.Tensor): Kernel (n_hidden x channels x size_wind x size_wind).
+
+    """
+    if W.shape[0] % (size_wind * size_wind) != 0:
+        raise ValueError("Layer input size " + str(W.shape[0]) + " is not a multiple of the neighborhood size " + str(size_wind * size_wind))
+    n_chans = W.shape[0] // (size_wind * size_wind)
+    return W.reshape(size_wind, size_wind, n_chans, W.shape[1]).permute(3, 2, 0, 1).contiguous()
+
+
+class SceneInference(object):
+    """Scene-level inference for per-pixel (neighborhood) DBN / ClustDBN models. The first RBM layer is run as a Conv2d over
+    the preprocessed scene, tile by tile, rather than as a dense layer over a (1 + 2 * pixel_padding)^2 copy of every pixel;
+    later layers are per-pixel (1x1) and run, with the clustering head, exactly as the model's forward does. Samples whose
+    neighborhood holds an invalid pixel are skipped, as DBNDataset skips them.
+
+    """
+
+    def __init__(self, model, pixel_padding: int, tile_size: int = 512, atol: float = 1e-4):
+        """Initialization method.
+
+        Args:
+            model: Trained (per-pixel) DBN or ClustDBN.
+            pixel_padding: Neighborhood padding the model was trained with.
+            tile_size: Size (rows and columns) of the output tiles processed at a time.
+            atol: Tolerance of the check of the first layer's activation against its hidden_sampling.
+
+        """
+        self.model = model
+        self.trunk = model.dbn_trunk if hasattr(model, "fc") else model
+        self.pixel_padding = pixel_padding
+        self.size_wind = 1 + 2 * pixel_padding
+        self.tile_size = tile_size
+        self.atol = atol
+
+        layers = [unwrap(layer) for layer in self.trunk.models]
+        self.first = layers[0]
+        self.layers = layers[1:]
+        self.activation = activation_name(self.first)
+        self.weight = conv_kernel(self.first.W.detach(), self.size_wind)
+        self.bias = self.first.b.detach()
+        self.checked = False
+
+    @property
+    def device(self):
+        return self.weight.device
+
+    def __check__(self, tile: np.ndarray, valid: np.ndarray, pre: torch.Tensor):
+        #The activation is inferred from the layer type - check it against the layer's own hidden pass on this tile's samples
+        rows, cols = np.nonzero(valid)
+        rows = rows[:64]
+        cols = cols[:64]
+        windows = view_as_windows(tile, [self.size_wind, self.size_wind, tile.shape[2]])[rows, cols, 0]
+        windows = torch.as_tensor(windows.reshape((rows.shape[0], -1)), device=self.device)
+        with torch.no_grad():
+            expected = self.first.hidden_sampling(windows)[0]
+        actual = RBM_ACTIVATIONS[self.activation](pre[:, rows, cols].t())
+        if not torch.allclose(actual, expected, atol=self.atol):
+            raise ValueError("The hidden pass of " + type(self.first).__name__ + " is not " + self.activation +
+                "(v W + b) - scene inference does not support it")
+        self.checked = True
+
+    def forward_pixels(self, y: torch.Tensor) -> torch.Tensor:
+        """Runs the later layers and the clustering head over first-layer activations.
+
+        Args:
+            y: First layer activations (samples x n_hidden).
+
+        Returns:
+            (torch.Tensor): The model's outputs (class scores for a ClustDBN, the trunk's outputs for a DBN).
+
+        """
+        for layer in self.layers:
+            y, _ = layer.hidden_sampling(y)
+        if self.trunk is self.model:
+            return y
+        y = torch.as_tensor(self.model.scaler.transform(y), dtype = y.dtype)
+        y = self.model.fc.forward(y)
+        if isinstance(y, (list, tuple)):
+            y = y[0]
+        return y
+
+    def tiles(self, scene: np.ndarray, valid_pixels: np.ndarray, file_id: int = 0) -> Iterator[Tuple[torch.Tensor, np.ndarray]]:
+        """Runs the model over a scene.
+
+        Args:
+            scene: Preprocessed scene (rows x columns x channels, float32), as returned by DBNDataset.read_and_preprocess_scene.
+            valid_pixels: Per-pixel validity mask of the scene.
+            file_id: File index stored in the sample indices.
+
+        Yields:
+            (Tuple[torch.Tensor, np.ndarray]): Outputs of the valid samples of each tile and their indices (file, row,
+                column of the center pixel), in row-major order within the tile.
+
+        """
+        valid = window_mask(valid_pixels, self.pixel_padding)
+        pad = self.pixel_padding
+        for r0 in range(0, valid.shape[0], self.tile_size):
+            for c0 in range(0, valid.shape[1], self.tile_size):
+                tile_valid = valid[r0:r0 + self.tile_size, c0:c0 + self.tile_size]
+                if not tile_valid.any():
+                    continue
+                tile = scene[r0:r0 + tile_valid.shape[0] + 2 * pad, c0:c0 + tile_valid.shape[1] + 2 * pad]
+                x = torch.as_tensor(np.ascontiguousarray(np.moveaxis(tile, 2, 0)), device=self.device).unsqueeze(0)
+                with torch.no_grad():
+                    pre = F.conv2d(x, self.weight, self.bias)[0]
+                    if not self.checked:
+                        self.__check__(tile, tile_valid, pre)
+                    mask = torch.as_tensor(tile_valid, device=self.device)
+                    y = RBM_ACTIVATIONS[self.activation](pre.permute(1, 2, 0)[mask])
+                    output = self.forward_pixels(y)
+                rows, cols = np.nonzero(tile_valid)
+                coords = np.stack((np.full(rows.shape, file_id), rows + r0 + pad, cols + c0 + pad), axis=1)
+                yield output, coords
+
+    def count(self, valid_pixels: np.ndarray) -> int:
+        """Number of samples of a scene.
+
+        Args:
+            valid_pixels: Per-pixel validity mask of the scene.
+
+        Returns:
+            (int): Number of samples (pixels whose whole neighborhood is valid).
+
+        """
+        return int(window_mask(valid_pixels, self.pixel_padding).sum())
+
+
+def check_parity(engine: SceneInference, scene: np.ndarray, valid_pixels: np.ndarray, n_samples: int = 10000, seed: int = 42,
+    crop_size: Optional[int] = None) -> dict:
+    """Compares scene inference with the model's forward over explicitly extracted neighborhoods.
+
+    Args:
+        engine: Scene inference engine.
+        scene: Preprocessed scene.
+        valid_pixels: Per-pixel validity mask of the scene.
+        n_samples: Number of (random) samples to compare.
+        seed: Random seed.
+        crop_size: Optional size (rows and columns of samples) of a random block of the scene, centered on a valid sample,
+            to run instead of the whole scene - cheap enough to check every scene.
+
+    Returns:
+        (dict): Number of samples compared, label agreement and maximum absolute output difference.
+
+    """
+    if crop_size is not None:
+        valid = window_mask(valid_pixels, engine.pixel_padding)
+        rows, cols = np.nonzero(valid)
+        if rows.shape[0] == 0:
+            return {"n_samples": 0, "label_agreement": 1.0, "max_abs_diff": 0.0}
+        center = np.random.default_rng(seed).integers(rows.shape[0])
+        r0 = int(np.clip(rows[center] - crop_size // 2, 0, max(valid.shape[0] - crop_size, 0)))
+        c0 = int(np.clip(cols[center] - crop_size // 2, 0, max(valid.shape[1] - crop_size, 0)))
+        r1 = r0 + crop_size + 2 * engine.pixel_padding
+        c1 = c0 + crop_size + 2 * engine.pixel_padding
+        scene = scene[r0:r1, c0:c1]
+        valid_pixels = valid_pixels[r0:r1, c0:c1]
+    outputs = []
+    coords = []
+    for output, coord in engine.tiles(scene, valid_pixels):
+        outputs.append(output.cpu())
+        coords.append(coord)
+    outputs = torch.cat(outputs)
+    coords = np.concatenate(coords)
+    inds = np.sort(np.random.default_rng(seed).choice(coords.shape[0], min(n_samples, coords.shape[0]), replace=False))
+    pad = engine.pixel_padding
+    windows = view_as_windows(scene, [engine.size_wind, engine.size_wind, scene.shape[2]])
+    windows = windows[coords[inds, 1] - pad, coords[inds, 2] - pad, 0].reshape((inds.shape[0], -1))
+    with torch.no_grad():
+        expected = engine.model.forward(torch.as_tensor(windows, device=engine.device))
+    if isinstance(expected, (list, tuple)):
+        expected = expected[0]
+    expected = expected.cpu()
+    actual = outputs[inds]
+    return {"n_samples": int(inds.shape[0]), "label_agreement": float((torch.argmax(expected, dim=1) == torch.argmax(actual, dim=1)).float().mean()),
+        "max_abs_diff": float((expected - actual).abs().max())}
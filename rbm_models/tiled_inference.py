@@ -0,0 +1,215 @@
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+from skimage.filters import sobel
+
+from validity import FILL
+
+#Blending windows of overlapping tiles
+#   cosine   - weight 1 in the tile's interior, with a raised cosine taper over the overlap at its edges
+#   gaussian - separable Gaussian centered on the tile (sigma of a quarter of the tile)
+#   uniform  - plain average
+BLEND_WINDOWS = ["cosine", "gaussian", "uniform"]
+
+
+def tile_starts(size: int, tile: int, stride: int) -> List[int]:
+    """Start positions of tiles along one axis.
+
+    Args:
+        size: Length of the axis.
+        tile: Tile length.
+        stride: Distance between tile starts.
+
+    Returns:
+        (List[int]): Starts, every stride, with the last tile aligned to the end of the axis so it is fully covered.
+
+    """
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile + 1, stride))
+    if starts[-1] + tile < size:
+        starts.append(size - tile)
+    return starts
+
+
+def _taper(length: int, overlap: int, blend: str) -> np.ndarray:
+    if blend == "uniform" or overlap == 0:
+        return np.ones(length)
+    if blend == "gaussian":
+        sigma = length / 4.0
+        x = np.arange(length) - (length - 1) / 2.0
+        return np.exp(-(x ** 2) / (2 * sigma ** 2))
+    overlap = min(overlap, length // 2)
+    weights = np.ones(length)
+    #Strictly positive at the tile edge, so pixels covered by a single (scene edge) tile keep its output
+    ramp = 0.5 - 0.5 * np.cos(np.pi * np.arange(1, overlap + 1) / (overlap + 1))
+    weights[:overlap] = ramp
+    weights[length - overlap:] = ramp[::-1]
+    return weights
+
+
+def blend_window(shape: Tuple[int, int], overlap: Tuple[int, int], blend: str = "cosine") -> np.ndarray:
+    """Per-pixel blending weights of a tile.
+
+    Args:
+        shape: Tile shape (rows, columns).
+        overlap: Overlap of neighboring tiles (rows, columns).
+        blend: One of BLEND_WINDOWS.
+
+    Returns:
+        (np.ndarray): Weights (rows x columns, float64), all positive.
+
+    """
+    if blend not in BLEND_WINDOWS:
+        raise ValueError("Unknown blending window " + str(blend) + ", expected one of " + ", ".join(BLEND_WINDOWS))
+    return np.outer(_taper(shape[0], overlap[0], blend), _taper(shape[1], overlap[1], blend))
+
+
+class TiledInference(object):
+    """Sliding-window inference of a fully convolutional model (DBNUnet) over arbitrarily large scenes. Tiles of the
+    model's input shape are cut from the scene as they are needed (the scene may be a memory map, zarr array, or
+    anything else sliced lazily), prepared and normalized as DBNDatasetConv prepares its tiles, and run in batches.
+    Overlapping outputs are blended with a tapered window, and only invalid (fill) pixels are excluded, so no seams
+    appear at tile edges. Blended rows are yielded as soon as no later tile covers them, so memory is bounded by a band
+    of tile rows across the scene.
+
+    """
+
+    def __init__(self, model, tile_size: Tuple[int, int], overlap: Tuple[int, int] = (0, 0), blend: str = "cosine",
+        transform = None, sobel_features: bool = True, device = "cpu", batch_size: int = 4):
+        """Initialization method.
+
+        Args:
+            model: Trained fully convolutional model (outputs classes x rows x columns per tile).
+            tile_size: Tile shape (rows, columns) - the model's input shape.
+            overlap: Overlap of neighboring tiles (rows, columns).
+            blend: One of BLEND_WINDOWS.
+            transform: Per-channel normalization of the (prepared) tiles, as used in training.
+            sobel_features: Whether or not tiles hold sobel edges (see dbn_datasets_conv.prepare_scene).
+            device: Device the model runs on.
+            batch_size: Number of tiles per forward pass.
+
+        """
+        self.model = model
+        self.tile_size = (int(tile_size[0]), int(tile_size[1]))
+        self.overlap = (int(overlap[0]), int(overlap[1]))
+        if self.overlap[0] >= self.tile_size[0] or self.overlap[1] >= self.tile_size[1]:
+            raise ValueError("Tile overlap " + str(self.overlap) + " must be smaller than the tile size " + str(self.tile_size))
+        self.stride = (self.tile_size[0] - self.overlap[0], self.tile_size[1] - self.overlap[1])
+        self.weights = blend_window(self.tile_size, self.overlap, blend)
+        self.transform = transform
+        self.sobel_features = sobel_features
+        self.device = device
+        self.batch_size = batch_size
+
+    def __read_tile__(self, scene, r0: int, c0: int) -> np.ndarray:
+        #Sobel edges need one pixel of context - tiles are cut with a one pixel halo (clipped at the scene's edges,
+        #where skimage's own boundary handling applies, as for the whole scene) that is dropped afterwards
+        rows, cols = self.tile_size
+        halo = 1 if self.sobel_features else 0
+        top = max(r0 - halo, 0)
+        left = max(c0 - halo, 0)
+        dat = np.array(scene[:, top:r0 + rows + halo, left:c0 + cols + halo], dtype=np.float32)
+        if self.sobel_features:
+            dat = np.concatenate((sobel(dat, axis=(1,2)), dat), axis=0)
+        dat = dat[:, r0 - top:r0 - top + rows, c0 - left:c0 - left + cols]
+        dat[np.where(dat <= FILL)] = 0.0
+        #Scenes smaller than a tile are padded as imputed fill
+        if dat.shape[1] < rows or dat.shape[2] < cols:
+            dat = np.pad(dat, ((0, 0), (0, rows - dat.shape[1]), (0, cols - dat.shape[2])))
+        return dat
+
+    def __forward__(self, tiles: List[np.ndarray]) -> np.ndarray:
+        #Normalized on the host, as DBNDatasetConv normalizes its tiles
+        x = torch.as_tensor(np.stack(tiles))
+        if self.transform is not None:
+            x = self.transform(x)
+        x = x.to(self.device)
+        with torch.no_grad():
+            y = self.model.forward(x)
+        if isinstance(y, (list, tuple)):
+            y = y[0]
+        return y.detach().cpu().numpy()
+
+    def run(self, scene, valid: Optional[np.ndarray] = None) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        """Runs the model over a scene.
+
+        Args:
+            scene: Scene (channels x rows x columns, invalid values set to fill), as returned by dbn_datasets_conv.read_scene.
+            valid: Optional per-pixel validity mask of the scene. Invalid pixels get no output.
+
+        Yields:
+            (Tuple[int, np.ndarray, np.ndarray]): First row of each block of finished rows, the blended outputs of those
+                rows (classes x rows x columns, float32, 0 where there is no output) and their validity.
+
+        """
+        n_rows, n_cols = scene.shape[1], scene.shape[2]
+        if valid is None:
+            valid = np.ones((n_rows, n_cols), dtype=bool)
+        rows, cols = self.tile_size
+        row_starts = tile_starts(n_rows, rows, self.stride[0])
+        col_starts = tile_starts(n_cols, cols, self.stride[1])
+        band = min(rows, n_rows)
+
+        acc = None
+        wsum = None
+        a0 = 0
+        for r0 in row_starts:
+            if acc is not None and r0 > a0:
+                #Rows above this band are finished
+                yield self.__finish__(a0, acc[:, :r0 - a0], wsum[:r0 - a0], valid)
+                keep = a0 + band - r0
+                shifted = np.zeros_like(acc)
+                shifted_w = np.zeros_like(wsum)
+                shifted[:, :keep] = acc[:, r0 - a0:]
+                shifted_w[:keep] = wsum[r0 - a0:]
+                acc, wsum = shifted, shifted_w
+            a0 = r0
+
+            tile_valid = valid[r0:r0 + band]
+            positions = [c0 for c0 in col_starts if tile_valid[:, c0:c0 + cols].any()]
+            for i in range(0, len(positions), self.batch_size):
+                batch = positions[i:i + self.batch_size]
+                outputs = self.__forward__([self.__read_tile__(scene, r0, c0) for c0 in batch])
+                if acc is None:
+                    acc = np.zeros((outputs.shape[1], band, n_cols), dtype=np.float64)
+                    wsum = np.zeros((band, n_cols), dtype=np.float64)
+                for c0, output in zip(batch, outputs):
+                    width = min(cols, n_cols - c0)
+                    w = self.weights[:band, :width] * valid[r0:r0 + band, c0:c0 + width]
+                    acc[:, :, c0:c0 + width] += output[:, :band, :width] * w
+                    wsum[:, c0:c0 + width] += w
+        if acc is not None:
+            yield self.__finish__(a0, acc, wsum, valid)
+
+    def __finish__(self, r0: int, acc: np.ndarray, wsum: np.ndarray, valid: np.ndarray) -> Tuple[int, np.ndarray, np.ndarray]:
+        covered = wsum > 0
+        scores = np.zeros(acc.shape, dtype=np.float32)
+        scores[:, covered] = (acc[:, covered] / wsum[covered]).astype(np.float32)
+        return r0, scores, covered & valid[r0:r0 + acc.shape[1]]
+
+
+def check_parity(engine: TiledInference, scene, valid: Optional[np.ndarray] = None) -> dict:
+    """Compares tiled inference with a single forward pass over the whole scene (which must fit in memory). The two are
+    identical when one tile covers the scene; otherwise they differ only within the model's receptive field of tile edges.
+
+    Args:
+        engine: Tiled inference engine.
+        scene: Scene (channels x rows x columns), as returned by dbn_datasets_conv.read_scene.
+        valid: Optional per-pixel validity mask of the scene.
+
+    Returns:
+        (dict): Number of pixels compared, label agreement and maximum absolute output difference.
+
+    """
+    if valid is None:
+        valid = np.ones(scene.shape[1:], dtype=bool)
+    single = TiledInference(engine.model, (max(engine.tile_size[0], scene.shape[1]), max(engine.tile_size[1], scene.shape[2])),
+        blend="uniform", transform=engine.transform, sobel_features=engine.sobel_features, device=engine.device)
+    expected = np.concatenate([scores for _, scores, _ in single.run(scene, valid)], axis=1)
+    actual = np.concatenate([scores for _, scores, _ in engine.run(scene, valid)], axis=1)
+    expected = expected[:, valid]
+    actual = actual[:, valid]
+    return {"n_pixels": int(valid.sum()), "label_agreement": float((expected.argmax(axis=0) == actual.argmax(axis=0)).mean()),
+        "max_abs_diff": float(np.abs(expected - actual).max())}
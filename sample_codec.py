@@ -0,0 +1,190 @@
+"""
+Copyright [2022-23], by the California Institute of Technology and Chapman University.
+ALL RIGHTS RESERVED. United States Government Sponsorship acknowledged. Any commercial use must be negotiated with the
+Office of Technology Transfer at the California Institute of Technology and Chapman University.
+This software may be subject to U.S. export control laws. By accepting this software, the user agrees to comply with all
+applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be
+required before exporting such information to foreign countries or providing access to foreign persons.
+"""
+import argparse
+
+import numpy as np
+import torch
+
+#Storage data types for preprocessed samples
+#   float32  - no compression (default)
+#   float16  - IEEE half precision
+#   bfloat16 - float32 range with 8 bits of mantissa. Stored as raw int16 bits, as numpy has no bfloat16 type.
+#   int16    - linear quantization with a per-feature (per-channel for tiles) offset and scale
+STORAGE_DTYPES = ["float32", "float16", "bfloat16", "int16"]
+
+#Rows encoded at a time, to bound the temporary float32 copy
+CHUNK_SIZE = 1000000
+
+
+class SampleCodec(object):
+    """
+    Encodes preprocessed samples into a reduced-precision storage type and decodes (upcasts) them back to float32.
+    Axis 1 is the feature axis: features of (N_samples x N_features) data, channels of (N_samples x C x H x W) tiles.
+    """
+
+    def __init__(self, dtype = "float32"):
+        """
+        :param dtype: One of STORAGE_DTYPES.
+        """
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError("Unknown storage dtype " + str(dtype) + ", expected one of " + ", ".join(STORAGE_DTYPES))
+        self.dtype = dtype
+        self.offset = None
+        self.scale = None
+
+    def fit(self, data):
+        """
+        Computes per-feature offsets and scales (int16 only), streaming over the data in chunks.
+
+        :param data: float32 samples (numpy array or tensor).
+        """
+        if self.dtype != "int16":
+            return
+        mins = None
+        maxs = None
+        for i in range(0, data.shape[0], CHUNK_SIZE):
+            chunk = _as_numpy(data[i:i+CHUNK_SIZE])
+            axes = tuple(a for a in range(chunk.ndim) if a != 1)
+            cmin = chunk.min(axis=axes).astype(np.float64)
+            cmax = chunk.max(axis=axes).astype(np.float64)
+            mins = cmin if mins is None else np.minimum(mins, cmin)
+            maxs = cmax if maxs is None else np.maximum(maxs, cmax)
+        self.offset = ((maxs + mins) / 2.0).astype(np.float32)
+        scale = (maxs - mins) / (2.0 * np.iinfo(np.int16).max)
+        scale[scale <= 0.0] = 1.0
+        self.scale = scale.astype(np.float32)
+
+    def encode(self, data):
+        """
+        :param data: float32 samples (numpy array or tensor).
+
+        :return: numpy array in the storage type (int16 bits for bfloat16).
+        """
+        if self.dtype == "float32":
+            return _as_numpy(data).astype(np.float32, copy=False)
+        storage = np.int16
+        if self.dtype == "float16":
+            storage = np.float16
+        out = np.empty(data.shape, dtype=storage)
+        for i in range(0, data.shape[0], CHUNK_SIZE):
+            chunk = data[i:i+CHUNK_SIZE]
+            if self.dtype == "float16":
+                chunk = _as_numpy(chunk)
+                #Values beyond the float16 range would be stored as inf
+                if chunk.size > 0 and np.abs(chunk).max() > np.finfo(np.float16).max:
+                    raise ValueError("Samples reach " + str(np.abs(chunk).max()) + ", beyond the float16 range (" +
+                        str(np.finfo(np.float16).max) + ") - scale the data or use data/storage_dtype bfloat16 or int16")
+                out[i:i+CHUNK_SIZE] = chunk
+            elif self.dtype == "bfloat16":
+                out[i:i+CHUNK_SIZE] = torch.as_tensor(chunk, dtype=torch.float32).to(torch.bfloat16).view(torch.int16).numpy()
+            else:
+                chunk = (_as_numpy(chunk) - self._broadcast(self.offset, chunk.ndim)) / self._broadcast(self.scale, chunk.ndim)
+                out[i:i+CHUNK_SIZE] = np.clip(np.rint(chunk), -np.iinfo(np.int16).max, np.iinfo(np.int16).max)
+        return out
+
+    def fit_encode(self, data):
+        """
+        :param data: float32 samples (numpy array or tensor).
+
+        :return: numpy array in the storage type.
+        """
+        self.fit(data)
+        return self.encode(data)
+
+    def decode(self, stored):
+        """
+        Upcasts a batch of stored samples.
+
+        :param stored: Stored samples (numpy array or tensor), as returned by encode.
+
+        :return: float32 tensor, on the same device as stored.
+        """
+        stored = torch.as_tensor(stored)
+        if self.dtype == "float32":
+            return stored
+        if self.dtype == "float16":
+            return stored.float()
+        if self.dtype == "bfloat16":
+            return stored.view(torch.bfloat16).float()
+        scale = torch.as_tensor(self._broadcast(self.scale, stored.ndim), device=stored.device)
+        offset = torch.as_tensor(self._broadcast(self.offset, stored.ndim), device=stored.device)
+        return stored.float() * scale + offset
+
+    def _broadcast(self, values, ndim):
+        shape = [1] * ndim
+        shape[1] = -1
+        return values.reshape(shape)
+
+
+def _as_numpy(data):
+    if torch.is_tensor(data):
+        return data.detach().cpu().numpy()
+    return np.asarray(data)
+
+
+def quantization_error(data, codec, n_channels = None):
+    """
+    Measures the error introduced by storing data with a codec.
+
+    :param data: float32 samples (N_samples x N_features, or N_samples x C x H x W).
+    :param codec: SampleCodec to evaluate. Fit on data if needed.
+    :param n_channels: Number of channels interleaved in each feature vector (features are ordered window row, window column, channel, as produced by DBNDataset). If None, errors are reported per feature (axis 1).
+
+    :return: Dictionary of per-channel arrays: max absolute error, RMSE, and RMSE relative to the channel's standard deviation.
+    """
+    if codec.dtype == "int16" and codec.scale is None:
+        codec.fit(data)
+    sq_err = None
+    max_err = None
+    total = None
+    total_sq = None
+    count = 0
+    for i in range(0, data.shape[0], CHUNK_SIZE):
+        chunk = torch.as_tensor(_as_numpy(data[i:i+CHUNK_SIZE]), dtype=torch.float32)
+        err = (codec.decode(codec.encode(chunk)) - chunk).double()
+        chunk = chunk.double()
+        if chunk.ndim > 2:
+            chunk = torch.movedim(chunk, 1, -1).reshape(-1, chunk.shape[1])
+            err = torch.movedim(err, 1, -1).reshape(-1, err.shape[1])
+        elif n_channels is not None:
+            chunk = chunk.reshape(-1, n_channels)
+            err = err.reshape(-1, n_channels)
+        cur_sq = (err ** 2).sum(dim=0)
+        cur_max = err.abs().max(dim=0).values
+        sq_err = cur_sq if sq_err is None else sq_err + cur_sq
+        max_err = cur_max if max_err is None else torch.maximum(max_err, cur_max)
+        total = chunk.sum(dim=0) if total is None else total + chunk.sum(dim=0)
+        total_sq = (chunk ** 2).sum(dim=0) if total_sq is None else total_sq + (chunk ** 2).sum(dim=0)
+        count = count + chunk.shape[0]
+    rmse = torch.sqrt(sq_err / count)
+    std = torch.sqrt(torch.clamp(total_sq / count - (total / count) ** 2, min=0.0))
+    std[std == 0.0] = 1.0
+    return {"max_abs_error": max_err.numpy(), "rmse": rmse.numpy(), "relative_rmse": (rmse / std).numpy()}
+
+
+def main(data_fname, dtypes, n_channels = None):
+    data = np.load(data_fname, mmap_mode="r")
+    print("SAMPLES", data.shape, data.dtype, "%.1f MB as float32" % (data.size * 4 / 1e6))
+    for dtype in dtypes:
+        codec = SampleCodec(dtype)
+        err = quantization_error(data, codec, n_channels)
+        print("\n" + dtype, "(%.1f MB)" % (data.size * np.dtype(np.float16 if dtype != "float32" else np.float32).itemsize / 1e6))
+        print("%8s %14s %14s %14s" % ("channel", "max_abs_error", "rmse", "rmse / std"))
+        for c in range(len(err["rmse"])):
+            print("%8d %14.6g %14.6g %14.6g" % (c, err["max_abs_error"][c], err["rmse"][c], err["relative_rmse"][c]))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Reports the per-channel error of storing preprocessed samples in reduced precision.")
+    parser.add_argument("-d", "--data", help="Preprocessed float32 samples (.npy), e.g. train_data.npy written by dbn_datasets.py.")
+    parser.add_argument("-t", "--dtypes", nargs="+", default=STORAGE_DTYPES[1:], help="Storage dtypes to evaluate.")
+    parser.add_argument("-c", "--channels", type=int, default=None, help="Number of channels per window position (2-D samples only). If unset, errors are reported per feature.")
+    args = parser.parse_args()
+    main(args.data, args.dtypes, args.channels)
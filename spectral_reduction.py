@@ -0,0 +1,129 @@
+"""
+Copyright [2022-23], by the California Institute of Technology and Chapman University.
+ALL RIGHTS RESERVED. United States Government Sponsorship acknowledged. Any commercial use must be negotiated with the
+Office of Technology Transfer at the California Institute of Technology and Chapman University.
+This software may be subject to U.S. export control laws. By accepting this software, the user agrees to comply with all
+applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be
+required before exporting such information to foreign countries or providing access to foreign persons.
+"""
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+
+#Spectral reduction methods
+#   pca               - IncrementalPCA, fit by streaming chunks of (scaled) pixels
+#   random_projection - Gaussian random projection. Needs no fitting beyond the number of channels.
+REDUCTION_METHODS = ["pca", "random_projection"]
+
+#Pixels transformed at a time
+CHUNK_SIZE = 1000000
+
+
+class SpectralReducer(object):
+    """
+    Per-pixel reduction of the channel (spectral) dimension, applied to scaled scenes before neighborhood windows are
+    extracted, so the first RBM layer sees n_components * (1 + 2 * pixel_padding)^2 features rather than n_channels * (1 + 2 * pixel_padding)^2.
+    Fit with partial_fit (alongside the scaler) and finalize, then transform.
+    """
+
+    def __init__(self, method = "pca", n_components = 32, seed = 0):
+        """
+        :param method: One of REDUCTION_METHODS.
+        :param n_components: Number of output channels.
+        :param seed: Seed of the random projection.
+        """
+        if method not in REDUCTION_METHODS:
+            raise ValueError("Unknown spectral reduction method " + str(method) + ", expected one of " + ", ".join(REDUCTION_METHODS))
+        self.method = method
+        self.n_components = n_components
+        self.seed = seed
+        self.pca = None
+        self.projection = None
+        self.buffer = []
+        self.n_buffered = 0
+        #Streaming sums of inputs and outputs, for the variance retained by random projections
+        self.n_seen = 0
+        self.input_sums = None
+        self.output_sums = None
+
+    @classmethod
+    def from_config(cls, conf):
+        """
+        :param conf: Dictionary with method and n_components (and, optionally, seed).
+
+        :return: A new, unfitted, SpectralReducer.
+        """
+        return cls(conf.get("method", "pca"), int(conf.get("n_components", 32)), int(conf.get("seed", 0)))
+
+    def partial_fit(self, pixels):
+        """
+        :param pixels: Valid, scaled, pixels (N_pixels x N_channels).
+        """
+        for i in range(0, pixels.shape[0], CHUNK_SIZE):
+            chunk = pixels[i:i+CHUNK_SIZE]
+            if self.method == "random_projection":
+                if self.projection is None:
+                    rng = np.random.default_rng(self.seed)
+                    self.projection = rng.normal(0.0, 1.0 / np.sqrt(self.n_components),
+                        (chunk.shape[1], self.n_components))
+                self.__accumulate__(chunk, chunk @ self.projection)
+                continue
+            if self.pca is None:
+                self.pca = IncrementalPCA(n_components = self.n_components)
+            #IncrementalPCA needs at least n_components samples per batch
+            self.buffer.append(chunk)
+            self.n_buffered = self.n_buffered + chunk.shape[0]
+            if self.n_buffered >= max(self.n_components, CHUNK_SIZE // 10):
+                self.__flush__()
+
+    def finalize(self):
+        """
+        Fits any buffered pixels. Call once all pixels have been passed to partial_fit.
+        """
+        if self.n_buffered > 0:
+            self.__flush__()
+
+    def __flush__(self):
+        pixels = np.concatenate(self.buffer)
+        self.buffer = []
+        self.n_buffered = 0
+        if pixels.shape[0] < self.n_components:
+            if self.pca is None or not hasattr(self.pca, "components_"):
+                raise ValueError("Spectral reduction needs at least " + str(self.n_components) + " valid pixels to fit")
+            return
+        self.pca.partial_fit(pixels)
+
+    def __accumulate__(self, pixels, reduced):
+        sums = np.array([pixels.sum(axis=0), (pixels ** 2).sum(axis=0)])
+        out_sums = np.array([reduced.sum(axis=0), (reduced ** 2).sum(axis=0)])
+        self.input_sums = sums if self.input_sums is None else self.input_sums + sums
+        self.output_sums = out_sums if self.output_sums is None else self.output_sums + out_sums
+        self.n_seen = self.n_seen + pixels.shape[0]
+
+    def transform(self, pixels):
+        """
+        :param pixels: Valid, scaled, pixels (N_pixels x N_channels).
+
+        :return: Reduced pixels (N_pixels x n_components), in the input's floating point type.
+        """
+        out = np.empty((pixels.shape[0], self.n_components), dtype=pixels.dtype)
+        for i in range(0, pixels.shape[0], CHUNK_SIZE):
+            if self.method == "random_projection":
+                out[i:i+CHUNK_SIZE] = pixels[i:i+CHUNK_SIZE] @ self.projection
+            else:
+                out[i:i+CHUNK_SIZE] = self.pca.transform(pixels[i:i+CHUNK_SIZE])
+        return out
+
+    def explained_variance(self):
+        """
+        :return: Dictionary with the fraction of the input variance retained (overall and, for PCA, per component and cumulative).
+        """
+        if self.method == "pca":
+            ratio = self.pca.explained_variance_ratio_
+            return {"method": self.method, "n_components": self.n_components, "n_samples_seen": int(self.pca.n_samples_seen_),
+                "explained_variance_ratio": ratio.tolist(), "cumulative": np.cumsum(ratio).tolist(), "total": float(ratio.sum())}
+        n = max(self.n_seen, 1)
+        in_var = (self.input_sums[1] / n - (self.input_sums[0] / n) ** 2).sum()
+        out_var = (self.output_sums[1] / n - (self.output_sums[0] / n) ** 2).sum()
+        #Random projections preserve the expected squared norm - the ratio shows how closely, not an orthogonal decomposition
+        return {"method": self.method, "n_components": self.n_components, "n_samples_seen": int(self.n_seen),
+            "total": float(out_var / max(in_var, np.finfo(np.float64).tiny))}
@@ -0,0 +1,275 @@
+"""
+Copyright [2022-23], by the California Institute of Technology and Chapman University.
+ALL RIGHTS RESERVED. United States Government Sponsorship acknowledged. Any commercial use must be negotiated with the
+Office of Technology Transfer at the California Institute of Technology and Chapman University.
+This software may be subject to U.S. export control laws. By accepting this software, the user agrees to comply with all
+applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be
+required before exporting such information to foreign countries or providing access to foreign persons.
+"""
+import os
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+
+import torch
+
+#Profilers that can be attached to (top level) phases
+PROFILERS = ["torch", "cprofile"]
+
+
+def _read_proc(fname):
+    values = {}
+    try:
+        with open(fname, "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                values[key.strip()] = value.strip()
+    except OSError:
+        pass
+    return values
+
+
+def _peak_rss():
+    #High water mark of the resident set, in bytes (None if unavailable)
+    hwm = _read_proc("/proc/self/status").get("VmHWM")
+    if hwm is None:
+        return None
+    return int(hwm.split()[0]) * 1024
+
+
+def _reset_peak_rss():
+    #Writing 5 to clear_refs resets VmHWM (Linux >= 4.0)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _io_counters():
+    io = _read_proc("/proc/self/io")
+    return {key: int(io[key]) for key in ["read_bytes", "write_bytes", "rchar", "wchar"] if key in io}
+
+
+def _peak_device():
+    if not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return int(torch.cuda.max_memory_allocated())
+
+
+def _reset_peak_device():
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.reset_peak_memory_stats()
+
+
+class Telemetry(object):
+    """
+    Per-phase performance records (wall time, samples/s, peak RSS, peak device memory, bytes read/written), appended as
+    JSON lines to a file next to the run outputs. Phases may nest - peaks of a phase include those of the phases inside it.
+    Optionally, a torch.profiler or cProfile trace is captured for every top level phase.
+
+    Bytes read and written are those of this process (/proc/self/io): read_bytes/write_bytes reach storage, rchar/wchar
+    include page cache hits. DataLoader worker processes are not included.
+    """
+
+    def __init__(self, path = None, profile = None, profile_dir = None, rank = 0):
+        """
+        :param path: JSON lines file to append records to. If None, nothing is recorded.
+        :param profile: Optional profiler (one of PROFILERS) to capture a trace of each top level phase with.
+        :param profile_dir: Directory traces are written to.
+        :param rank: Rank of this process, added to every record.
+        """
+        if profile is not None and profile not in PROFILERS:
+            raise ValueError("Unknown profiler " + str(profile) + ", expected one of " + ", ".join(PROFILERS))
+        self.path = path
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.rank = rank
+        self.open = []
+        self.profiler = None
+        #Times each phase has run, so traces of repeated phases (e.g. one per output file) do not overwrite each other
+        self.counts = {}
+        if self.profile is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def __fold_peaks__(self):
+        #Current high water marks, before they are reset, count towards every open phase
+        rss = _peak_rss()
+        device = _peak_device()
+        for phase in self.open:
+            if rss is not None:
+                phase["peak_rss_bytes"] = max(phase["peak_rss_bytes"] or 0, rss)
+            if device is not None:
+                phase["peak_device_bytes"] = max(phase["peak_device_bytes"] or 0, device)
+
+    def start(self, name):
+        """
+        Starts timing a phase.
+
+        :param name: Phase name.
+        """
+        if not self.enabled:
+            return
+        self.__fold_peaks__()
+        phase = {"phase": name, "peak_rss_bytes": None, "peak_device_bytes": None}
+        phase["peak_rss_scope"] = "phase" if _reset_peak_rss() else "process"
+        _reset_peak_device()
+        if self.profile is not None and len(self.open) == 0:
+            self.__start_profiler__()
+        phase["io"] = _io_counters()
+        phase["start"] = time.time()
+        phase["timer"] = time.perf_counter()
+        self.open.append(phase)
+
+    def stop(self, name, n_samples = None, **extra):
+        """
+        Stops timing a phase and appends its record.
+
+        :param name: Phase name, as passed to start. Phases are stopped innermost first.
+        :param n_samples: Optional amount of samples processed in the phase, for samples/s.
+        :param extra: Optional additional (JSON serializable) fields of the record, e.g. the file processed.
+
+        :return: The record, or None if telemetry is disabled.
+        """
+        if not self.enabled:
+            return None
+        wall = time.perf_counter() - self.open[-1]["timer"]
+        if self.open[-1]["phase"] != name:
+            raise ValueError("Phase " + str(name) + " stopped while " + str(self.open[-1]["phase"]) + " is running")
+        self.__fold_peaks__()
+        phase = self.open.pop()
+        io = _io_counters()
+
+        record = {"phase": name, "rank": self.rank, "start": phase["start"], "wall_time_s": wall}
+        if len(self.open) > 0:
+            record["parent"] = self.open[-1]["phase"]
+        if n_samples is not None:
+            record["n_samples"] = int(n_samples)
+            record["samples_per_s"] = n_samples / max(wall, 1e-9)
+        record["peak_rss_bytes"] = phase["peak_rss_bytes"]
+        record["peak_rss_scope"] = phase["peak_rss_scope"]
+        record["peak_device_bytes"] = phase["peak_device_bytes"]
+        for key in io:
+            record[key] = io[key] - phase["io"].get(key, 0)
+        record.update(extra)
+
+        if self.profiler is not None and len(self.open) == 0:
+            record["trace"] = self.__stop_profiler__(name)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        return record
+
+    def abort(self):
+        """
+        Drops all running phases (e.g. after an error) without recording them.
+        """
+        self.open = []
+        if self.profiler is not None:
+            if self.profile == "cprofile":
+                self.profiler.disable()
+            else:
+                self.profiler.stop()
+            self.profiler = None
+
+    @contextmanager
+    def phase(self, name, n_samples = None, **extra):
+        """
+        Context manager equivalent of start / stop.
+        """
+        self.start(name)
+        yield
+        self.stop(name, n_samples, **extra)
+
+    def __start_profiler__(self):
+        if self.profile == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities = activities, profile_memory = True)
+        self.profiler.start()
+
+    def __stop_profiler__(self, name):
+        count = self.counts.get(name, 0)
+        self.counts[name] = count + 1
+        base = os.path.join(self.profile_dir, name + "." + str(count) + ".rank" + str(self.rank))
+        if self.profile == "cprofile":
+            self.profiler.disable()
+            fname = base + ".prof"
+            self.profiler.dump_stats(fname)
+        else:
+            self.profiler.stop()
+            fname = base + ".json"
+            self.profiler.export_chrome_trace(fname)
+        self.profiler = None
+        return fname
+
+
+#Telemetry of the current run. Disabled until configured.
+_telemetry = Telemetry()
+
+
+def configure_telemetry(out_dir, profile = None, rank = 0, world_size = 1):
+    """
+    Enables telemetry for the current run. Records go to out_dir/telemetry.jsonl (telemetry.rank<r>.jsonl for ranks other
+    than 0), traces to out_dir/profiles.
+
+    :param out_dir: Output directory of the run.
+    :param profile: Optional profiler (one of PROFILERS).
+    :param rank: Rank of this process.
+    :param world_size: Number of processes.
+
+    :return: The Telemetry now returned by get_telemetry.
+    """
+    global _telemetry
+    fname = "telemetry.jsonl"
+    if rank > 0 and world_size > 1:
+        fname = "telemetry.rank" + str(rank) + ".jsonl"
+    _telemetry = Telemetry(os.path.join(out_dir, fname), profile, os.path.join(out_dir, "profiles"), rank)
+    return _telemetry
+
+
+def get_telemetry():
+    """
+    :return: Telemetry of the current run (a disabled one, whose start and stop do nothing, unless configure_telemetry was called).
+    """
+    return _telemetry
+
+
+def summarize(fname):
+    """
+    :param fname: Telemetry file written by Telemetry.
+
+    :return: Per-phase totals (count, wall time, samples, peak RSS and device memory, bytes read/written), slowest first.
+    """
+    phases = {}
+    with open(fname, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            total = phases.setdefault(record["phase"], {"count": 0, "wall_time_s": 0.0, "n_samples": 0,
+                "peak_rss_bytes": 0, "peak_device_bytes": 0, "read_bytes": 0, "write_bytes": 0})
+            total["count"] = total["count"] + 1
+            total["wall_time_s"] = total["wall_time_s"] + record["wall_time_s"]
+            total["n_samples"] = total["n_samples"] + record.get("n_samples", 0)
+            for key in ["peak_rss_bytes", "peak_device_bytes"]:
+                total[key] = max(total[key], record.get(key) or 0)
+            for key in ["read_bytes", "write_bytes"]:
+                total[key] = total[key] + record.get(key, 0)
+    return dict(sorted(phases.items(), key = lambda item: -item[1]["wall_time_s"]))
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Summarizes a telemetry.jsonl file per phase, slowest first.")
+    parser.add_argument("-f", "--file", help="Telemetry file (out_dir/telemetry.jsonl).")
+    args = parser.parse_args()
+    print(json.dumps(summarize(args.file), indent=2))
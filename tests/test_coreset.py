@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from coreset import kcenter_coreset, select_subset
+
+
+@pytest.mark.parametrize("n_features", [9, 81])
+@pytest.mark.parametrize("k", [50, 500])
+def test_kcenter_selects_exactly_k(n_features, k):
+    data = np.random.default_rng(0).normal(size=(4000, n_features)).astype(np.float32)
+    inds, counts = kcenter_coreset(data, k, block_size=512)
+    assert inds.shape[0] == k
+    assert np.unique(inds).shape[0] == k
+    assert counts.sum() == data.shape[0]
+
+
+def test_kcenter_duplicates():
+    #Fewer distinct samples than k - duplicates fill the subset
+    data = np.repeat(np.eye(5, dtype=np.float32), 40, axis=0)
+    inds, counts = kcenter_coreset(data, 20, block_size=64)
+    assert np.unique(inds).shape[0] == 20
+    assert counts.sum() == data.shape[0]
+
+
+@pytest.mark.parametrize("method", ["random", "norm", "kcenter"])
+def test_select_subset(method):
+    data = np.random.default_rng(0).normal(size=(3000, 5)).astype(np.float32)
+    inds, weights = select_subset(data, 100, method, seed=1)
+    assert inds.shape[0] == 100
+    assert np.all(np.diff(inds) > 0)
+    assert weights.shape[0] == 100
+    if method != "kcenter":
+        np.testing.assert_allclose(weights.sum(), data.shape[0], rtol=0.5)
+
+
+def test_random_subset_is_seeded_and_not_a_prefix():
+    data = np.zeros((1000, 2), dtype=np.float32)
+    inds, _ = select_subset(data, 100, "random", seed=3)
+    assert np.array_equal(inds, select_subset(data, 100, "random", seed=3)[0])
+    assert not np.array_equal(inds, np.arange(100))
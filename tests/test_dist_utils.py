@@ -0,0 +1,74 @@
+import os
+import socket
+
+import numpy as np
+import pytest
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from sklearn.preprocessing import MaxAbsScaler, MinMaxScaler, StandardScaler
+
+from dist_utils import all_reduce_scaler
+
+WORLD_SIZE = 2
+
+
+class CumlLikeStandardScaler(object):
+    """Stands in for cuML's StandardScaler: same fitted attributes as sklearn's, but not a subclass of it."""
+
+    def partial_fit(self, x):
+        fitted = StandardScaler().partial_fit(x)
+        for key in ["mean_", "var_", "scale_", "n_samples_seen_", "n_features_in_"]:
+            setattr(self, key, getattr(fitted, key))
+        return self
+
+
+#Matched by module and class name, as cuml.preprocessing.StandardScaler is
+CumlLikeStandardScaler.__name__ = "StandardScaler"
+
+SCALERS = {"sklearn_standard": StandardScaler, "sklearn_max_abs": MaxAbsScaler, "cuml_standard": CumlLikeStandardScaler,
+    "min_max": MinMaxScaler}
+
+
+def data(rank):
+    return np.random.default_rng(rank).normal(loc=rank, scale=1 + rank, size=(100 + 50 * rank, 3))
+
+
+def run(rank, port, scaler_name, results):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=WORLD_SIZE)
+    try:
+        scaler_cls = SCALERS[scaler_name]
+        if scaler_cls is CumlLikeStandardScaler:
+            scaler_cls.__module__ = "cuml.preprocessing"
+        scaler = scaler_cls().partial_fit(data(rank))
+        try:
+            all_reduce_scaler(scaler)
+        except ValueError:
+            results[rank] = "raised"
+            return
+        results[rank] = {key: getattr(scaler, key) for key in ["mean_", "var_", "scale_", "max_abs_", "n_samples_seen_"] if hasattr(scaler, key)}
+    finally:
+        dist.destroy_process_group()
+
+
+def reduce_on_ranks(scaler_name):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    results = mp.Manager().dict()
+    mp.spawn(run, args=(port, scaler_name, results), nprocs=WORLD_SIZE)
+    return [results[rank] for rank in range(WORLD_SIZE)]
+
+
+@pytest.mark.parametrize("scaler_name", ["sklearn_standard", "sklearn_max_abs", "cuml_standard"])
+def test_all_reduce_scaler_matches_union(scaler_name):
+    expected_cls = MaxAbsScaler if scaler_name == "sklearn_max_abs" else StandardScaler
+    expected = expected_cls().fit(np.concatenate([data(rank) for rank in range(WORLD_SIZE)]))
+    for result in reduce_on_ranks(scaler_name):
+        for key, value in result.items():
+            np.testing.assert_allclose(value, getattr(expected, key))
+
+
+def test_all_reduce_scaler_rejects_unsupported():
+    assert reduce_on_ranks("min_max") == ["raised"] * WORLD_SIZE
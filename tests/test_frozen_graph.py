@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.preprocessing import StandardScaler
+
+from learnergy.core import Model
+from learnergy.models.deep import DBN
+from rbm_models import frozen_graph
+from rbm_models.clust_dbn import ClustDBN
+from rbm_models.heirarchichal_deep_clust import HeirClust
+
+N_VISIBLE = 12
+N_EMBED = 8
+N_CLASSES = 5
+
+
+def build_clust(seed=0):
+    torch.manual_seed(seed)
+    dbn = DBN(model=("gaussian_selu", "gaussian_selu"), n_visible=N_VISIBLE, n_hidden=(16, N_EMBED), steps=(1, 1),
+        learning_rate=(0.1, 0.1), momentum=(0, 0), decay=(0, 0), temperature=(1, 1), use_gpu=False)
+    x = torch.randn(500, N_VISIBLE, generator=torch.Generator().manual_seed(seed))
+    with torch.no_grad():
+        embedded = dbn(x).numpy()
+    return ClustDBN(dbn, N_EMBED, N_CLASSES, use_gpu=False, scaler=StandardScaler().fit(embedded)).eval()
+
+
+def build_heir():
+    base = build_clust()
+    heir = HeirClust.__new__(HeirClust)
+    Model.__init__(heir, use_gpu=False)
+    heir.base_clust = base
+    children = {}
+    for label in range(N_CLASSES):
+        #Label 1 has a None sub-clustering, label 3 none at all
+        if label == 3:
+            continue
+        child = None
+        if label != 1:
+            torch.manual_seed(100 + label)
+            child = ClustDBN(base.dbn_trunk, N_EMBED, N_CLASSES, use_gpu=False, scaler=base.scaler).eval()
+        children[str(torch.tensor(label))] = child
+    heir.clust_tree = {"0": {"-1": base}, "1": children}
+    return heir
+
+
+def samples(n=300, seed=1):
+    return torch.randn(n, N_VISIBLE, generator=torch.Generator().manual_seed(seed))
+
+
+@pytest.mark.parametrize("fmt", frozen_graph.FREEZE_FORMATS)
+@pytest.mark.parametrize("build", [build_clust, build_heir])
+def test_frozen_labels_match_eager(build, fmt, tmp_path):
+    model = build()
+    x = samples()
+    frozen = frozen_graph.freeze(model, x[:64], fmt)
+    fname = str(tmp_path / ("graph.pt2" if fmt == "export" else "graph.pt"))
+    frozen_graph.save(frozen, fname)
+    frozen = frozen_graph.load(fname)
+    #Batches of other sizes than the traced one
+    for batch in [x[:17], x[17:]]:
+        labels, scores = frozen_graph.eager(model, batch)
+        with torch.no_grad():
+            frozen_labels, frozen_scores = frozen(batch)
+        assert torch.equal(frozen_labels, labels)
+        if scores is not None:
+            assert float((frozen_scores - scores).abs().max()) < 1e-5
+
+
+def test_heir_routing_covers_every_branch():
+    model = build_heir()
+    base_labels = frozen_graph.eager(model.base_clust, samples())[0]
+    routed = frozen_graph.eager(model, samples())[0]
+    assert set(base_labels.tolist()) == set(range(N_CLASSES))
+    #Samples of base clusters without a sub-clustering keep the base label, times the offset
+    plain = (base_labels == 1) | (base_labels == 3)
+    assert torch.equal(routed[plain], base_labels[plain] * frozen_graph.HEIR_LABEL_OFFSET)
+    assert torch.equal(routed // frozen_graph.HEIR_LABEL_OFFSET, base_labels)
@@ -0,0 +1,69 @@
+import torch
+import torch.nn as nn
+
+from learnergy.core import Model
+from rbm_models.heirarchichal_deep_clust import HeirClust
+
+
+class Head(nn.Module):
+    """Linear clustering head, returning its scores as ClustDBN does (first element of a list or tuple)."""
+
+    def __init__(self, weight, bias=None, as_tuple=False):
+        super().__init__()
+        self.fc = nn.Linear(weight.shape[1], weight.shape[0])
+        with torch.no_grad():
+            self.fc.weight.copy_(weight)
+            self.fc.bias.copy_(bias if bias is not None else torch.zeros(weight.shape[0]))
+        self.as_tuple = as_tuple
+
+    def forward(self, x):
+        y = torch.softmax(self.fc(x), dim=1)
+        return (y,) if self.as_tuple else [y]
+
+
+def make_heir(base, subs):
+    model = HeirClust.__new__(HeirClust)
+    Model.__init__(model, use_gpu=False)
+    model.base_clust = base
+    model.clust_tree = {"0": {"-1": base}, "1": subs}
+    return model
+
+
+def build(n_features=6):
+    gen = torch.Generator().manual_seed(0)
+    #Top-level label 3 is never the argmax (empty group), label 1 has no sub-clustering, label 2 has a None sub-clustering
+    #Samples at the origin go to label 4
+    base = Head(torch.randn(5, n_features, generator=gen), torch.tensor([0.0, 0.0, 0.0, -1e4, 1.0]))
+    sub_w = torch.randn(4, n_features, generator=gen)
+    #Near ties: rows equal up to the last bits, and an exact tie
+    near = sub_w.clone()
+    near[1] = near[0] * (1 + 1e-7)
+    near[3] = near[2]
+    subs = {str(torch.tensor(0)): Head(sub_w), str(torch.tensor(2)): None, str(torch.tensor(4)): Head(near, as_tuple=True)}
+    return make_heir(base, subs), gen
+
+
+def test_grouped_routing_matches_per_sample():
+    model, gen = build()
+    x = torch.randn(2000, 6, generator=gen)
+    #Samples that tie exactly in the sub-clustering of label 4
+    x[:50] = 0.0
+    #Samples at near ties in the sub-clustering of label 4
+    x[50:100] = 1e-6 * x[50:100]
+    with torch.no_grad():
+        grouped = model.forward(x)
+        per_sample = model.forward_per_sample(x)
+        top = torch.argmax(model.base_clust.forward(x)[0], dim=1)
+    assert torch.equal(grouped, per_sample)
+    assert not (top == 3).any()
+    assert set(top.tolist()) >= {0, 1, 2, 4}
+
+
+def test_grouped_routing_single_sample_and_single_group():
+    model, gen = build()
+    x = torch.randn(1, 6, generator=gen)
+    with torch.no_grad():
+        assert torch.equal(model.forward(x), model.forward_per_sample(x))
+    x = torch.zeros(7, 6)
+    with torch.no_grad():
+        assert torch.equal(model.forward(x), model.forward_per_sample(x))
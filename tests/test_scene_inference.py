@@ -0,0 +1,63 @@
+import numpy as np
+import torch
+from sklearn.preprocessing import StandardScaler
+from skimage.util import view_as_windows
+
+from learnergy.models.deep import DBN
+from rbm_models.clust_dbn import ClustDBN
+from rbm_models.scene_inference import SceneInference, check_parity
+from validity import window_mask
+
+PADDING = 2
+SIZE_WIND = 1 + 2 * PADDING
+
+
+def build(n_chans=8, seed=0):
+    torch.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+    scene = rng.normal(size=(96, 80, n_chans)).astype(np.float32)
+    valid = np.ones(scene.shape[:2], dtype=bool)
+    valid[30:33, 10:40] = False
+    valid[:, 0] = False
+    scene[~valid] = -9999
+    dbn = DBN(model=("gaussian_selu", "gaussian_selu"), n_visible=SIZE_WIND * SIZE_WIND * n_chans, n_hidden=(32, 16),
+        steps=(1, 1), learning_rate=(0.1, 0.1), momentum=(0, 0), decay=(0, 0), temperature=(1, 1), use_gpu=False)
+    for model in dbn.models:
+        model.W.requires_grad_(False)
+        model.b.requires_grad_(False)
+    windows = view_as_windows(scene, [SIZE_WIND, SIZE_WIND, n_chans])[window_mask(valid, PADDING)].reshape((-1, SIZE_WIND * SIZE_WIND * n_chans))
+    with torch.no_grad():
+        embedded = dbn(torch.as_tensor(windows)).numpy()
+    clust = ClustDBN(dbn, 16, 7, use_gpu=False, scaler=StandardScaler().fit(embedded)).eval()
+    return clust, scene, valid
+
+
+def test_scene_inference_matches_forward():
+    clust, scene, valid = build()
+    for model in [clust, clust.dbn_trunk]:
+        engine = SceneInference(model, PADDING, tile_size=32)
+        parity = check_parity(engine, scene, valid, 2000)
+        assert parity["n_samples"] == 2000
+        assert parity["label_agreement"] == 1.0
+        assert parity["max_abs_diff"] < 1e-3
+
+
+def test_scene_inference_covers_every_sample():
+    clust, scene, valid = build()
+    engine = SceneInference(clust, PADDING, tile_size=32)
+    coords = np.concatenate([coord for _, coord in engine.tiles(scene, valid)])
+    expected = np.argwhere(window_mask(valid, PADDING)) + PADDING
+    assert coords.shape[0] == engine.count(valid)
+    assert np.array_equal(np.sort(coords[:, 1] * scene.shape[1] + coords[:, 2]), np.sort(expected[:, 0] * scene.shape[1] + expected[:, 1]))
+
+
+def test_check_parity_crop():
+    clust, scene, valid = build()
+    engine = SceneInference(clust, PADDING, tile_size=32)
+    parity = check_parity(engine, scene, valid, 256, crop_size=16)
+    assert parity["n_samples"] == 256
+    assert parity["label_agreement"] == 1.0
+    #A wrong head is caught
+    forward_pixels = engine.forward_pixels
+    engine.forward_pixels = lambda y: forward_pixels(y).flip(1)
+    assert check_parity(engine, scene, valid, 256, crop_size=16)["label_agreement"] < 1.0
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import torch
+from skimage.filters import sobel
+
+from dbn_datasets_conv import check_sobel_layer, prepare_scene
+from rbm_models.fcn_dbn import SobelFeatures
+from validity import FILL
+
+RTOL = 1e-5
+
+
+def synthetic_scene(n_chans, shape, seed=0):
+    """Scene with fill at its corners, along its edges and in its interior."""
+    rng = np.random.default_rng(seed)
+    dat = (rng.normal(size=(n_chans,) + tuple(shape)) * 50.0 + 100.0).astype(np.float32)
+    dat[:, 0, 0] = FILL
+    dat[:, -1, -1] = FILL
+    dat[:, -1, 1:3] = FILL
+    dat[0, 1:3, 0] = FILL
+    dat[-1, 1, -1] = FILL
+    dat[:, shape[0] // 2, shape[1] // 2] = FILL
+    return dat
+
+
+@pytest.mark.parametrize("n_chans,shape", [(4, (17, 23)), (1, (17, 23)), (3, (4, 5))])
+def test_sobel_layer_matches_skimage_on_normalized_inputs(n_chans, shape):
+    report = check_sobel_layer(synthetic_scene(n_chans, shape))
+    assert report["max_rel_diff"] <= RTOL
+    #Stored features are computed before fill is imputed, so they differ around fill
+    assert report["fill_affected_fraction"] > 0.0
+
+
+def test_sobel_layer_matches_skimage_on_raw_inputs():
+    dat = synthetic_scene(4, (17, 23))
+    imputed = prepare_scene(dat.copy(), False)
+    reference = sobel(imputed, axis=(1,2))
+    with torch.no_grad():
+        out = SobelFeatures()(torch.from_numpy(imputed)[None])[0]
+    assert out.shape[0] == 2 * dat.shape[0]
+    np.testing.assert_allclose(out[:dat.shape[0]].numpy(), reference, rtol=0, atol=RTOL * np.abs(reference).max())
+    np.testing.assert_array_equal(out[dat.shape[0]:].numpy(), imputed)
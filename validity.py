@@ -0,0 +1,110 @@
+"""
+Copyright [2022-23], by the California Institute of Technology and Chapman University.
+ALL RIGHTS RESERVED. United States Government Sponsorship acknowledged. Any commercial use must be negotiated with the
+Office of Technology Transfer at the California Institute of Technology and Chapman University.
+This software may be subject to U.S. export control laws. By accepting this software, the user agrees to comply with all
+applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be
+required before exporting such information to foreign countries or providing access to foreign persons.
+"""
+import os
+
+import numpy as np
+from skimage.util import view_as_windows
+
+#Sentinel invalid values are set to in scene data. Readers may already use it for missing data.
+FILL = -9999
+
+
+def validity_mask(dat, valid_min = None, valid_max = None, fill_value = None):
+    """
+    Computes, once at read time, which values of a scene are usable.
+
+    :param dat: Scene data (any dimensionality).
+    :param valid_min: Optional minimum valid value. Anything less is invalid.
+    :param valid_max: Optional maximum valid value. Anything greater is invalid.
+    :param fill_value: Optional fill value of the data.
+
+    :return: Boolean mask with the shape of dat, True where values are valid. NaNs and values already set to FILL are invalid.
+    """
+    valid = dat > FILL + 1
+    if valid_min is not None:
+        valid &= dat >= valid_min - 0.00000000005
+    if valid_max is not None:
+        valid &= dat <= valid_max - 0.00000000005
+    if fill_value is not None:
+        valid &= dat != fill_value
+    return valid
+
+
+def pixel_mask(valid, chan_dim):
+    """
+    :param valid: Per-channel validity mask (see validity_mask).
+    :param chan_dim: Channel dimension of the mask.
+
+    :return: Per-pixel validity mask, True where all channels are valid.
+    """
+    return valid.all(axis=chan_dim)
+
+
+def window_mask(valid_pixels, pixel_padding):
+    """
+    Validity of neighborhood samples: a sample is valid if every pixel of its (1 + 2 * pixel_padding)^2 window is valid.
+
+    :param valid_pixels: 2-D per-pixel validity mask.
+    :param pixel_padding: Number of neighbors in each direction.
+
+    :return: Boolean mask over the window grid (pixel_padding smaller than the scene on every side), in the order view_as_windows produces samples.
+    """
+    if pixel_padding == 0:
+        return valid_pixels
+    size_wind = 1 + 2 * pixel_padding
+    return view_as_windows(valid_pixels, (size_wind, size_wind)).all(axis=(2,3))
+
+
+def pack_mask(valid):
+    """
+    :param valid: Boolean mask.
+
+    :return: Compact (1 bit per value) representation of the mask: dictionary with its shape and packed bits.
+    """
+    return {"shape": np.asarray(valid.shape), "bits": np.packbits(valid, axis=None)}
+
+
+def unpack_mask(packed):
+    """
+    :param packed: Mask as returned by pack_mask.
+
+    :return: Boolean mask.
+    """
+    shape = tuple(int(s) for s in packed["shape"])
+    return np.unpackbits(packed["bits"], count=int(np.prod(shape))).astype(bool).reshape(shape)
+
+
+def get_mask_filename(output_filename):
+    """
+    :param output_filename: Path to per-sample output (e.g. as written by generate_output).
+
+    :return: Path the validity mask of the output's scene is stored at.
+    """
+    return output_filename + ".mask.npz"
+
+
+def save_mask(fname, packed):
+    """
+    :param fname: Path to write to (see get_mask_filename).
+    :param packed: Mask as returned by pack_mask.
+    """
+    with open(fname, "wb") as f:
+        np.savez(f, **packed)
+
+
+def load_mask(fname):
+    """
+    :param fname: Path written by save_mask.
+
+    :return: Boolean mask, or None if the file does not exist.
+    """
+    if not os.path.exists(fname):
+        return None
+    with np.load(fname) as packed:
+        return unpack_mask(packed)
@@ -21,6 +21,7 @@ from joblib import load
 
 #Data
 from utils import read_yaml, get_read_func
+from output_store import load_output, load_indices
 
 #ML Imports
 import torch
@@ -75,7 +76,7 @@ def load_model(yml_conf, n_visible = None):
     
     if n_visible is None:
         input_fp = glob(os.path.join(out_dir, "*.clustoutput.data.input"))[0]
-        data_full = torch.load(input_fp)
+        data_full = load_output(input_fp)
         n_visible = data_full.shape[1]
     
     new_dbn = DBN(model=model_type, n_visible=n_visible, n_hidden=dbn_arch, steps=gibbs_steps, \
@@ -131,10 +132,10 @@ def read_train_test(yml_conf, read_from_input_file = False):
     
     # Try to load data from .input files (seems to be a bit faster)
     if read_from_input_file and os.path.exists(train_fp) and os.path.exists(test_fp):
-        data_train = np.array(torch.load(train_fp))
-        data_test = np.array(torch.load(test_fp))
+        data_train = np.array(load_output(train_fp))
+        data_test = np.array(load_output(test_fp))
         
-        test_idx = np.array(torch.load(test_idx_fp))
+        test_idx = load_indices(test_idx_fp)
         dims = dims_from_indices(test_idx, n_channels, chan_dim)
         print(data_train.shape)
         data_train = unwrap(data_train, dims)
@@ -144,7 +145,7 @@ def read_train_test(yml_conf, read_from_input_file = False):
         if data_train.shape == data_test.shape:
             data_test = unwrap(data_test, dims)
         else:
-            train_idx = np.array(torch.load(train_idx_fp))
+            train_idx = load_indices(train_idx_fp)
             dims = dims_from_indices(train_idx, n_channels, chan_dim)
             data_train = unwrap(data_train, dims)
             del train_idx